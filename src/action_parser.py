@@ -0,0 +1,369 @@
+"""
+Single pass parser for the action grammar of TARS_SYSTEM_PROMPT.
+
+    actions := fence? ( "[" call_string ("," call_string)* "]" | call ([,;]? call)* ) fence?
+    call    := NAME "(" [ argument ("," argument)* ] ")"
+    argument:= NAME "=" value | value
+    value   := STRING | POINT | NUMBER | NAME
+
+Inside the JSON list form every call is a JSON encoded string. Box tokens (<|box_start|>, <|box_end|>)
+are accepted around points. A single quote only ends a single quoted string before ",", ")" or "]", so
+unescaped apostrophes (type(content='It's a test')) are part of the string.
+"""
+import json
+import re
+from typing import NamedTuple
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<ws>\s+)
+    |(?P<fence>```(?:json)?)
+    |(?P<point>(?:<\|box_start\|>)?\(\s*(?P<x>-?\d+)\s*,\s*(?P<y>-?\d+)\s*\)(?:<\|box_end\|>)?)
+    |(?P<number>-?\d+(?:\.\d+)?)
+    |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<sq_string>'(?:\\.|[^'\\]|'(?!\s*[,)\]]))*')
+    |(?P<dq_string>"(?:\\.|[^"\\])*")
+    |(?P<punct>[()\[\],;=])
+    |(?P<error>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+ACTION_LINE_PATTERN = re.compile(r"^\s*action\s*:", re.IGNORECASE | re.MULTILINE)
+INLINE_ACTION_PATTERN = re.compile(r"\baction\s*:", re.IGNORECASE)
+POINT_PATTERN = re.compile(r"^\s*(?:<\|box_start\|>)?\s*\(\s*(-?\d+)\s*,\s*(-?\d+)\s*\)\s*(?:<\|box_end\|>)?\s*$")
+
+# Argument names of every atomic action, required ones first. Positional arguments bind in this order.
+ACTION_ARGUMENTS = {
+    "click": (("start_box",), ()),
+    "long_press": (("start_box",), ("time",)),
+    "type": (("content",), ()),
+    "scroll": (("start_box", "end_box"), ()),
+    "press_home": ((), ()),
+    "press_back": ((), ()),
+    "finished": ((), ("content",)),
+    "wait": ((), ("time",)),
+    "double_click": (("start_box",), ("time",)),
+    "call_user": ((), ("content",)),
+}
+
+
+class ActionParseError(Exception):
+    def __init__(self, message, text="", position=0):
+        self.message = message
+        self.text = text
+        self.position = position
+        super().__init__(self.__str__())
+
+    def __str__(self):
+        if not self.text:
+            return self.message
+        line_start = self.text.rfind("\n", 0, self.position) + 1
+        line_end = self.text.find("\n", self.position)
+        line = self.text[line_start:line_end if line_end != -1 else len(self.text)]
+        return f"{self.message} at position {self.position}:\n{line}\n{' ' * (self.position - line_start)}^"
+
+
+class Action(NamedTuple):
+    name: str
+    args: dict
+    position: int = 0
+
+    @property
+    def is_shortcut(self):
+        return self.name not in ACTION_ARGUMENTS
+
+    def render(self):
+        """
+        Canonical call string, e.g. click(start_box='(509,155)').
+        """
+        arguments = []
+        for key, value in self.args.items():
+            if isinstance(value, tuple):
+                value = f"({value[0]},{value[1]})"
+            elif value is None:
+                value = ""
+            value = str(value).replace("\\", "\\\\").replace("'", "\\'")
+            arguments.append(f"{key}='{value}'")
+        return f"{self.name}({', '.join(arguments)})"
+
+    def to_event(self):
+        """
+        The action dict consumed by ActionSpace.map_generate_action_to_event.
+        """
+        if self.is_shortcut:
+            return {"type": "shortcut", "name": self.name, "args": dict(self.args)}
+        event = {"type": self.name}
+        if "start_box" in self.args:
+            box = self.args["start_box"]
+            if self.name == "scroll":
+                event["start_x"], event["start_y"] = box
+                event["end_x"], event["end_y"] = self.args["end_box"]
+            else:
+                event["x"], event["y"] = box
+        if self.args.get("content") or self.name == "type":
+            event["content"] = self.args.get("content", "")
+        if self.args.get("time") is not None:
+            event["time"] = self.args["time"]
+        return event
+
+
+def unquote(token):
+    """
+    Text of a quoted string. Double quoted strings are JSON strings (the JSON list form); in single
+    quoted ones only escaped quotes and backslashes are unescaped, other escapes such as the \\n the
+    model ends a type() content with are kept as written.
+    """
+    if token[0] == '"':
+        try:
+            return json.loads(token)
+        except ValueError:
+            pass
+    return re.sub(r"\\([\\'\"])", r"\1", token[1:-1])
+
+
+class ActionParser:
+    """
+    strict=True raises ActionParseError on the first problem: unknown action names (when a `shortcuts`
+    collection is given), missing or unexpected arguments and trailing text after the action list.
+    Otherwise malformed calls are skipped and an error is raised only when no action could be parsed.
+    """
+
+    def __init__(self, strict=False, shortcuts=None):
+        self.strict = strict
+        self.shortcuts = shortcuts
+
+    def tokenize(self, text, offset=0):
+        tokens = []
+        for match in TOKEN_PATTERN.finditer(text):
+            kind = match.lastgroup if match.lastgroup not in ("x", "y") else "point"
+            if kind == "ws":
+                continue
+            if kind == "error":
+                tokens.append(("error", match.group(), offset + match.start()))
+            elif kind == "point":
+                tokens.append(("point", (int(match.group("x")), int(match.group("y"))), offset + match.start()))
+            else:
+                tokens.append((kind, match.group(), offset + match.start()))
+        tokens.append(("end", "", offset + len(text)))
+        return tokens
+
+    def parse(self, response: str):
+        """
+        Parse the `Action:` section of a model response into a list of Action.
+        """
+        match = ACTION_LINE_PATTERN.search(response) or INLINE_ACTION_PATTERN.search(response)
+        if not match:
+            raise ActionParseError("No 'Action:' line found", response, len(response))
+        self.text = response
+        self.errors = []
+        self.tokens = self.tokenize(response[match.end():], match.end())
+        self.index = 0
+        actions = self.__parse_actions__()
+        if not actions:
+            raise self.errors[0] if self.errors else ActionParseError("Empty action list", response, match.end())
+        return actions
+
+    def __peek__(self):
+        return self.tokens[self.index]
+
+    def __advance__(self):
+        token = self.tokens[self.index]
+        if token[0] != "end":
+            self.index += 1
+        return token
+
+    def __expect__(self, kind, value=None):
+        token = self.__advance__()
+        if token[0] != kind or (value is not None and token[1] != value):
+            expected = repr(value) if value is not None else kind
+            found = repr(token[1]) if token[0] != "end" else "end of text"
+            raise ActionParseError(f"Expected {expected}, found {found}", self.text, token[2])
+        return token
+
+    def __fail__(self, error):
+        if self.strict:
+            raise error
+        self.errors.append(error)
+
+    def __parse_actions__(self):
+        if self.__peek__()[0] == "fence":
+            self.__advance__()
+        actions = []
+        if self.__peek__()[:2] == ("punct", "["):
+            self.__advance__()
+            while self.__peek__()[0] != "end" and self.__peek__()[1] != "]":
+                token = self.__advance__()
+                if token[0] in ("dq_string", "sq_string"):
+                    self.__parse_nested__(unquote(token[1]), token[2] + 1, actions)
+                elif token[0] == "name":
+                    self.index -= 1
+                    self.__parse_call_into__(actions)
+                elif token[:2] != ("punct", ","):
+                    self.__fail__(ActionParseError(f"Unexpected {token[1]!r} in action list", self.text, token[2]))
+            self.__expect__("punct", "]")
+        else:
+            while self.__peek__()[0] == "name":
+                self.__parse_call_into__(actions)
+                if self.__peek__()[0] == "punct" and self.__peek__()[1] in (",", ";"):
+                    self.__advance__()
+        if self.__peek__()[0] == "fence":
+            self.__advance__()
+        token = self.__peek__()
+        if self.strict and token[0] != "end":
+            raise ActionParseError(f"Unexpected {token[1]!r} after actions", self.text, token[2])
+        return actions
+
+    def __parse_nested__(self, call_text, offset, actions):
+        parser = ActionParser(strict=self.strict, shortcuts=self.shortcuts)
+        parser.text = self.text
+        parser.errors = self.errors
+        parser.tokens = parser.tokenize(call_text, offset)
+        parser.index = 0
+        if parser.__peek__()[0] != "name":
+            token = parser.__peek__()
+            self.__fail__(ActionParseError(f"Expected action call, found {token[1]!r}", self.text, token[2]))
+            return
+        parser.__parse_call_into__(actions)
+        token = parser.__peek__()
+        if token[0] != "end":
+            self.__fail__(ActionParseError(f"Unexpected {token[1]!r} after action", self.text, token[2]))
+
+    def __parse_call_into__(self, actions):
+        try:
+            actions.append(self.__parse_call__())
+        except ActionParseError as e:
+            self.__fail__(e)
+            self.__skip_call__()
+
+    def __skip_call__(self):
+        depth = 0
+        while self.__peek__()[0] != "end":
+            kind, value, _ = self.__advance__()
+            if kind == "punct" and value == "(":
+                depth += 1
+            elif kind == "punct" and value == ")":
+                depth -= 1
+                if depth <= 0:
+                    return
+
+    def __parse_call__(self):
+        _, name, position = self.__expect__("name")
+        self.__expect__("punct", "(")
+        keywords, positional = {}, []
+        while not (self.__peek__()[0] == "punct" and self.__peek__()[1] == ")"):
+            kind, value, token_position = self.__advance__()
+            if kind == "name" and self.__peek__()[:2] == ("punct", "="):
+                self.__advance__()
+                keywords[value] = self.__parse_value__()
+            elif kind in ("sq_string", "dq_string", "point", "number", "name"):
+                self.index -= 1
+                positional.append(self.__parse_value__())
+            else:
+                found = repr(value) if kind != "end" else "end of text"
+                raise ActionParseError(f"Expected argument in {name}(), found {found}", self.text, token_position)
+            if self.__peek__()[:2] == ("punct", ","):
+                self.__advance__()
+            elif not (self.__peek__()[0] == "punct" and self.__peek__()[1] == ")"):
+                token = self.__peek__()
+                found = repr(token[1]) if token[0] != "end" else "end of text"
+                raise ActionParseError(f"Expected ',' or ')' in {name}(), found {found}", self.text, token[2])
+        self.__expect__("punct", ")")
+        return self.__bind__(name, keywords, positional, position)
+
+    def __parse_value__(self):
+        kind, value, position = self.__advance__()
+        if kind in ("sq_string", "dq_string"):
+            value = unquote(value)
+            point = POINT_PATTERN.match(value)
+            return (int(point.group(1)), int(point.group(2))) if point else value
+        if kind == "number":
+            return float(value) if "." in value else int(value)
+        if kind in ("point", "name"):
+            return value
+        found = repr(value) if kind != "end" else "end of text"
+        raise ActionParseError(f"Expected value, found {found}", self.text, position)
+
+    def __bind__(self, name, keywords, positional, position):
+        action_name = name.lower()
+        if action_name not in ACTION_ARGUMENTS:
+            if self.strict and self.shortcuts is not None and name not in self.shortcuts:
+                raise ActionParseError(f"Unknown action {name!r}", self.text, position)
+            args = dict(keywords)
+            for index, value in enumerate(positional):
+                args[f"arg{index}"] = value
+            return Action(name, args, position)
+        required, optional = ACTION_ARGUMENTS[action_name]
+        names = required + optional
+        if len(positional) > len(names):
+            raise ActionParseError(f"Too many arguments for {action_name}()", self.text, position)
+        args = dict(zip(names, positional))
+        for key, value in keywords.items():
+            if key not in names:
+                if self.strict:
+                    raise ActionParseError(f"Unexpected argument {key!r} for {action_name}()", self.text, position)
+                continue
+            args[key] = value
+        for key in required:
+            if key not in args:
+                raise ActionParseError(f"Missing argument {key!r} for {action_name}()", self.text, position)
+            if key.endswith("_box") and not isinstance(args[key], tuple):
+                raise ActionParseError(f"Argument {key!r} of {action_name}() is not a point: {args[key]!r}", self.text, position)
+        if "time" in args:
+            args["time"] = self.__parse_time__(args["time"], action_name, position)
+        return Action(action_name, args, position)
+
+    def __parse_time__(self, value, action_name, position):
+        if value in ("", None):
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            if self.strict:
+                raise ActionParseError(f"Invalid time {value!r} for {action_name}()", self.text, position)
+            return None
+
+
+def action_section_end(text: str):
+    """
+    End offset of a complete Action section in a partial response, or None while it may still grow.
+    A JSON list is complete at its closing bracket, plain calls once the line after them ends.
+    Used to dispatch actions while the rest of a streamed response is still being generated, so only an
+    `Action:` at the start of a line counts (a thought mentioning "action:" must not trigger it).
+    """
+    match = ACTION_LINE_PATTERN.search(text)
+    if not match:
+        return None
+    depth = 0
+    quote = None
+    escaped = False
+    seen_call = False
+    list_form = None
+    for index in range(match.end(), len(text)):
+        char = text[index]
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+            continue
+        if char in "'\"":
+            quote = char
+        elif char in "([":
+            if list_form is None:
+                list_form = char == "["
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+            if depth == 0:
+                if list_form:
+                    return index + 1
+                seen_call = True
+        elif char == "\n" and depth == 0 and seen_call:
+            return index
+    return None
+
+
+def parse_actions(response: str, strict=False, shortcuts=None):
+    return ActionParser(strict=strict, shortcuts=shortcuts).parse(response)
@@ -1,70 +1,302 @@
+import shlex
 import time
 import subprocess
-from utils import get_screen_x_coordinate, get_screen_y_coordinate, extract_action
+from adb_session import AdbShellSession, AdbSessionError, AdbSessionTimeout
+from settle import AdbFrameSource, wait_for_screen_settle
+from shortcuts import DEFAULT_SHORTCUTS, PACKAGE_PATTERN, ShortcutError
+from tracing import Tracer
+from utils import adb_command, get_screen_x_coordinate, get_screen_y_coordinate, extract_action
+
+# Keys of the 1000x1000 grid points of the action events with coordinates.
+ACTION_POINTS = {
+    "click": (("x", "y"),),
+    "double_click": (("x", "y"),),
+    "long_press": (("x", "y"),),
+    "scroll": (("start_x", "start_y"), ("end_x", "end_y")),
+}
+KEY_EVENTS = {"press_home": "KEYCODE_HOME", "press_back": "KEYCODE_BACK", "press_enter": "KEYCODE_ENTER"}
 
 class ActionSpace:
-    def __init__(self, adb_path="adb", image_width=1080, image_height=2400):
+    def __init__(
+        self,
+        adb_path="adb",
+        image_width=1080,
+        image_height=2400,
+        use_shell_session=True,
+        wait_for_settle=True,
+        settle_timeout=3.0,
+        settle_threshold=0.01,
+        settle_poll_interval=0.15,
+        frame_source=None,
+        crop_top=0.0,
+        crop_bottom=0.0,
+        tracer=None,
+        shortcuts=None,
+        shell_session=None,
+    ):
+        """
+        image_width/image_height: Size of the frames the model is shown, updated with set_display.
+        shell_session:            Object with run(command) -> (exit_code, output) and close() used instead
+                                  of an AdbShellSession, e.g. virtual_device.VirtualDevice.
+        """
         self.adb_path = adb_path
         self.image_width = image_width
         self.image_height = image_height
+        if shell_session is None and use_shell_session:
+            shell_session = AdbShellSession(adb_path=adb_path)
+        self.shell_session = shell_session
+        # display.DisplayInfo of the last frame passed to set_display.
+        self.display = None
+        self.wait_for_settle = wait_for_settle
+        self.settle_timeout = settle_timeout
+        self.settle_threshold = settle_threshold
+        self.settle_poll_interval = settle_poll_interval
+        self.frame_source = frame_source if frame_source is not None else AdbFrameSource(adb_path)
+        self.last_settle = None
+        # Fractions of the screen height cropped out of the frames sent to the model (see image_pipeline).
+        self.crop_top = crop_top
+        self.crop_bottom = crop_bottom
+        # Gestures are traced as "actuation" spans and waits as "settle" spans.
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.shortcuts = shortcuts if shortcuts is not None else DEFAULT_SHORTCUTS
+
+    def set_display(self, display):
+        """
+        Map later actions onto the geometry of `display` (see display.DisplayInfo), the one of the frame
+        the model was shown. Returns True when the frame size changed, e.g. after a rotation.
+        """
+        changed = (display.width, display.height) != (self.image_width, self.image_height)
+        self.image_width, self.image_height = display.width, display.height
+        self.display = display
+        return changed
+
+    def visible_area(self):
+        """
+        (top, height) in device pixels of the part of the screen the model sees.
+        """
+        top = round(self.image_height * self.crop_top)
+        return top, self.image_height - top - round(self.image_height * self.crop_bottom)
+
+    def screen_point(self, x, y):
+        """
+        Map a point on the model's 1000x1000 grid to device pixels, accounting for cropped bars.
+        """
+        top, visible_height = self.visible_area()
+        return get_screen_x_coordinate(x, self.image_width), top + get_screen_y_coordinate(y, visible_height)
+
+    def screen_points(self, points):
+        """
+        screen_point for an (N, 2) array of grid points at once, returns an (N, 2) int array.
+        Rounds half to even like round(), so both agree on every point.
+        """
+        import numpy as np
+        top, visible_height = self.visible_area()
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        mapped = np.rint(points * np.array([self.image_width, visible_height], dtype=np.float64) / 1000)
+        mapped[:, 1] += top
+        return mapped.astype(np.int64)
+
+    def grid_point(self, x, y):
+        """
+        Inverse of screen_point: device pixels to the model's 1000x1000 grid.
+        """
+        top, visible_height = self.visible_area()
+        return round(x * 1000 / self.image_width), round((y - top) * 1000 / visible_height)
+
+    def gesture_commands(self, actions):
+        """
+        Device shell commands of a batch of action events, with the points of all of them mapped in one
+        screen_points call. None for events that send nothing (wait, finished, call_user, shortcut).
+        """
+        keys = [ACTION_POINTS.get(action["type"], ()) for action in actions]
+        grid = [(action[x], action[y]) for action, points in zip(actions, keys) for x, y in points]
+        mapped = self.screen_points(grid).tolist() if grid else []
+        commands = []
+        for action, points in zip(actions, keys):
+            commands.append(self.__command__(action, mapped[:len(points)]))
+            mapped = mapped[len(points):]
+        return commands
+
+    def __command__(self, action, points):
+        kind = action["type"]
+        if kind == "click":
+            (x, y), = points
+            return f"input tap {x} {y}"
+        if kind == "double_click":
+            # One command line, so both taps land within the double tap timeout.
+            (x, y), = points
+            return f"input tap {x} {y}; input tap {x} {y}"
+        if kind == "long_press":
+            (x, y), = points
+            return f"input swipe {x} {y} {x} {y} 1000"
+        if kind == "scroll":
+            (x, y), (x1, y1) = points
+            return f"input swipe {x} {y} {x1} {y1} 500"
+        if kind == "type":
+            # `input text` reads spaces as %s; the quoting keeps quotes, newlines and ; in the text literal.
+            return f"input text {shlex.quote(action['content'].replace(' ', '%s'))}"
+        if kind in KEY_EVENTS:
+            return f"input keyevent {KEY_EVENTS[kind]}"
+        if kind == "launch_app":
+            if not PACKAGE_PATTERN.match(action["content"]):
+                raise ShortcutError(f"Invalid package name {action['content']!r}")
+            return f"monkey -p {action['content']} -c android.intent.category.LAUNCHER 1"
+        return None
+
+    def snap_to_elements(self, actions, hierarchy, max_distance=48):
+        """
+        Move the points of click, long_press and double_click events onto the clickable element of the
+        UI hierarchy (see ui_hierarchy.UiHierarchy) they aim at, when they land next to it.
+        """
+        snapped = []
+        for action in actions:
+            if action["type"] in ("click", "long_press", "double_click"):
+                x, y = self.screen_point(action["x"], action["y"])
+                element = hierarchy.snap(x, y, max_distance)
+                if element is not None and not element.contains(x, y):
+                    grid_x, grid_y = self.grid_point(*element.center)
+                    print(f"Snapped {action['type']} ({action['x']},{action['y']}) to {element.resource_id or element.text or element.class_name} ({grid_x},{grid_y})")
+                    action = {**action, "x": grid_x, "y": grid_y}
+            snapped.append(action)
+        return snapped
+
+    def wait_until_settled(self, timeout=None):
+        """
+        Wait until the screen stops changing. Falls back to a fixed sleep when settle detection is disabled.
+        Returns the number of seconds waited.
+        """
+        timeout = self.settle_timeout if timeout is None else timeout
+        if not self.wait_for_settle:
+            with self.tracer.span("settle", fixed=True):
+                time.sleep(timeout)
+            return timeout
+        with self.tracer.span("settle"):
+            self.last_settle = wait_for_screen_settle(
+                self.frame_source,
+                threshold=self.settle_threshold,
+                timeout=timeout,
+                poll_interval=self.settle_poll_interval,
+            )
+        status = "settled" if self.last_settle.settled else "not settled (timeout)"
+        print(f"Screen {status} after {self.last_settle.waited:.2f}s, {self.last_settle.frames} frames.")
+        return self.last_settle.waited
+
+    def run_shell(self, command):
+        """
+        Run a device shell command, over the persistent adb shell session when enabled.
+        Returns its exit code, None when it timed out: it may still run on the device, so it is not sent again.
+        """
+        if self.shell_session is not None:
+            try:
+                return self.shell_session.run(command)[0]
+            except AdbSessionTimeout as e:
+                print("adb shell command timed out, not retrying it: ", e)
+                return None
+            except AdbSessionError as e:
+                print("adb shell session unavailable, falling back to a single command: ", e)
+        # One argument, so the device shell parses the command as the session would.
+        result = subprocess.run(adb_command(self.adb_path, "shell", command), capture_output=True, text=True)
+        return result.returncode
+
+    def close(self):
+        if self.shell_session is not None:
+            self.shell_session.close()
     
+    def __send__(self, action):
+        self.run_shell(self.gesture_commands([action])[0])
+
     def click(self, x, y):
-        x_screen = get_screen_x_coordinate(x, self.image_width)
-        y_screen = get_screen_y_coordinate(y, self.image_height)
-        command = self.adb_path + f" shell input tap {x_screen} {y_screen}"
-        subprocess.run(command, capture_output=True, text=True, shell=True)
+        self.__send__({"type": "click", "x": x, "y": y})
 
     def type(self, text):
-        command = self.adb_path + f" shell input text \"{text}\""
-        subprocess.run(command, capture_output=True, text=True, shell=True)
+        self.__send__({"type": "type", "content": text})
 
     def press_home(self):
-        command = self.adb_path + " shell input keyevent KEYCODE_HOME"
-        subprocess.run(command, capture_output=True, text=True, shell=True)
+        self.__send__({"type": "press_home"})
     
     def scroll(self, x, y, x1, y1):
-        x_screen = get_screen_x_coordinate(x, self.image_width)
-        y_screen = get_screen_y_coordinate(y, self.image_height)
-        x1_screen = get_screen_x_coordinate(x1, self.image_width)
-        y1_screen = get_screen_y_coordinate(y1, self.image_height)
-        command = self.adb_path + f" shell input swipe {x_screen} {y_screen} {x1_screen} {y1_screen} 500"
-        subprocess.run(command, capture_output=True, text=True, shell=True)
+        self.__send__({"type": "scroll", "start_x": x, "start_y": y, "end_x": x1, "end_y": y1})
 
     def press_back(self):
-        command = self.adb_path + " shell input keyevent KEYCODE_BACK"
-        subprocess.run(command, capture_output=True, text=True, shell=True)
+        self.__send__({"type": "press_back"})
+
+    def press_enter(self):
+        self.__send__({"type": "press_enter"})
+
+    def launch_app(self, package):
+        self.__send__({"type": "launch_app", "content": package})
 
     def long_press(self, x, y):
-        x_screen = get_screen_x_coordinate(x, self.image_width)
-        y_screen = get_screen_y_coordinate(y, self.image_height)
-        command = self.adb_path + f" shell input swipe {x_screen} {y_screen} {x_screen} {y_screen} 1000"
-        subprocess.run(command, capture_output=True, text=True, shell=True)
+        self.__send__({"type": "long_press", "x": x, "y": y})
     
-    def map_generate_action_to_event(self, action):
+    def map_generate_action_to_event(self, action, command=None):
+        """
+        Perform one action event and wait for the screen to settle. `command` is the event's shell
+        command when it was already computed for a batch (see gesture_commands).
+        """
         print("Performing Action: ", action)
-        if action["type"] == "click":
-            self.click(action["x"], action["y"])
-        elif action["type"] == "type":
-            self.type(action["content"])
-        elif action["type"] == "press_home":
-            self.press_home()
-        elif action["type"] == "scroll":
-            self.scroll(action["start_x"], action["start_y"], action["end_x"], action["end_y"])
-        elif action["type"] == "press_back":
-            self.press_back()
-        elif action["type"] == "long_press":
-            self.long_press(action["x"], action["y"])
-        elif action["type"] == "wait":
+        if action["type"] == "wait":
             print("Waiting...")
         elif action["type"] == "finished":
             print("Task Finished.")
+            return 0
         elif action["type"] == "call_user":
             print("User intervention needed.")
-        elif action["type"] == "double_click":
-            self.click(action["x"], action["y"])
-            time.sleep(1)
-            self.click(action["x"], action["y"])
-        time.sleep(3)
+            return 0
+        command = command if command is not None else self.gesture_commands([action])[0]
+        if command is not None:
+            with self.tracer.span("actuation", action=action["type"]):
+                self.run_shell(command)
+        return self.wait_until_settled()
+
+    def run_shortcut(self, action):
+        """
+        Run a shortcut event as its atomic actions, see shortcuts.py.
+        Returns False when the shortcut is unknown, its arguments are invalid or its precondition check fails.
+        """
+        try:
+            shortcut, args = self.shortcuts.resolve(action)
+            if shortcut.check is not None and not shortcut.check(self, args):
+                print(f"Precondition of {shortcut.name} not met: {shortcut.precondition}")
+                return False
+            events = shortcut.expand(args)
+            print(f"Running shortcut {shortcut.name}: {len(events)} actions.")
+            for event in events:
+                self.map_generate_action_to_event(event)
+        except ShortcutError as e:
+            print(f"Shortcut {action['name']} failed: ", e)
+            return False
+        return True
+
+    def execute_actions(self, actions, verify=None):
+        """
+        Execute a batch of actions in order.
+        `verify(action, next_action)` is called between steps; returning False stops the batch so the
+        model can look at the screen again. Returns (number of executed actions, finished).
+        """
+        executed = 0
+        commands = self.gesture_commands(actions)
+        for index, action in enumerate(actions):
+            if action["type"] == "finished":
+                return executed, True
+            if action["type"] == "shortcut":
+                if not self.run_shortcut(action):
+                    print(f"Stopping batch at shortcut {action['name']}.")
+                    break
+            else:
+                self.map_generate_action_to_event(action, commands[index])
+            executed += 1
+            next_action = actions[index + 1] if index + 1 < len(actions) else None
+            if next_action is not None and verify is not None and not verify(action, next_action):
+                print(f"Verification failed after {action['type']}, {len(actions) - executed} actions skipped.")
+                break
+        return executed, False
+
+    def screen_settled(self, action=None, next_action=None):
+        """
+        verify callback for execute_actions: continue the batch only if the last action's screen settled.
+        """
+        return self.last_settle is None or self.last_settle.settled
 
 if __name__ == "__main__":
     actionOperator = ActionSpace()
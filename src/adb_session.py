@@ -0,0 +1,125 @@
+import itertools
+import queue
+import shlex
+import subprocess
+import threading
+import uuid
+from utils import adb_command
+
+
+def split_commands(command):
+    """
+    Words of the simple commands of a device shell command line, split on `;` outside of quotes.
+    """
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=";")
+    lexer.whitespace_split = True
+    commands = [[]]
+    for token in lexer:
+        if set(token) == {";"}:
+            commands.append([])
+        else:
+            commands[-1].append(token)
+    return [words for words in commands if words]
+
+
+class AdbSessionError(Exception):
+    pass
+
+
+class AdbSessionTimeout(AdbSessionError):
+    pass
+
+
+class AdbShellSession:
+    """
+    Long lived `adb shell` process that runs commands over stdin.
+    Every command is followed by an `echo <marker> $?` so completion and exit code can be read back
+    without spawning a new adb client per command. The session is restarted if the process dies.
+    """
+
+    def __init__(self, adb_path="adb", timeout=10, max_reconnect=2):
+        self.adb_path = adb_path
+        self.timeout = timeout
+        self.max_reconnect = max_reconnect
+        self.process = None
+        self.lines = None
+        self.marker = f"__ADB_DONE_{uuid.uuid4().hex}__"
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            adb_command(self.adb_path, "shell"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+        self.lines = queue.Queue()
+        threading.Thread(target=self.__read_output__, args=(self.process, self.lines), daemon=True).start()
+
+    def __read_output__(self, process, lines):
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+
+    def __execute__(self, command):
+        if not self.is_alive():
+            self.start()
+        command_id = f"{self.marker}{next(self.counter)}"
+        self.process.stdin.write(f"{command}; echo {command_id} $?\n")
+        self.process.stdin.flush()
+        output = []
+        while True:
+            try:
+                line = self.lines.get(timeout=self.timeout)
+            except queue.Empty:
+                raise AdbSessionTimeout(f"Timed out waiting for: {command}")
+            if line is None:
+                raise AdbSessionError("adb shell session closed.")
+            if line.split(" ")[0] == command_id:
+                return int(line.split()[-1]), "".join(output)
+            output.append(line)
+
+    def run(self, command):
+        """
+        Run a device shell command and return (exit_code, output).
+        """
+        with self.lock:
+            attempt = 0
+            while True:
+                try:
+                    return self.__execute__(command)
+                except AdbSessionTimeout:
+                    # The command may still run on the device, so it is not replayed.
+                    self.close()
+                    raise
+                except (AdbSessionError, OSError, ValueError) as e:
+                    self.close()
+                    attempt += 1
+                    if attempt > self.max_reconnect:
+                        raise AdbSessionError(f"adb shell session failed: {e}")
+                    print(f"adb shell session lost ({e}), reconnecting...")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
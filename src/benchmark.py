@@ -0,0 +1,1129 @@
+"""
+Benchmarks that run without a device or a model endpoint.
+Example: `python src/benchmark.py screenshot --iterations 5`
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from PIL import Image, ImageChops
+from actions import ActionSpace
+from action_parser import ActionParser, parse_actions
+from change_detection import ChangeDetector
+from constants import MANAGER_PROMPT_TEMPLATE, TARS_SYSTEM_PROMPT
+from daemon import submit
+from display import DisplayTracker
+from episode import Episode
+from episode_log import EpisodeLog
+from evaluate import EvalConfig, evaluate, print_report
+from gateway import InferenceGateway
+from image_pipeline import ImageEncodeConfig, preprocess_screenshot
+from history import ConversationHistory
+from inference_client import InferenceClient, RetryPolicy
+from main import run_task_async
+from parser_corpus import action_templates, fuzz, parser_corpus, property_violations
+from prompt import PLAN_DESCRIPTION, SUBGOAL_DESCRIPTION, estimate_tokens
+from response_cache import perceptual_hash, hamming_distance, latest_screenshot
+from shortcuts import DEFAULT_SHORTCUTS
+from stub_server import StubServer
+from tars import AsyncTARS
+from tracing import Tracer
+from trajectory_cache import TrajectoryStore
+from ui_hierarchy import UiHierarchy, dump_ui_hierarchy
+from virtual_device import VirtualDevice
+from settle import ReplayFrameSource, AdbFrameSource, wait_for_screen_settle
+from utils import get_screenshot, capture_screenshot, encode_screenshot, get_image_url
+
+FAKE_ADB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_adb.py")
+
+
+def fake_adb_path():
+    return f"{sys.executable} {FAKE_ADB_SCRIPT}"
+
+
+def make_frame(path, width=1080, height=2400):
+    """
+    Write a noisy PNG frame so that encode sizes are closer to a real screen than a flat color.
+    """
+    noise = Image.effect_noise((width, height), 40).convert("RGB")
+    noise.save(path, "PNG")
+    return path
+
+
+def setup_fake_device(workdir, width=1080, height=2400):
+    os.environ["FAKE_ADB_FRAME"] = make_frame(os.path.join(workdir, "frame.png"), width, height)
+    os.environ["FAKE_ADB_ROOT"] = os.path.join(workdir, "device")
+    os.makedirs(os.environ["FAKE_ADB_ROOT"], exist_ok=True)
+
+
+def timeit(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    print(f"{name:<28} mean={statistics.mean(timings)*1000:9.1f}ms  min={min(timings)*1000:9.1f}ms  max={max(timings)*1000:9.1f}ms  n={len(timings)}")
+
+
+def check(ok, message):
+    """
+    Fail the run with a non-zero exit status when a correctness check of a benchmark does not hold.
+    """
+    if not ok:
+        print(f"CHECK FAILED: {message}")
+        sys.exit(1)
+
+
+def bench_screenshot(args):
+    adb_path = fake_adb_path()
+    with tempfile.TemporaryDirectory() as workdir:
+        setup_fake_device(workdir, args.width, args.height)
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        os.makedirs("screenshot", exist_ok=True)
+        try:
+            def file_based():
+                get_screenshot(adb_path, save_path="./screenshot/screenshot.jpg")
+                get_image_url("./screenshot/screenshot.jpg")
+
+            def in_memory():
+                image = capture_screenshot(adb_path)
+                get_image_url(encode_screenshot(image))
+
+            report("file based (get_screenshot)", timeit(file_based, args.iterations))
+            report("in memory (exec-out)", timeit(in_memory, args.iterations))
+        finally:
+            os.chdir(cwd)
+
+
+def bench_actions(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        setup_fake_device(workdir, 64, 64)
+        os.environ["FAKE_ADB_LOG"] = os.path.join(workdir, "adb.log")
+        per_command = ActionSpace(adb_path=fake_adb_path(), use_shell_session=False)
+        session = ActionSpace(adb_path=fake_adb_path(), use_shell_session=True)
+        try:
+            report("subprocess per gesture", timeit(lambda: per_command.click(500, 500), args.iterations))
+            session.click(500, 500)  # Open the session outside the measurement.
+            report("persistent shell session", timeit(lambda: session.click(500, 500), args.iterations))
+        finally:
+            session.close()
+        with open(os.environ["FAKE_ADB_LOG"]) as f:
+            taps = sum(1 for line in f if line.startswith("shell input tap"))
+        print(f"gestures received by fake adb: {taps}")
+    check(taps == 2 * args.iterations + 1, f"{2 * args.iterations + 1} taps sent, {taps} received")
+
+
+def transition_frames(animated=8, stable=10, width=270, height=600):
+    """
+    Synthetic recording of a screen transition: a bar sliding down for `animated` frames, then a still screen.
+    """
+    frames = []
+    for i in range(animated + stable):
+        frame = Image.new("RGB", (width, height), "white")
+        offset = min(i, animated) * height // (animated + 1)
+        frame.paste((30, 30, 200), (0, offset, width, offset + height // 8))
+        frames.append(frame)
+    return frames
+
+
+def bench_settle(args):
+    def source():
+        if args.frames:
+            return ReplayFrameSource.from_directory(args.frames)
+        return ReplayFrameSource(transition_frames(args.animated))
+
+    result = wait_for_screen_settle(source(), timeout=args.timeout, poll_interval=args.poll_interval)
+    print(f"settled={result.settled} waited={result.waited:.2f}s frames={result.frames} (fixed sleep: {args.timeout:.2f}s)")
+    report("settle wait (replay)", timeit(lambda: wait_for_screen_settle(source(), timeout=args.timeout, poll_interval=args.poll_interval), args.iterations))
+    with tempfile.TemporaryDirectory() as workdir:
+        setup_fake_device(workdir)
+        adb_source = AdbFrameSource(fake_adb_path())
+        report("settle wait (fake adb)", timeit(lambda: wait_for_screen_settle(adb_source, timeout=args.timeout, poll_interval=args.poll_interval), args.iterations))
+
+
+def bench_parser(args):
+    rng = random.Random(args.seed)
+    corpus = parser_corpus(args.corpus_size, rng)
+    violations = property_violations(corpus)
+    for response in violations:
+        print("Property violated for: ", response)
+    print(f"corpus: {len(corpus)} responses from {len(action_templates())} prompt templates, {len(violations)} property violations")
+
+    rejected, crashes = fuzz(corpus, args.fuzz, rng)
+    for response, e in crashes:
+        print(f"Crash ({e!r}) on: {response!r}")
+    print(f"fuzz: {args.fuzz} mutated responses, {rejected} rejected with ActionParseError, {len(crashes)} crashes")
+    check(not violations and not crashes, f"{len(violations)} property violations, {len(crashes)} crashes")
+
+    responses = [response for response, _ in corpus]
+    for strict in (False, True):
+        parser = ActionParser(strict=strict)
+        timings = timeit(lambda: [parser.parse(response) for response in responses], args.iterations)
+        per_response = [timing / len(responses) for timing in timings]
+        print(f"parse strict={strict!s:<5} mean={statistics.mean(per_response)*1e6:7.1f}us per response")
+
+
+ENCODE_SETTINGS = {
+    "full resolution (legacy)": ImageEncodeConfig(max_side=None, quality=75),
+    "1280 jpeg q75": ImageEncodeConfig(max_side=1280, quality=75),
+    "1024 jpeg q60": ImageEncodeConfig(max_side=1024, quality=60),
+    "1024 webp q60": ImageEncodeConfig(max_side=1024, format="WEBP", quality=60),
+    "1024 jpeg q60 gray": ImageEncodeConfig(max_side=1024, quality=60, grayscale=True),
+    "1024 jpeg q60 cropped bars": ImageEncodeConfig(max_side=1024, quality=60, crop_top=0.03, crop_bottom=0.05),
+}
+
+
+def load_screenshots(directory):
+    if directory:
+        names = sorted(name for name in os.listdir(directory) if name.lower().endswith((".png", ".jpg", ".jpeg", ".webp")))
+        return [Image.open(os.path.join(directory, name)).convert("RGB") for name in names]
+    return [frame.resize((1080, 2400)) for frame in transition_frames(animated=4, stable=0)]
+
+
+def bench_encode(args):
+    screenshots = load_screenshots(args.dir)
+    print(f"{len(screenshots)} screenshots")
+    for name, config in ENCODE_SETTINGS.items():
+        frames = [preprocess_screenshot(screenshot, config, log=False) for screenshot in screenshots]
+        size = statistics.mean(len(frame.data) for frame in frames)
+        encode_time = statistics.mean(frame.encode_time for frame in frames)
+        print(f"{name:<28} payload={size/1024:8.1f}KiB  base64={size*4/3/1024:8.1f}KiB  encode={encode_time*1000:7.1f}ms  size={frames[0].size[0]}x{frames[0].size[1]}")
+
+
+def bench_history(args):
+    frame = preprocess_screenshot(transition_frames(animated=1, stable=0)[0].resize((1080, 2400)), log=False)
+    url = get_image_url(frame.data, frame.mime_type)
+
+    def step_messages(step):
+        user = {"role": "user", "content": [{"type": "text", "text": "Here is the screen"}, {"type": "image_url", "image_url": {"url": url + str(step)}}]}
+        assistant = {"role": "assistant", "content": [{"type": "text", "text": f"Thought: step {step}\nAction: click(start_box='(500,{step % 1000})')"}]}
+        return user, assistant
+
+    for name, make in (("unbounded list", list), ("ConversationHistory", ConversationHistory)):
+        tracemalloc.start()
+        store = make()
+        start = time.perf_counter()
+        for step in range(args.steps):
+            for message in step_messages(step):
+                store.append(message)
+        elapsed = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<22} steps={args.steps} retained={current/1024/1024:7.2f}MiB append={elapsed/args.steps*1e6:6.1f}us per step")
+    roles = [message["role"] for message in store.messages()]
+    check(store.image_count() <= store.max_images, f"{store.image_count()} screenshots kept, at most {store.max_images} expected")
+    check(len(store) <= 2 * store.max_turns + 1, f"{len(store)} messages kept, at most {2 * store.max_turns + 1} expected")
+    check(roles[0] == "user" and all(a != b for a, b in zip(roles, roles[1:])), f"roles do not alternate: {roles}")
+
+
+def bench_inference(args):
+    messages = [{"role": "user", "content": "Open Youtube"}]
+    policy = RetryPolicy(base_delay=args.base_delay, max_delay=5, deadline=30, request_timeout=5)
+    with StubServer(fail_first=args.transient_failures) as server:
+        client = InferenceClient([("primary", server.url)], api_key="stub", retry_policy=policy)
+        start = time.perf_counter()
+        client.create(model="tgi", messages=messages)
+        check(server.requests == args.transient_failures + 1, f"{server.requests} requests for {args.transient_failures} transient failures")
+        print(f"{args.transient_failures} transient 503s: recovered in {time.perf_counter() - start:.2f}s (flat 20s sleeps: {20 * args.transient_failures}s)")
+
+    with StubServer(fail_rate=1.0) as primary, StubServer() as fallback:
+        client = InferenceClient([("dpo", primary.url), ("sft", fallback.url)], api_key="stub", retry_policy=policy, failure_threshold=3)
+        timings = timeit(lambda: client.create(model="tgi", messages=messages), args.iterations)
+        report("failover, primary down", timings)
+        for name, metrics in client.metrics().items():
+            print(f"{name}: breaker={metrics['breaker']} errors={metrics['errors']} requests={metrics['latency']['count']} p50<={metrics['latency']['p50']}s")
+        metrics = client.metrics()
+        check(metrics["dpo"]["breaker"] == "open", f"breaker of the failing endpoint is {metrics['dpo']['breaker']}")
+        check(metrics["sft"]["latency"]["count"] == args.iterations, f"{metrics['sft']['latency']['count']}/{args.iterations} requests failed over")
+        check(primary.requests <= 3 + args.iterations, f"{primary.requests} requests sent to the failing endpoint past its open breaker")
+
+
+STREAM_RESPONSE = (
+    "Thought: The home screen is open and the YouTube icon is in the second row. Tapping it opens the app, "
+    "after that the search bar at the top can be used to look for the video.\n"
+    "Action: click(start_box='(235,512)')\n"
+    "Reflection: The click should open YouTube, the next step is to tap the search icon in the top bar "
+    "and type the query, then pick the first result from the list."
+)
+
+
+def bench_stream(args):
+    messages = [{"role": "user", "content": "Open Youtube"}]
+
+    async def run(server, stream):
+        client = InferenceClient([("stub", server.url)], api_key="stub", retry_policy=RetryPolicy(request_timeout=30))
+        agent = AsyncTARS("Open Youtube", "default", inference_client=client)
+        first_tokens, dispatches = [], []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            if stream:
+                dispatched = []
+                result = await agent.stream_inference([dict(message) for message in messages], on_action=lambda actions: dispatched.append(time.perf_counter() - start), cancel_after_action=args.cancel)
+                first_tokens.append(result.time_to_first_token)
+                dispatches.append(dispatched[0])
+            else:
+                await agent.inference([dict(message) for message in messages])
+                dispatches.append(time.perf_counter() - start)
+        await client.aclose()
+        return first_tokens, dispatches
+
+    with StubServer([STREAM_RESPONSE], latency=args.prefill, token_latency=args.token_latency) as server:
+        _, dispatches = asyncio.run(run(server, stream=False))
+        report("complete response", dispatches)
+        first_tokens, dispatches = asyncio.run(run(server, stream=True))
+        report("streamed, first token", first_tokens)
+        report("streamed, actions", dispatches)
+        print(f"cancelled streams: {server.cancelled_streams}/{args.iterations}")
+
+
+def synthetic_episode(path, steps, width=1080, height=2400, seed=0):
+    """
+    Episode of `steps` random clicks on distinct noisy screens, then finished.
+    """
+    rng = random.Random(seed)
+    episode = Episode(path, task="Open Youtube")
+    for index in range(steps):
+        if index == steps - 1:
+            response = "Thought: The task is done.\nAction: finished(content='')"
+        else:
+            response = f"Thought: Step {index + 1}, tapping the next button.\nAction: click(start_box='({rng.randint(50, 950)},{rng.randint(50, 950)})')"
+        actions = [action.to_event() for action in parse_actions(response)]
+        episode.add_step(Image.effect_noise((width, height), 40).convert("RGB"), response, actions)
+    return episode
+
+
+def bench_replay(args):
+    workdir = tempfile.mkdtemp()
+    if args.episode:
+        episode = Episode.load(args.episode)
+    else:
+        episode = synthetic_episode(os.path.join(workdir, "episode"), args.steps, args.width, args.height)
+    os.environ["FAKE_ADB_EPISODE"] = episode.path
+    os.environ["FAKE_ADB_ROOT"] = os.path.join(workdir, "device")
+    os.environ["FAKE_ADB_LOG"] = os.path.join(workdir, "adb.log")
+    os.makedirs(os.environ["FAKE_ADB_ROOT"], exist_ok=True)
+    tracer = Tracer()
+
+    async def replay(server):
+        client = InferenceClient([("stub", server.url)], api_key="stub")
+        try:
+            return await run_task_async(episode.task, max_itr=len(episode.steps) + 1, adb_path=fake_adb_path(), inference_client=client, tracer=tracer)
+        finally:
+            await client.aclose()
+
+    with StubServer(episode.responses(), latency=args.latency) as server:
+        tracemalloc.start()
+        start = time.perf_counter()
+        outcome = asyncio.run(replay(server))
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    with open(os.environ["FAKE_ADB_LOG"]) as f:
+        gestures = sum(" input " in line or " monkey " in line for line in f)
+    expected = sum(step.gestures for step in episode.steps)
+    print()
+    tracer.print_summary()
+    print(f"status={outcome['status']} steps={outcome['steps']} in {elapsed:.2f}s: {outcome['steps'] / elapsed:.2f} steps/s")
+    print(f"python memory: retained={current/1024/1024:.2f}MiB peak={peak/1024/1024:.2f}MiB")
+    print(f"gestures: {gestures}/{expected}")
+    check(outcome["status"] == "finished" and gestures == expected, "replay diverged from the recording")
+
+
+def synthetic_hierarchy(rows, columns=4, width=1080, row_height=160):
+    """
+    uiautomator dump of a scrolling grid: clickable cells holding an icon and a text label.
+    """
+    cell_width = width // columns
+    nodes = []
+    for row in range(rows):
+        for column in range(columns):
+            x1, y1 = column * cell_width, row * row_height
+            index = row * columns + column
+            nodes.append(
+                f'<node index="{index}" text="" resource-id="com.example:id/cell" class="android.widget.LinearLayout" content-desc="" '
+                f'clickable="true" enabled="true" bounds="[{x1},{y1}][{x1 + cell_width},{y1 + row_height}]">'
+                f'<node index="0" text="" resource-id="com.example:id/icon" class="android.widget.ImageView" content-desc="Icon {index}" '
+                f'clickable="false" enabled="true" bounds="[{x1 + 20},{y1 + 10}][{x1 + cell_width - 20},{y1 + 100}]" />'
+                f'<node index="1" text="Item {index}" resource-id="com.example:id/label" class="android.widget.TextView" content-desc="" '
+                f'clickable="false" enabled="true" bounds="[{x1 + 10},{y1 + 110}][{x1 + cell_width - 10},{y1 + 150}]" />'
+                "</node>"
+            )
+    return (
+        "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?><hierarchy rotation=\"0\">"
+        f'<node index="0" text="" resource-id="" class="android.widget.FrameLayout" clickable="false" enabled="true" bounds="[0,0][{width},{rows * row_height}]">'
+        + "".join(nodes)
+        + "</node></hierarchy>"
+    )
+
+
+def bench_hierarchy(args):
+    rng = random.Random(args.seed)
+    xml = synthetic_hierarchy(args.rows)
+    hierarchy = UiHierarchy.from_xml(xml)
+    print(f"{len(hierarchy)} elements, {len(xml) / 1024:.0f}KiB of XML")
+    report("parse + index", timeit(lambda: UiHierarchy.from_xml(xml), args.iterations))
+    cells = len(hierarchy) // 3
+    labels = [f"Item {rng.randrange(cells)}" for _ in range(args.queries)]
+    points = [(rng.randrange(1080), rng.randrange(args.rows * 160)) for _ in range(args.queries)]
+    clickable = [element for element in hierarchy.elements if element.clickable]
+
+    def linear_snap(x, y, max_distance=48):
+        hits = [(element.distance(x, y), element.area, element.index) for element in clickable if element.distance(x, y) <= max_distance]
+        return hierarchy.elements[min(hits)[2]] if hits else None
+
+    errors = 0
+    for label in labels:
+        element = hierarchy.find(label)
+        errors += element is None or element.resource_id != "com.example:id/cell"
+    for x, y in points:
+        errors += hierarchy.snap(x, y) != linear_snap(x, y)
+    report(f"find x{args.queries}", timeit(lambda: [hierarchy.find(label) for label in labels], args.iterations))
+    report(f"snap x{args.queries}, grid", timeit(lambda: [hierarchy.snap(x, y) for x, y in points], args.iterations))
+    report(f"snap x{args.queries}, linear scan", timeit(lambda: [linear_snap(x, y) for x, y in points], args.iterations))
+    print(f"lookup errors: {errors}")
+    check(not errors, f"{errors} lookups differ from a linear scan")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        setup_fake_device(workdir, 270, 600)
+        os.environ["FAKE_ADB_HIERARCHY"] = os.path.join(workdir, "window_dump.xml")
+        with open(os.environ["FAKE_ADB_HIERARCHY"], "w") as f:
+            f.write(xml)
+        report("dump over fake adb", timeit(lambda: dump_ui_hierarchy(fake_adb_path()), args.iterations))
+
+
+def bench_trajectory(args):
+    workdir = tempfile.mkdtemp()
+    episode = synthetic_episode(os.path.join(workdir, "episode"), args.steps, 540, 1200)
+    diverged = os.path.join(workdir, "diverged")
+    shutil.copytree(episode.path, diverged)
+    diverge_at = args.steps // 2
+    for step in episode.steps[diverge_at:]:
+        Image.effect_noise((540, 1200), 40).convert("RGB").save(os.path.join(diverged, step.frame), "PNG")
+    os.environ["FAKE_ADB_ROOT"] = os.path.join(workdir, "device")
+    os.makedirs(os.environ["FAKE_ADB_ROOT"], exist_ok=True)
+    store = TrajectoryStore(path=os.path.join(workdir, "trajectories.db"))
+
+    async def run(server):
+        client = InferenceClient([("stub", server.url)], api_key="stub")
+        try:
+            return await run_task_async(episode.task, max_itr=args.steps + 1, adb_path=fake_adb_path(), inference_client=client, tracer=Tracer(), trajectory_store=store)
+        finally:
+            await client.aclose()
+
+    runs = [("cold", episode.path, 0), ("replay", episode.path, 0), (f"diverge at step {diverge_at + 1}", diverged, diverge_at)]
+    results = []
+    for name, path, first_response in runs:
+        os.environ["FAKE_ADB_EPISODE"] = path
+        gestures = os.path.join(os.environ["FAKE_ADB_ROOT"], "gestures")
+        if os.path.exists(gestures):
+            os.remove(gestures)
+        with StubServer(episode.responses()[first_response:], latency=args.latency) as server:
+            start = time.perf_counter()
+            outcome = asyncio.run(run(server))
+            results.append((name, outcome["status"], server.requests, time.perf_counter() - start))
+    print()
+    for name, status, calls, elapsed in results:
+        print(f"{name:<20} status={status} model calls={calls} time={elapsed:.2f}s")
+    stats = store.stats()
+    print("store: ", stats)
+    store.close()
+    check(all(status == "finished" for _, status, _, _ in results), "a run did not finish")
+    check(results[1][2] == 0, f"replay of the recorded trajectory made {results[1][2]} model calls")
+    check(0 < results[2][2] < results[0][2], f"diverged run made {results[2][2]} model calls, the cold run {results[0][2]}")
+    # The diverged run finished on a new path, recorded in place of the replayed one with fresh replay counts.
+    check(stats["trajectories"] == 1 and stats["hits"] == 2 and stats["replays"] == 0, f"store holds {stats['trajectories']} trajectories after {stats['hits']} hits and {stats['replays']} replays")
+
+
+SHORTCUT_SCENARIOS = {
+    "atomic": [
+        "Thought: Tap the search box.\nAction: click(start_box='(500,80)')",
+        "Thought: Type the query.\nAction: type(content='lofi beats')",
+        "Thought: Open the first suggestion to search.\nAction: click(start_box='(500,160)')",
+        "Thought: Swipe to the next results.\nAction: scroll(start_box='(500,750)', end_box='(500,250)')",
+        "Thought: The task is done.\nAction: finished(content='')",
+    ],
+    "shortcuts": [
+        "Thought: Search for the query.\nAction: [\"Tap_Type_and_Enter(start_box='(500,80)', text='lofi beats')\", \"Swipe_Page(direction='down')\"]",
+        "Thought: The task is done.\nAction: finished(content='')",
+    ],
+}
+
+
+def bench_shortcuts(args):
+    async def run(server):
+        client = InferenceClient([("stub", server.url)], api_key="stub")
+        try:
+            return await run_task_async("Search YouTube for lofi beats", max_itr=10, adb_path=fake_adb_path(), inference_client=client, tracer=Tracer())
+        finally:
+            await client.aclose()
+
+    for name, responses in SHORTCUT_SCENARIOS.items():
+        with tempfile.TemporaryDirectory() as workdir:
+            setup_fake_device(workdir, 270, 600)
+            os.environ["FAKE_ADB_LOG"] = os.path.join(workdir, "adb.log")
+            with StubServer(responses, latency=args.latency) as server:
+                start = time.perf_counter()
+                outcome = asyncio.run(run(server))
+                elapsed = time.perf_counter() - start
+                calls = server.requests
+            with open(os.environ["FAKE_ADB_LOG"]) as f:
+                gestures = sum(" input " in line for line in f)
+        print(f"{name:<10} status={outcome['status']} model calls={calls} gestures={gestures} time={elapsed:.2f}s")
+        check(outcome["status"] == "finished", f"{name} scenario did not finish")
+
+
+class LoadingScreenStub(StubServer):
+    """
+    Model that opens a screen which takes `load_time` seconds to load, waits while it loads and finishes
+    once it is shown a screenshot of the loaded screen. Counts the uploaded screenshots and their size.
+    """
+
+    def __init__(self, frame, loaded_frame, load_time, **kwargs):
+        super().__init__(**kwargs)
+        self.frame = frame
+        self.loaded_frame = loaded_frame
+        self.load_time = load_time
+        self.loading = None
+        self.loaded_detector = ChangeDetector()
+        self.loaded_detector.commit(Image.open(loaded_frame))
+        self.saw_loaded = False
+        self.images = 0
+        self.image_bytes = 0
+
+    def next_response(self, request):
+        for content in request["messages"][-1]["content"]:
+            if content["type"] == "image_url":
+                url = content["image_url"]["url"]
+                self.images += 1
+                self.image_bytes += len(url)
+                image = Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1])))
+                self.saw_loaded = not self.loaded_detector.compare(image).changed
+        if self.loading is None:
+            self.loading = threading.Timer(self.load_time, shutil.copyfile, (self.loaded_frame, self.frame))
+            self.loading.start()
+            return "Thought: Open the results.\nAction: click(start_box='(500,500)')"
+        if not self.saw_loaded:
+            return "Thought: The results are still loading.\nAction: wait()"
+        return "Thought: The results are shown, the task is done.\nAction: finished(content='')"
+
+
+def bench_change(args):
+    frame = Image.effect_noise((1080, 2400), 40).convert("RGB")
+    edited = frame.copy()
+    edited.paste((30, 30, 200), (100, 1200, 400, 1300))
+    detector = ChangeDetector()
+    detector.commit(frame)
+    print(f"unchanged: {detector.compare(frame)}")
+    print(f"edited:    {detector.compare(edited)}")
+    report("diff (numpy, downsampled)", timeit(lambda: detector.compare(edited), args.iterations))
+    report("diff (PIL, full frame)", timeit(lambda: ImageChops.difference(frame.convert("L"), edited.convert("L")).point(lambda v: 255 if v > 24 else 0).getbbox(), args.iterations))
+
+    async def run(server, detector):
+        client = InferenceClient([("stub", server.url)], api_key="stub")
+        tracer = Tracer()
+        try:
+            outcome = await run_task_async("Open the results", max_itr=20, adb_path=fake_adb_path(), inference_client=client, tracer=tracer, change_detector=detector)
+        finally:
+            await client.aclose()
+        return outcome, tracer.summary().get("encode", {}).get("count", 0)
+
+    print()
+    for name, detector in (("without detection", None), ("with detection", ChangeDetector())):
+        with tempfile.TemporaryDirectory() as workdir:
+            setup_fake_device(workdir, 540, 1200)
+            loaded_frame = os.path.join(workdir, "loaded.png")
+            results = Image.open(os.environ["FAKE_ADB_FRAME"]).convert("RGB")
+            for row in range(4):
+                results.paste((240, 240, 240), (20, 200 + row * 220, 520, 400 + row * 220))
+            results.save(loaded_frame, "PNG")
+            with LoadingScreenStub(os.environ["FAKE_ADB_FRAME"], loaded_frame, args.load_time, latency=args.latency) as server:
+                start = time.perf_counter()
+                outcome, encodes = asyncio.run(run(server, detector))
+                elapsed = time.perf_counter() - start
+                server.loading.cancel()
+        print(f"{name:<18} status={outcome['status']} steps={outcome['steps']} model calls={server.requests} encodes={encodes} uploads={server.images} upload bytes={server.image_bytes} time={elapsed:.2f}s")
+        check(outcome["status"] == "finished", f"task {name} did not finish")
+
+
+def grid_script(rows, columns, width=1080, height=2400):
+    """
+    Virtual device script with a portrait and a landscape screen of rows x columns buttons, the last
+    button of each switches to the other screen.
+    """
+    screens = {}
+    for name, rotation, (screen_width, screen_height) in (("portrait", 0, (width, height)), ("landscape", 1, (height, width))):
+        cell_width, cell_height = screen_width // columns, screen_height // rows
+        elements = [
+            {"id": f"{name}-{row}-{column}", "text": f"{row},{column}", "bounds": [column * cell_width + 8, row * cell_height + 8, (column + 1) * cell_width - 8, (row + 1) * cell_height - 8]}
+            for row in range(rows)
+            for column in range(columns)
+        ]
+        elements[-1]["tap"] = "landscape" if name == "portrait" else "portrait"
+        screens[name] = {"rotation": rotation, "elements": elements}
+    return {"width": width, "height": height, "density": 420, "start": "portrait", "screens": screens}
+
+
+def bench_device(args):
+    rng = random.Random(args.seed)
+    space = ActionSpace(use_shell_session=False, wait_for_settle=False)
+    points = [(rng.randrange(1001), rng.randrange(1001)) for _ in range(args.points)]
+    report("screen_point (per point)", timeit(lambda: [space.screen_point(x, y) for x, y in points], args.iterations))
+    report("screen_points (vectorized)", timeit(lambda: space.screen_points(points), args.iterations))
+    mismatches = sum(tuple(mapped) != space.screen_point(x, y) for mapped, (x, y) in zip(space.screen_points(points).tolist(), points))
+    print(f"vectorized vs per point mismatches: {mismatches}/{len(points)}")
+    check(not mismatches, f"{mismatches} vectorized points differ from screen_point")
+    print()
+
+    # Batches of taps on button centers, given in the grid of the frame captured before the batch. The
+    # last tap of every batch rotates the display, like the model would be shown a rotated frame.
+    for name, per_frame in (("per frame geometry", True), ("first frame geometry", False)):
+        device = VirtualDevice(grid_script(args.rows, args.columns))
+        tracker = DisplayTracker(query=lambda: (device.width, device.height, device.density))
+        space = ActionSpace(shell_session=device, wait_for_settle=False, settle_timeout=0, tracer=Tracer())
+        space.set_display(tracker.update(device.screenshot().size))
+        expected = []
+        elapsed = 0.0
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(args.batches):
+                frame = device.screenshot()
+                display = tracker.update(frame.size)
+                if per_frame:
+                    space.set_display(display)
+                elements = device.screens[device.screen]["elements"]
+                targets = rng.choices(elements[:-1], k=args.batch_size - 1) + [elements[-1]]
+                actions = []
+                for element in targets:
+                    x1, y1, x2, y2 = element["bounds"]
+                    actions.append({"type": "click", "x": round((x1 + x2) / 2 * 1000 / frame.width), "y": round((y1 + y2) / 2 * 1000 / frame.height)})
+                start = time.perf_counter()
+                space.execute_actions(actions)
+                elapsed += time.perf_counter() - start
+                expected.extend(element["id"] for element in targets)
+        missed = sum(gesture.target != target for gesture, target in zip(device.gestures, expected))
+        print(f"{name:<22} actions={len(expected)} actions/s={len(expected) / elapsed:9.0f} missed taps={missed} display refreshes={tracker.refreshes}")
+        # Without per frame geometry the taps after a rotation are expected to miss.
+        check(not per_frame or not missed, f"{missed} taps missed with per frame geometry")
+
+    # Whole loop through the fake adb binary on the default virtual device: tap Rotate in portrait,
+    # then Done on the landscape screen it opens.
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ["FAKE_ADB_ROOT"] = os.path.join(workdir, "device")
+        os.environ["FAKE_ADB_DEVICE"] = "default"
+        responses = [
+            "Thought: Rotate the screen.\nAction: click(start_box='(500,500)')",
+            "Thought: Confirm.\nAction: click(start_box='(875,870)')",
+            "Thought: The task is done.\nAction: finished(content='')",
+        ]
+
+        async def run(server):
+            client = InferenceClient([("stub", server.url)], api_key="stub")
+            try:
+                return await run_task_async("Rotate the screen and confirm", max_itr=5, adb_path=fake_adb_path(), inference_client=client, tracer=Tracer())
+            finally:
+                await client.aclose()
+
+        try:
+            with StubServer(responses) as server:
+                outcome = asyncio.run(run(server))
+        finally:
+            del os.environ["FAKE_ADB_DEVICE"]
+        with open(os.path.join(os.environ["FAKE_ADB_ROOT"], "gestures.jsonl")) as f:
+            gestures = [json.loads(line) for line in f]
+    print()
+    print(f"rotation task: status={outcome['status']} taps={[(gesture['screen'], gesture['target']) for gesture in gestures]}")
+    check(outcome["status"] == "finished" and [gesture["target"] for gesture in gestures] == ["rotate", "done"], "rotation task did not tap Rotate, then Done")
+
+
+def bench_startup(args):
+    source_dir = os.path.dirname(FAKE_ADB_SCRIPT)
+
+    def python(*arguments, env=None):
+        return subprocess.run([sys.executable, *arguments], cwd=source_dir, env=env, capture_output=True)
+
+    report("python -c pass", timeit(lambda: python("-c", "pass"), args.iterations))
+    report("import main", timeit(lambda: python("-c", "import main"), args.iterations))
+    report("main.py --help", timeit(lambda: python("main.py", "--help"), args.iterations))
+    print()
+    with tempfile.TemporaryDirectory() as workdir, StubServer() as server:
+        setup_fake_device(workdir, 270, 600)
+        env = {**os.environ, "ADB_PATH": fake_adb_path(), "HF_DPO_ENDPOINT": server.url, "HF_SFT_ENDPOINT": server.url, "HF_API_KEY": "stub"}
+        task = "Open the settings"
+        report("one-shot main.py task", timeit(lambda: python("main.py", task, "--max_itr", "2", env=env), args.tasks))
+
+        socket_path = os.path.join(workdir, "daemon.sock")
+        start = time.perf_counter()
+        daemon = subprocess.Popen([sys.executable, "daemon.py", "--socket", socket_path], cwd=source_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                if daemon.poll() is not None:
+                    raise Exception("Daemon exited during startup.")
+                try:
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                        connection.connect(socket_path)
+                    break
+                except OSError:
+                    time.sleep(0.01)
+            print(f"daemon ready after {(time.perf_counter() - start) * 1000:.1f}ms")
+            report("daemon.py --submit task", timeit(lambda: python("daemon.py", "--socket", socket_path, "--submit", task, env=env), args.tasks))
+            start = time.perf_counter()
+            results = list(submit(socket_path, [{"task": task, "max_itr": 2}] * args.batch))
+            elapsed = time.perf_counter() - start
+            finished = sum(result["status"] == "finished" for result in results)
+            print(f"{'daemon batch submit':<28} per task={elapsed / len(results) * 1000:9.1f}ms  finished={finished}/{len(results)}")
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+def block_episode(path, steps, width=540, height=1200, seed=0):
+    """
+    Episode of `steps` clicks on screens of large colored blocks, distinct to the perceptual hash, then finished.
+    """
+    rng = random.Random(seed)
+    episode = Episode(path, task="Open the settings")
+    for index in range(steps):
+        image = Image.new("RGB", (width, height), "#ffffff")
+        for row in range(6):
+            for column in range(3):
+                color = tuple(rng.randrange(256) for _ in range(3))
+                image.paste(color, (column * width // 3, row * height // 6, (column + 1) * width // 3, (row + 1) * height // 6))
+        if index == steps - 1:
+            response = "Thought: The task is done.\nAction: finished(content='')"
+        else:
+            response = f"Thought: Step {index + 1}, tapping the next button.\nAction: click(start_box='({rng.randint(50, 950)},{rng.randint(50, 950)})')"
+        episode.add_step(image, response, [action.to_event() for action in parse_actions(response)])
+    return episode
+
+
+class EpisodeStub(StubServer):
+    """
+    Model answering with the recorded response of the episode step whose frame is closest to the last
+    screenshot sent, so cancelled or repeated requests do not shift the responses.
+    With jitter, every coordinate of the response is moved by up to that much on the 1000x1000 grid.
+    """
+
+    def __init__(self, *episodes, jitter=0, seed=0, **kwargs):
+        super().__init__(**kwargs)
+        self.steps = [(perceptual_hash(Image.open(episode.frame_path(index))), step.response) for episode in episodes for index, step in enumerate(episode.steps)]
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+
+    def move(self, match):
+        with self.lock:
+            x, y = (min(1000, max(0, int(value) + self.rng.randint(-self.jitter, self.jitter))) for value in match.groups())
+        return f"({x},{y})"
+
+    def next_response(self, request):
+        image = latest_screenshot(request["messages"])
+        if image is None:
+            response = self.steps[0][1]
+        else:
+            phash = perceptual_hash(image)
+            response = min(self.steps, key=lambda step: hamming_distance(phash, step[0]))[1]
+        return re.sub(r"\((\d+),(\d+)\)", self.move, response) if self.jitter else response
+
+
+def bench_speculative(args):
+    workdir = tempfile.mkdtemp()
+    episode = block_episode(os.path.join(workdir, "episode"), args.steps)
+    os.environ["FAKE_ADB_EPISODE"] = episode.path
+    os.environ["FAKE_ADB_TRANSITION"] = str(args.transition)
+    if args.progress:
+        os.environ["FAKE_ADB_PROGRESS"] = "1"
+
+    async def run(server, speculative, max_speculative):
+        client = InferenceClient([("stub", server.url)], api_key="stub")
+        tracer = Tracer()
+        try:
+            outcome = await run_task_async(episode.task, max_itr=args.steps + 2, adb_path=fake_adb_path(), inference_client=client, tracer=tracer, speculative=speculative, max_speculative=max_speculative)
+        finally:
+            await client.aclose()
+        return outcome, tracer.summary()
+
+    results = []
+    for name, speculative, max_speculative in (("sequential", False, 1), ("speculative", True, 1), (f"speculative x{args.max_speculative}", True, args.max_speculative)):
+        os.environ["FAKE_ADB_ROOT"] = os.path.join(workdir, name.replace(" ", "_"))
+        os.makedirs(os.environ["FAKE_ADB_ROOT"], exist_ok=True)
+        with EpisodeStub(episode, latency=args.latency) as server:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                outcome, summary = asyncio.run(run(server, speculative, max_speculative))
+            elapsed = time.perf_counter() - start
+        stats = re.search(r"Speculation:  (.*)", output.getvalue())
+        results.append((name, outcome, elapsed, server.requests, summary.get("request", {}).get("total", 0.0), stats.group(1) if stats else ""))
+    for name, outcome, elapsed, requests, waited, stats in results:
+        print(f"{name:<16} status={outcome['status']} steps={outcome['steps']} time={elapsed:.2f}s ({elapsed / outcome['steps']:.2f}s/step) model calls={requests} waited on model={waited:.2f}s {stats}")
+    check(all(outcome["status"] == "finished" for _, outcome, *_ in results), "a run did not finish")
+
+
+class SlotStub(StubServer):
+    """
+    Endpoint with `slots` requests generated at once taking `service_time` seconds each, the others
+    wait in arrival order like on a loaded TGI server.
+    """
+
+    def __init__(self, slots, service_time, **kwargs):
+        super().__init__(**kwargs)
+        self.slots = threading.Semaphore(slots)
+        self.service_time = service_time
+
+    def next_response(self, request):
+        with self.slots:
+            time.sleep(self.service_time)
+        return super().next_response(request)
+
+
+def bench_gateway(args):
+    def request(task, text):
+        system = f"{TARS_SYSTEM_PROMPT}\n## User Instruction\n{task}"
+        return {
+            "model": "tgi",
+            "messages": [
+                {"role": "system", "content": [{"type": "text", "text": system}]},
+                {"role": "user", "content": [{"type": "text", "text": text}]},
+            ],
+            "max_tokens": 64,
+            "temperature": 0.0,
+        }
+
+    async def run(mode, server):
+        client = InferenceClient([("stub", server.url)], api_key="stub", failover=False)
+        gateway = InferenceGateway(client, max_concurrent=args.max_concurrent, tokens_per_minute=args.tokens_per_minute) if mode == "gateway" else None
+        semaphore = asyncio.Semaphore(args.max_concurrent)
+        latencies = []
+
+        async def send(session, kwargs):
+            if gateway is not None:
+                return await gateway.session(session).acreate(**kwargs)
+            if mode == "fifo":
+                async with semaphore:
+                    return await client.acreate(**kwargs)
+            return await client.acreate(**kwargs)
+
+        async def interactive(index):
+            # Every other session runs the same task as the previous one, on the same screens.
+            task = f"Open the settings of app {index // 2}"
+            for step in range(args.steps):
+                start = time.perf_counter()
+                await send(f"device-{index}", request(task, f"Screen {step} of {task}"))
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(args.think_time)
+
+        async def bulk():
+            start = time.perf_counter()
+            await asyncio.gather(*(send("bulk", request("Label the screenshot", f"Screenshot {index}")) for index in range(args.bulk)))
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        bulk_time, *_ = await asyncio.gather(bulk(), *(interactive(index) for index in range(args.sessions)))
+        elapsed = time.perf_counter() - start
+        stats = gateway.stats() if gateway is not None else None
+        if gateway is not None:
+            await gateway.aclose()
+        await client.aclose()
+        return elapsed, bulk_time, latencies, stats
+
+    for mode in ("direct", "fifo", "gateway"):
+        with SlotStub(args.slots, args.service_time) as server:
+            elapsed, bulk_time, latencies, stats = asyncio.run(run(mode, server))
+        print(
+            f"{mode:<8} total={elapsed:.2f}s bulk={bulk_time:.2f}s interactive p50={statistics.median(latencies) * 1000:.0f}ms "
+            f"p95={sorted(latencies)[int(len(latencies) * 0.95)] * 1000:.0f}ms upstream={server.requests} max in flight={server.max_in_flight}"
+        )
+        if stats is not None:
+            print(f"         {json.dumps({key: value for key, value in stats.items() if key != 'sessions'})}")
+            check(server.max_in_flight <= args.max_concurrent, f"{server.max_in_flight} requests in flight, the limit is {args.max_concurrent}")
+            check(stats["upstream"] + stats["coalesced"] == stats["requests"], f"{stats['requests']} requests, {stats['upstream']} sent and {stats['coalesced']} coalesced")
+            check(args.sessions < 2 or stats["coalesced"] > 0, "identical requests of sessions running the same task were not coalesced")
+
+
+def bench_episodelog(args):
+    rng = random.Random(args.seed)
+    frames = []
+    for _ in range(args.unique):
+        image = Image.new("RGB", (540, 1200), tuple(rng.randrange(256) for _ in range(3)))
+        for _ in range(12):
+            x, y = rng.randrange(500), rng.randrange(1150)
+            image.paste(tuple(rng.randrange(256) for _ in range(3)), (x, y, x + rng.randrange(40, 400), y + rng.randrange(40, 600)))
+        data = io.BytesIO()
+        image.save(data, "JPEG", quality=80)
+        frames.append(data.getvalue())
+    response = "Thought: Tapping the next button.\nAction: click(start_box='(500,500)')"
+    actions = [action.to_event() for action in parse_actions(response)]
+    with tempfile.TemporaryDirectory() as workdir:
+        log = EpisodeLog(os.path.join(workdir, "log"), chunk_size=args.chunk_mb * 1024 * 1024)
+        start = time.perf_counter()
+        for index in range(args.steps):
+            if index % args.episode_steps == 0:
+                if index:
+                    log.finish_episode(episode, "finished")
+                episode = log.start_episode(f"Task {index // args.episode_steps}", "bench")
+            log.add_step(episode, rng.choice(frames), response, actions, {"model": 1.0, "step": 2.0})
+        log.finish_episode(episode, "finished")
+        elapsed = time.perf_counter() - start
+        stats = log.stats()
+        print(f"episode log write: {args.steps} steps in {elapsed:.2f}s, {args.steps / elapsed:.0f} steps/s")
+        print(f"  {json.dumps(stats)}")
+        check(stats["frames"] <= args.unique, f"{stats['frames']} frames stored for {args.unique} distinct ones")
+        digests = [step.frame for step in log.steps(episode)]
+        report("frame read (mmap view)", timeit(lambda: log.frame(rng.choice(digests)), args.iterations * 100))
+        report("frame read as data URL", timeit(lambda: log.image_url(rng.choice(digests)), args.iterations * 100))
+        start = time.perf_counter()
+        retained = log.retain(max_bytes=stats["frame_bytes"] // 4)
+        print(f"retain to a quarter: {time.perf_counter() - start:.2f}s {json.dumps(retained)}")
+        retained_stats = log.stats()
+        print(f"  {json.dumps(retained_stats)}")
+        check(retained_stats["frame_bytes"] <= stats["frame_bytes"] // 4, f"{retained_stats['frame_bytes']} frame bytes kept, the limit is {stats['frame_bytes'] // 4}")
+        check(retained_stats["episodes"] and all(log.frame(step.frame) is not None for step in log.steps(episode)), "the last episode was not kept")
+        log.close()
+
+        episode_dir = Episode(os.path.join(workdir, "episode"), task="Baseline")
+        images = [Image.open(io.BytesIO(data)) for data in frames[:20]]
+        start = time.perf_counter()
+        for index in range(args.baseline_steps):
+            episode_dir.add_step(images[index % len(images)], response, actions)
+        elapsed = time.perf_counter() - start
+        disk = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(episode_dir.path) for name in names)
+        print(f"episode directory write: {args.baseline_steps} steps in {elapsed:.2f}s, {args.baseline_steps / elapsed:.0f} steps/s, {disk} bytes on disk")
+
+
+def legacy_system_message(system_prompt, instruction, steps):
+    """
+    System message of request `steps`, as the request preparation before prompt.py built it: the
+    instruction suffix was appended to the agent's system prompt on every request.
+    """
+    for _ in range(steps):
+        system_prompt = f"{system_prompt}\n## User Instruction\n{instruction}"
+    return system_prompt
+
+
+def bench_prompt(args):
+    frame = preprocess_screenshot(transition_frames(animated=1, stable=0)[0].resize((1080, 2400)), log=False)
+    url = get_image_url(frame.data, frame.mime_type)
+    instruction = "Open Youtube and search for the latest video of the channel"
+    history = ConversationHistory(max_images=args.max_images, max_turns=args.max_turns)
+    agent = AsyncTARS(instruction, "default", inference_client=InferenceClient([("stub", "http://127.0.0.1:9")], api_key="stub"), max_prompt_tokens=args.max_prompt_tokens)
+    system_messages = set()
+    timings, estimates = [], []
+    for step in range(args.steps):
+        history.append({"role": "user", "content": [{"type": "text", "text": "Here is the screen"}, {"type": "image_url", "image_url": {"url": url}}]})
+        start = time.perf_counter()
+        messages, _ = agent.__prepare_request__(history.messages(), {})
+        timings.append(time.perf_counter() - start)
+        system_messages.add(json.dumps(messages[0]))
+        estimates.append(sum(estimate_tokens(message) for message in messages))
+        history.append({"role": "assistant", "content": [{"type": "text", "text": f"Thought: step {step}\nAction: click(start_box='(500,{step % 1000})')"}]})
+    legacy = legacy_system_message(TARS_SYSTEM_PROMPT, instruction, args.steps)
+    print(f"system message after {args.steps} requests: legacy {len(legacy)} chars, assembled {len(agent.prompt.system_message['content'][0]['text'])} chars, {len(system_messages)} distinct")
+    print(f"estimated request tokens: first {estimates[0]} last {estimates[-1]} max {max(estimates)} (budget {args.max_prompt_tokens}, {agent.prompt.trimmed} requests trimmed)")
+    print(f"request preparation: mean {statistics.mean(timings) * 1e6:.1f}us max {max(timings) * 1e6:.1f}us")
+    check(len(system_messages) == 1, f"{len(system_messages)} distinct system messages")
+    check(args.max_prompt_tokens is None or max(estimates) <= args.max_prompt_tokens, f"requests of up to {max(estimates)} tokens, the budget is {args.max_prompt_tokens}")
+
+    shortcuts = DEFAULT_SHORTCUTS.reference_block()
+    rendered = {}
+    for name, render in (
+        ("full substitution", lambda plan: MANAGER_PROMPT_TEMPLATE.substitute(instruction=instruction, shortcuts_reference_block=shortcuts, planning_block=agent.prompt.manager_blocks["planning_block"], error_handling_block="", plan_checkpoint_meta_metadata="", plan_description=PLAN_DESCRIPTION, current_subgoal_description=SUBGOAL_DESCRIPTION)),
+        ("incremental", lambda plan: agent.prompt.manager_prompt()),
+    ):
+        start = time.perf_counter()
+        for step in range(args.steps):
+            # The plan changes every 10 steps.
+            agent.prompt.set_plan(f"1. Open Youtube\n2. Search\n3. Open the video ({step // 10})", "Search")
+            rendered[name] = render(step)
+        print(f"manager prompt, {name:<18} {(time.perf_counter() - start) / args.steps * 1e6:6.1f}us per step")
+    check(rendered["full substitution"] == rendered["incremental"], "the incremental manager prompt differs from the full substitution")
+
+
+def bench_evaluate(args):
+    workdir = tempfile.mkdtemp()
+    episodes = [block_episode(os.path.join(workdir, f"episode{index}"), args.steps, seed=index) for index in range(args.episodes)]
+    # Tasks recorded twice, their screens repeat for the cache layer.
+    episodes += [block_episode(os.path.join(workdir, f"repeat{index}"), args.steps, seed=index) for index in range(args.repeats)]
+    configs = [EvalConfig.parse(name) for name in args.configs.split(",")]
+    steps = sum(len(episode.steps) for episode in episodes)
+    with EpisodeStub(*episodes, latency=args.dpo_latency) as dpo, EpisodeStub(*episodes, latency=args.sft_latency, jitter=args.sft_jitter) as sft:
+        endpoints = {"dpo": dpo.url, "sft": sft.url}
+        start = time.perf_counter()
+        for config in configs:
+            asyncio.run(evaluate(episodes, [config], endpoints, concurrency=1, prompt_price=args.prompt_price, completion_price=args.completion_price, api_key="stub"))
+        sequential = time.perf_counter() - start
+        start = time.perf_counter()
+        summaries, _ = asyncio.run(evaluate(episodes, configs, endpoints, concurrency=args.concurrency, prompt_price=args.prompt_price, completion_price=args.completion_price, api_key="stub"))
+        parallel = time.perf_counter() - start
+    print_report(summaries)
+    print(f"{len(configs)} configurations x {steps} steps: one at a time {sequential:.2f}s, concurrently with {args.concurrency} workers each {parallel:.2f}s")
+    shutil.rmtree(workdir)
+    check(all(summary["steps"] == steps and not summary["errors"] for summary in summaries), "steps failed or were skipped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the agent loop.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    screenshot_parser = subparsers.add_parser("screenshot", help="File based vs in-memory screenshot capture.")
+    screenshot_parser.add_argument("--iterations", type=int, default=5)
+    screenshot_parser.add_argument("--width", type=int, default=1080)
+    screenshot_parser.add_argument("--height", type=int, default=2400)
+    screenshot_parser.set_defaults(func=bench_screenshot)
+
+    actions_parser = subparsers.add_parser("actions", help="Gesture dispatch latency, per command vs persistent session.")
+    actions_parser.add_argument("--iterations", type=int, default=50)
+    actions_parser.set_defaults(func=bench_actions)
+
+    settle_parser = subparsers.add_parser("settle", help="Adaptive screen settle wait vs the fixed sleep.")
+    settle_parser.add_argument("--frames", type=str, default=None, help="Directory with a recorded frame sequence.")
+    settle_parser.add_argument("--animated", type=int, default=8, help="Animated frames in the synthetic sequence.")
+    settle_parser.add_argument("--timeout", type=float, default=3.0)
+    settle_parser.add_argument("--poll_interval", type=float, default=0.15)
+    settle_parser.add_argument("--iterations", type=int, default=3)
+    settle_parser.set_defaults(func=bench_settle)
+
+    parser_parser = subparsers.add_parser("parser", help="Action parser properties, fuzzing and throughput.")
+    parser_parser.add_argument("--corpus_size", type=int, default=500)
+    parser_parser.add_argument("--fuzz", type=int, default=2000)
+    parser_parser.add_argument("--seed", type=int, default=0)
+    parser_parser.add_argument("--iterations", type=int, default=5)
+    parser_parser.set_defaults(func=bench_parser)
+
+    encode_parser = subparsers.add_parser("encode", help="Payload size and encode latency per screenshot encode setting.")
+    encode_parser.add_argument("--dir", type=str, default=None, help="Directory with sample screenshots.")
+    encode_parser.set_defaults(func=bench_encode)
+
+    history_parser = subparsers.add_parser("history", help="Memory retained by the conversation over a long task.")
+    history_parser.add_argument("--steps", type=int, default=500)
+    history_parser.set_defaults(func=bench_history)
+
+    inference_parser = subparsers.add_parser("inference", help="Retry, circuit breaker and failover against stub endpoints.")
+    inference_parser.add_argument("--transient_failures", type=int, default=2)
+    inference_parser.add_argument("--base_delay", type=float, default=0.2)
+    inference_parser.add_argument("--iterations", type=int, default=10)
+    inference_parser.set_defaults(func=bench_inference)
+
+    stream_parser = subparsers.add_parser("stream", help="Time to action, complete vs streamed responses with early dispatch.")
+    stream_parser.add_argument("--prefill", type=float, default=0.3, help="Seconds before the first token.")
+    stream_parser.add_argument("--token_latency", type=float, default=0.01, help="Seconds per 4 character chunk.")
+    stream_parser.add_argument("--no_cancel", dest="cancel", action="store_false", help="Read streams to the end after dispatching.")
+    stream_parser.add_argument("--iterations", type=int, default=5)
+    stream_parser.set_defaults(func=bench_stream)
+
+    replay_parser = subparsers.add_parser("replay", help="Whole loop over a recorded episode with a fake device and a stub model.")
+    replay_parser.add_argument("--episode", type=str, default=None, help="Recorded episode directory, a synthetic one by default.")
+    replay_parser.add_argument("--steps", type=int, default=10, help="Steps of the synthetic episode.")
+    replay_parser.add_argument("--width", type=int, default=1080)
+    replay_parser.add_argument("--height", type=int, default=2400)
+    replay_parser.add_argument("--latency", type=float, default=0.0, help="Seconds the stub model takes per response.")
+    replay_parser.set_defaults(func=bench_replay)
+
+    hierarchy_parser = subparsers.add_parser("hierarchy", help="UI hierarchy parsing, label lookups and coordinate snapping.")
+    hierarchy_parser.add_argument("--rows", type=int, default=500, help="Rows of 4 cells in the synthetic hierarchy.")
+    hierarchy_parser.add_argument("--queries", type=int, default=1000)
+    hierarchy_parser.add_argument("--seed", type=int, default=0)
+    hierarchy_parser.add_argument("--iterations", type=int, default=5)
+    hierarchy_parser.set_defaults(func=bench_hierarchy)
+
+    shortcuts_parser = subparsers.add_parser("shortcuts", help="Model calls per task, atomic actions vs shortcut macros.")
+    shortcuts_parser.add_argument("--latency", type=float, default=1.0, help="Seconds the stub model takes per response.")
+    shortcuts_parser.set_defaults(func=bench_shortcuts)
+
+    trajectory_parser = subparsers.add_parser("trajectory", help="Model calls of a repeated task with the trajectory cache.")
+    trajectory_parser.add_argument("--steps", type=int, default=6)
+    trajectory_parser.add_argument("--latency", type=float, default=1.0, help="Seconds the stub model takes per response.")
+    trajectory_parser.set_defaults(func=bench_trajectory)
+
+    change_parser = subparsers.add_parser("change", help="Screen change detection latency and model calls on a loading screen.")
+    change_parser.add_argument("--load_time", type=float, default=4.0, help="Seconds the opened screen takes to load.")
+    change_parser.add_argument("--latency", type=float, default=0.5, help="Seconds the stub model takes per response.")
+    change_parser.add_argument("--iterations", type=int, default=20)
+    change_parser.set_defaults(func=bench_change)
+
+    device_parser = subparsers.add_parser("device", help="Coordinate mapping throughput and accuracy on a virtual device, with rotations.")
+    device_parser.add_argument("--points", type=int, default=100000, help="Points mapped per transform iteration.")
+    device_parser.add_argument("--batches", type=int, default=500)
+    device_parser.add_argument("--batch_size", type=int, default=10)
+    device_parser.add_argument("--rows", type=int, default=12)
+    device_parser.add_argument("--columns", type=int, default=6)
+    device_parser.add_argument("--seed", type=int, default=0)
+    device_parser.add_argument("--iterations", type=int, default=5)
+    device_parser.set_defaults(func=bench_device)
+
+    startup_parser = subparsers.add_parser("startup", help="CLI startup time and per task overhead, one-shot vs resident daemon.")
+    startup_parser.add_argument("--iterations", type=int, default=5)
+    startup_parser.add_argument("--tasks", type=int, default=5, help="Tasks run one by one per mode.")
+    startup_parser.add_argument("--batch", type=int, default=50, help="Tasks submitted to the daemon over one connection.")
+    startup_parser.set_defaults(func=bench_startup)
+
+    speculative_parser = subparsers.add_parser("speculative", help="Time per step with requests speculated on intermediate frames while the screen settles.")
+    speculative_parser.add_argument("--steps", type=int, default=6)
+    speculative_parser.add_argument("--latency", type=float, default=1.5, help="Seconds the stub model takes per response.")
+    speculative_parser.add_argument("--transition", type=float, default=0.6, help="Seconds a new screen takes to slide in.")
+    speculative_parser.add_argument("--progress", action=argparse.BooleanOptionalAction, default=True, help="Keep a progress bar pulsing so the screen only settles at the settle timeout.")
+    speculative_parser.add_argument("--max_speculative", type=int, default=2)
+    speculative_parser.set_defaults(func=bench_speculative)
+
+    gateway_parser = subparsers.add_parser("gateway", help="Interactive sessions next to a bulk job, direct vs FIFO limited vs the batching gateway.")
+    gateway_parser.add_argument("--sessions", type=int, default=8, help="Interactive sessions, every other one duplicates the previous one.")
+    gateway_parser.add_argument("--steps", type=int, default=5, help="Sequential requests per interactive session.")
+    gateway_parser.add_argument("--think_time", type=float, default=0.1, help="Seconds between the steps of a session.")
+    gateway_parser.add_argument("--bulk", type=int, default=40, help="Requests submitted at once by the bulk session.")
+    gateway_parser.add_argument("--slots", type=int, default=4, help="Requests the stub endpoint generates at once.")
+    gateway_parser.add_argument("--service_time", type=float, default=0.2, help="Seconds the stub endpoint takes per request.")
+    gateway_parser.add_argument("--max_concurrent", type=int, default=4)
+    gateway_parser.add_argument("--tokens_per_minute", type=int, default=None)
+    gateway_parser.set_defaults(func=bench_gateway)
+
+    episodelog_parser = subparsers.add_parser("episodelog", help="Episode log write rate, deduplication, mmap reads and retention vs the episode directory.")
+    episodelog_parser.add_argument("--steps", type=int, default=20000)
+    episodelog_parser.add_argument("--unique", type=int, default=2000, help="Distinct frames the steps are drawn from.")
+    episodelog_parser.add_argument("--episode_steps", type=int, default=10)
+    episodelog_parser.add_argument("--chunk_mb", type=int, default=16)
+    episodelog_parser.add_argument("--baseline_steps", type=int, default=300, help="Steps recorded as an episode directory for comparison.")
+    episodelog_parser.add_argument("--seed", type=int, default=0)
+    episodelog_parser.add_argument("--iterations", type=int, default=20)
+    episodelog_parser.set_defaults(func=bench_episodelog)
+
+    prompt_parser = subparsers.add_parser("prompt", help="System prompt growth, request preparation and token budget over a long task.")
+    prompt_parser.add_argument("--steps", type=int, default=200)
+    prompt_parser.add_argument("--max_images", type=int, default=5)
+    prompt_parser.add_argument("--max_turns", type=int, default=20)
+    prompt_parser.add_argument("--max_prompt_tokens", type=int, default=8000)
+    prompt_parser.set_defaults(func=bench_prompt)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="Offline DPO vs SFT evaluation over recorded episodes against stub endpoints, sequential vs concurrent.")
+    evaluate_parser.add_argument("--configs", type=str, default="dpo,sft,dpo+cache,sft+gateway")
+    evaluate_parser.add_argument("--episodes", type=int, default=8)
+    evaluate_parser.add_argument("--repeats", type=int, default=4, help="Episodes recorded a second time.")
+    evaluate_parser.add_argument("--steps", type=int, default=5)
+    evaluate_parser.add_argument("--concurrency", type=int, default=4)
+    evaluate_parser.add_argument("--dpo_latency", type=float, default=0.3)
+    evaluate_parser.add_argument("--sft_latency", type=float, default=0.2)
+    evaluate_parser.add_argument("--sft_jitter", type=int, default=40, help="Coordinate error of the SFT stub on the 1000x1000 grid.")
+    evaluate_parser.add_argument("--prompt_price", type=float, default=0.5, help="USD per million prompt tokens.")
+    evaluate_parser.add_argument("--completion_price", type=float, default=1.5, help="USD per million completion tokens.")
+    evaluate_parser.set_defaults(func=bench_evaluate)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
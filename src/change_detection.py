@@ -0,0 +1,107 @@
+"""
+Change detection between the frame the model last saw and a new capture, on a downsampled grayscale
+copy with NumPy. Used by the loop to avoid re-sending (and re-asking about) a screen that did not change.
+"""
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+
+class ChangeResult(NamedTuple):
+    changed: bool
+    # Fraction of grid cells with changed pixels and mean absolute pixel difference, both in [0, 1].
+    changed_fraction: float
+    mean_difference: float
+    # Bounding boxes of connected changed cells in source pixels (x1, y1, x2, y2), largest first.
+    regions: List[Tuple[int, int, int, int]]
+
+    @property
+    def bbox(self) -> Optional[Tuple[int, int, int, int]]:
+        if not self.regions:
+            return None
+        return (
+            min(region[0] for region in self.regions),
+            min(region[1] for region in self.regions),
+            max(region[2] for region in self.regions),
+            max(region[3] for region in self.regions),
+        )
+
+
+def connected_regions(cells):
+    """
+    Bounding boxes (column, row, column end, row end) of 4-connected True cells of a 2D bool array.
+    """
+    rows, columns = cells.shape
+    seen = np.zeros_like(cells)
+    regions = []
+    for row, column in zip(*np.nonzero(cells)):
+        if seen[row, column]:
+            continue
+        seen[row, column] = True
+        stack = [(row, column)]
+        top, left, bottom, right = row, column, row, column
+        while stack:
+            r, c = stack.pop()
+            top, left, bottom, right = min(top, r), min(left, c), max(bottom, r), max(right, c)
+            for nr, nc in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+                if 0 <= nr < rows and 0 <= nc < columns and cells[nr, nc] and not seen[nr, nc]:
+                    seen[nr, nc] = True
+                    stack.append((nr, nc))
+        regions.append((int(left), int(top), int(right) + 1, int(bottom) + 1))
+    return regions
+
+
+class ChangeDetector:
+    """
+    width:                Width of the downsampled frame, the height keeps the aspect ratio.
+    pixel_threshold:      Gray level difference (0-255) above which a pixel counts as changed.
+    cell_size:            Side of the grid cells (in downsampled pixels) changes are reported on.
+    min_changed_fraction: Fraction of changed cells above which the screen counts as changed, so a
+                          blinking cursor or a ticking clock does not.
+    ignore_top:           Fraction of the height ignored at the top (status bar).
+    """
+
+    def __init__(self, width=108, pixel_threshold=24, cell_size=6, min_changed_fraction=0.005, ignore_top=0.04):
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.cell_size = cell_size
+        self.min_changed_fraction = min_changed_fraction
+        self.ignore_top = ignore_top
+        self.reference = None
+        self.reference_size = None
+
+    def downsample(self, image):
+        height = max(self.cell_size, round(self.width * image.height / image.width))
+        # Box reduction first, then grayscale on the small frame: about half the cost of the other order.
+        small = image.resize((self.width, height), Image.BILINEAR, reducing_gap=2.0).convert("L")
+        pixels = np.asarray(small, dtype=np.int16)
+        pixels = pixels[round(height * self.ignore_top):]
+        rows = pixels.shape[0] - pixels.shape[0] % self.cell_size
+        columns = pixels.shape[1] - pixels.shape[1] % self.cell_size
+        return pixels[:rows, :columns]
+
+    def commit(self, image):
+        """
+        Make `image` the frame later captures are compared with, i.e. the one the model was shown.
+        """
+        self.reference = self.downsample(image)
+        self.reference_size = image.size
+
+    def compare(self, image):
+        if self.reference is None or image.size != self.reference_size:
+            return ChangeResult(True, 1.0, 1.0, [(0, 0, image.width, image.height)])
+        pixels = self.downsample(image)
+        difference = np.abs(pixels - self.reference)
+        mask = difference > self.pixel_threshold
+        rows, columns = mask.shape
+        cells = mask.reshape(rows // self.cell_size, self.cell_size, columns // self.cell_size, self.cell_size).any(axis=(1, 3))
+        changed_fraction = float(cells.mean())
+        scale = image.width / self.width
+        offset = image.height * self.ignore_top
+        regions = [
+            (round(x1 * self.cell_size * scale), round(y1 * self.cell_size * scale + offset),
+             round(x2 * self.cell_size * scale), round(y2 * self.cell_size * scale + offset))
+            for x1, y1, x2, y2 in connected_regions(cells)
+        ]
+        regions.sort(key=lambda region: (region[2] - region[0]) * (region[3] - region[1]), reverse=True)
+        return ChangeResult(changed_fraction > self.min_changed_fraction, changed_fraction, float(difference.mean()) / 255, regions)
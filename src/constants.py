@@ -1,5 +1,6 @@
 from string import Template
 import os
+from shortcuts import DEFAULT_SHORTCUTS
 
 MANAGER_PROMPT_TEMPLATE = Template(
 """### User Instruction ###
@@ -33,7 +34,7 @@ INIT_TIPS = """0. Do not add any payment information. If you are asked to sign i
 """
 
 
-TARS_SYSTEM_PROMPT = r"""You are a GUI agent. You are given a task, overall plan, current subgoal, progress status, additional context (such as screen information, keyboard status, tips, important notes, and recent action history), your action history, and screenshots. Your job is to carefully examine all provided information and decide on the next action to complete the task.
+TARS_SYSTEM_PROMPT_TEMPLATE = Template(r"""You are a GUI agent. You are given a task, overall plan, current subgoal, progress status, additional context (such as screen information, keyboard status, tips, important notes, and recent action history), your action history, and screenshots. Your job is to carefully examine all provided information and decide on the next action to complete the task.
 
 ## Output Format:
 Your output must contain exactly two lines:
@@ -62,8 +63,8 @@ You also have access to shortcut functions. They are listed in the format:
 IMPORTANT: If you decide to use a shortcut, first verify that its precondition is met in the current phone state. For example, if the shortcut requires the phone to be at the Home screen, check whether the current screenshot shows the Home screen. If not, perform the appropriate atomic actions instead.
   name(arguments): description | Precondition: precondition
 Use them similarly to atomic actions.
-For example:
-- Tap_Type_and_Enter(start_box='<|box_start|>(x1,y1)<|box_end|>', text): Tap an input box at the given start_box coordinate, type the "text", and then perform the Enter operation | Precondition: There is a text input box on the screen.
+Available shortcuts:
+$shortcuts_reference_block
 
 When appropriate, you may call a shortcut instead of issuing multiple atomic actions. Always verify that the current phone state meets the shortcut’s precondition before using it.
 
@@ -80,7 +81,9 @@ When appropriate, you may call a shortcut instead of issuing multiple atomic act
        d. Use the scroll action (drag) from the current seek position to the target (y usually remains constant).
 6. **Error Handling:** If you detect an error in previous actions (for example, repeated failures), think as a human user and adjust your strategy to rectify the error.
 
-"""
+""")
+# The shortcut block is generated from the registry that ActionSpace executes, see shortcuts.py.
+TARS_SYSTEM_PROMPT = TARS_SYSTEM_PROMPT_TEMPLATE.substitute(shortcuts_reference_block=DEFAULT_SHORTCUTS.reference_block())
 
 HF_TARS_BASE_ENDPOINT = os.getenv("HF_SFT_ENDPOINT","https://rkmm5cfjhg21bqv6.us-east-1.aws.endpoints.huggingface.cloud/v1/")
 HF_TARS_DPO_ENDPOINT = os.getenv("HF_DPO_ENDPOINT", "https://s0b5af1yeykmxwwc.us-east-1.aws.endpoints.huggingface.cloud/v1/")
\ No newline at end of file
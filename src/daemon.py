@@ -0,0 +1,242 @@
+"""
+Resident agent process for many short tasks: the imports, the inference client and its HTTP connection
+pool, the adb shell session and the display values stay warm between tasks, which run one at a time.
+
+    python src/daemon.py < tasks.jsonl                          # tasks on stdin, results on stdout
+    python src/daemon.py --socket /tmp/tars.sock                # tasks over a unix socket
+    python src/daemon.py --socket /tmp/tars.sock --submit "Open Youtube" "Open Maps"
+
+A task is a JSON line {"task": "...", "id": ..., "max_itr": ..., "llm_type": "dpo" | "sft"} or a bare
+string. Every task is answered with one JSON line {"id", "task", "status", "steps", "duration"} ("error"
+when it failed). Task logs go to stderr. Only the standard library is imported on the --submit path.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+
+def parse_request(line):
+    """
+    Task dict of a JSONL request line, None for blank lines.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    if not line.startswith("{"):
+        return {"task": json.loads(line) if line.startswith('"') else line}
+    request = json.loads(line)
+    if not isinstance(request.get("task"), str) or not request["task"]:
+        raise ValueError("Request without a task.")
+    return request
+
+
+class AgentDaemon:
+    def __init__(self, adb_path=None, llm_type="dpo", max_itr=10, request_timeout=120, task_timeout=None, failover=False, tracer=None):
+        self.adb_path = adb_path or os.getenv("ADB_PATH", "adb")
+        self.llm_type = llm_type
+        self.max_itr = max_itr
+        self.request_timeout = request_timeout
+        self.task_timeout = task_timeout
+        self.failover = failover
+        self.tracer = tracer
+        self.clients = {}
+        self.http_client = None
+        self.action_space = None
+        self.display_tracker = None
+        self.lock = asyncio.Lock()
+        self.tasks = 0
+
+    async def start(self):
+        """
+        Import the agent, open the HTTP connection pool and the adb shell session.
+        """
+        import httpx
+        from actions import ActionSpace
+        from display import DisplayTracker
+        from image_pipeline import ImageEncodeConfig
+        from tracing import Tracer
+        from utils import device_state
+        state = await asyncio.to_thread(device_state, self.adb_path)
+        if state != "device":
+            raise Exception(f"No device ready, adb get-state: {state}")
+        self.tracer = self.tracer if self.tracer is not None else Tracer()
+        self.http_client = httpx.AsyncClient(timeout=self.request_timeout)
+        self.client(self.llm_type)
+        encode_config = ImageEncodeConfig.from_env()
+        self.action_space = ActionSpace(adb_path=self.adb_path, crop_top=encode_config.crop_top, crop_bottom=encode_config.crop_bottom)
+        await asyncio.to_thread(self.action_space.run_shell, "true")
+        self.display_tracker = DisplayTracker(self.adb_path)
+
+    def client(self, llm_type):
+        if llm_type not in self.clients:
+            from inference_client import RetryPolicy
+            from tars import create_inference_client
+            self.clients[llm_type] = create_inference_client(
+                llm_type,
+                failover=self.failover,
+                retry_policy=RetryPolicy(request_timeout=self.request_timeout),
+                http_client=self.http_client,
+            )
+        return self.clients[llm_type]
+
+    async def run(self, request):
+        """
+        Run one task request, returns its result dict.
+        """
+        from main import run_task_async
+        async with self.lock:
+            self.tasks += 1
+            task = request["task"]
+            llm_type = request.get("llm_type", self.llm_type)
+            result = {"id": request.get("id", self.tasks), "task": task}
+            start = time.monotonic()
+            try:
+                outcome = await asyncio.wait_for(
+                    run_task_async(
+                        task,
+                        max_itr=request.get("max_itr", self.max_itr),
+                        llm_type=llm_type,
+                        adb_path=self.adb_path,
+                        inference_client=self.client(llm_type),
+                        tracer=self.tracer,
+                        action_space=self.action_space,
+                        display_tracker=self.display_tracker,
+                    ),
+                    timeout=request.get("timeout", self.task_timeout),
+                )
+                result.update(outcome)
+            except asyncio.TimeoutError:
+                result["status"] = "timeout"
+            except Exception as e:
+                result["status"] = "error"
+                result["error"] = str(e)
+            result["duration"] = time.monotonic() - start
+            return result
+
+    async def answer(self, line):
+        try:
+            request = parse_request(line)
+        except ValueError as e:
+            return {"status": "error", "error": f"Invalid request: {e}"}
+        if request is None:
+            return None
+        return await self.run(request)
+
+    async def serve_stdin(self, output):
+        while True:
+            line = await asyncio.to_thread(sys.stdin.readline)
+            if not line:
+                return
+            result = await self.answer(line)
+            if result is not None:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+
+    async def serve_socket(self, path):
+        async def handle(reader, writer):
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    result = await self.answer(line.decode("utf-8"))
+                    if result is not None:
+                        writer.write((json.dumps(result) + "\n").encode("utf-8"))
+                        await writer.drain()
+            except ConnectionError as e:
+                print("Client disconnected: ", e)
+            finally:
+                writer.close()
+
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(handle, path)
+        print(f"Listening on {path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        if self.http_client is not None:
+            await self.http_client.aclose()
+        if self.action_space is not None:
+            self.action_space.close()
+        if self.tracer is not None:
+            self.tracer.print_summary()
+
+
+def submit(path, requests, timeout=None):
+    """
+    Send task requests to a daemon listening on `path` and yield their results as they complete.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(path)
+        connection.sendall("".join(json.dumps(request) + "\n" for request in requests).encode("utf-8"))
+        connection.shutdown(socket.SHUT_WR)
+        with connection.makefile("r", encoding="utf-8") as results:
+            for line in results:
+                yield json.loads(line)
+
+
+async def serve(args, output):
+    daemon = AgentDaemon(
+        llm_type=args.llm_type,
+        max_itr=args.max_itr,
+        request_timeout=args.request_timeout,
+        task_timeout=args.task_timeout,
+        failover=args.failover,
+    )
+    try:
+        await daemon.start()
+        if args.socket:
+            await daemon.serve_socket(args.socket)
+        else:
+            await daemon.serve_stdin(output)
+    finally:
+        await daemon.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the agent warm and run tasks submitted as JSONL over stdin or a unix socket.")
+    parser.add_argument("tasks", type=str, nargs="*", help="With --submit, task queries to send")
+    parser.add_argument("--socket", type=str, default=None, help="Unix socket to listen on (or submit to) instead of stdin")
+    parser.add_argument("--submit", action="store_true", help="Send the tasks to a running daemon and print the results")
+    parser.add_argument("--llm_type", type=str, default="dpo", help="dpo/sft: default model of the tasks")
+    parser.add_argument("--max_itr", type=int, default=10, help="Default maximum number of iterations per task")
+    parser.add_argument("--request_timeout", type=float, default=120, help="Timeout in seconds of a single model request")
+    parser.add_argument("--task_timeout", type=float, default=None, help="Default timeout in seconds of a task")
+    parser.add_argument("--failover", action="store_true", help="Fail over between the DPO and SFT endpoints when one keeps failing")
+    args = parser.parse_args()
+
+    if args.submit:
+        if not args.socket:
+            raise Exception("--submit needs --socket.")
+        finished = True
+        for result in submit(args.socket, [{"task": task} for task in args.tasks]):
+            print(json.dumps(result))
+            finished = finished and result.get("status") == "finished"
+        sys.exit(0 if finished else 1)
+
+    # Results are the only thing written to stdout, everything the tasks print goes to stderr.
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    from dotenv import load_dotenv
+    load_dotenv()
+    try:
+        asyncio.run(serve(args, output))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Display geometry of the device: the size of the current frame, its orientation and the screen density.
+The frame size is known from every capture for free; the physical size and density come from `wm` and
+are only queried again when a frame no longer matches them (e.g. a resolution override) or they are old.
+"""
+import re
+import subprocess
+import threading
+import time
+from typing import NamedTuple, Optional
+from utils import adb_command
+
+SIZE_PATTERN = re.compile(r"(Physical|Override) size:\s*(\d+)x(\d+)")
+DENSITY_PATTERN = re.compile(r"(Physical|Override) density:\s*(\d+)")
+
+
+class DisplayInfo(NamedTuple):
+    # Size of the frames in the current orientation, the space `input` coordinates are in.
+    width: int
+    height: int
+    # Size in the natural (rotation 0) orientation as reported by `wm size`.
+    physical_width: int
+    physical_height: int
+    density: Optional[int]
+    # Quarter turns from the natural orientation; 1 for any landscape frame of a portrait device.
+    rotation: int
+
+    @property
+    def orientation(self):
+        return "landscape" if self.width > self.height else "portrait"
+
+    def dp(self, pixels):
+        """
+        Pixels to density independent pixels (dp), pixels as is when the density is unknown.
+        """
+        return pixels * 160 / self.density if self.density else pixels
+
+
+def parse_wm_output(output, pattern):
+    """
+    Values reported by `wm size` / `wm density`, the override when there is one.
+    """
+    values = {match.group(1): match.groups()[1:] for match in pattern.finditer(output or "")}
+    return values.get("Override") or values.get("Physical")
+
+
+def query_display(adb_path, timeout=5):
+    """
+    (physical width, physical height, density) of the device, None for values that cannot be read.
+    """
+    values = []
+    for command, pattern in (("size", SIZE_PATTERN), ("density", DENSITY_PATTERN)):
+        try:
+            result = subprocess.run(adb_command(adb_path, "shell", "wm", command), capture_output=True, text=True, timeout=timeout)
+            values.append(parse_wm_output(result.stdout, pattern))
+        except Exception as e:
+            print(f"wm {command} failed: ", e)
+            values.append(None)
+    size, density = values
+    width, height = (int(size[0]), int(size[1])) if size else (None, None)
+    return width, height, int(density[0]) if density else None
+
+
+class DisplayTracker:
+    """
+    DisplayInfo of every captured frame. The `wm` values are cached, `query` (returning what
+    query_display returns) runs again only when a new frame size is neither the physical size nor its
+    rotation, or the values are older than `max_age` seconds.
+    """
+
+    def __init__(self, adb_path="adb", max_age=60.0, query=None):
+        self.query = query if query is not None else (lambda: query_display(adb_path))
+        self.max_age = max_age
+        self.physical = None
+        self.density = None
+        self.refreshed = None
+        self.refreshed_size = None
+        self.refreshes = 0
+        self.current = None
+        self.lock = threading.Lock()
+
+    def __stale__(self, width, height):
+        if self.refreshed is None or time.monotonic() - self.refreshed > self.max_age:
+            return True
+        if self.physical is None or (width, height) == self.refreshed_size:
+            return False
+        return (width, height) not in (self.physical, self.physical[::-1])
+
+    def update(self, frame_size):
+        """
+        DisplayInfo for a frame of `frame_size` (width, height).
+        """
+        width, height = frame_size
+        with self.lock:
+            if self.__stale__(width, height):
+                physical_width, physical_height, self.density = self.query()
+                self.physical = (physical_width, physical_height) if physical_width and physical_height else None
+                self.refreshed = time.monotonic()
+                self.refreshed_size = (width, height)
+                self.refreshes += 1
+            physical_width, physical_height = self.physical or (min(width, height), max(width, height))
+            rotation = 0 if (width > height) == (physical_width > physical_height) else 1
+            self.current = DisplayInfo(width, height, physical_width, physical_height, self.density, rotation)
+            return self.current
@@ -0,0 +1,107 @@
+"""
+Recorded episodes: the screens, model responses and actions of one task, for offline replay.
+
+    <episode>/episode.json  {"task": "...", "width": 1080, "height": 2400, "steps": [
+                                {"frame": "frames/0001.png", "response": "...", "actions": [...], "gestures": 1}, ...]}
+    <episode>/frames/       One PNG per step, the screen the model was shown.
+
+`gestures` is the number of `input` and `monkey` commands the step's actions send, fake_adb.py uses it to
+switch to the next frame once the replayed loop performed them.
+"""
+import json
+import os
+from typing import List, NamedTuple, Optional
+
+EPISODE_FILE = "episode.json"
+# Device commands counted as gestures, the ones fake_adb.py counts.
+GESTURE_COMMANDS = ("input", "monkey")
+
+
+def count_gestures(actions, shortcuts=None):
+    """
+    Gestures sent by a batch of action events up to the first finished action, counted on the commands
+    of ActionSpace.gesture_commands, with shortcuts expanded into their atomic actions.
+    """
+    from actions import ActionSpace
+    from adb_session import split_commands
+    from shortcuts import ShortcutError
+    space = ActionSpace(use_shell_session=False, wait_for_settle=False, shortcuts=shortcuts)
+    gestures = 0
+    for action in actions:
+        if action["type"] == "finished":
+            break
+        try:
+            if action["type"] == "shortcut":
+                shortcut, args = space.shortcuts.resolve(action)
+                gestures += count_gestures(shortcut.expand(args), space.shortcuts)
+                continue
+            command = space.gesture_commands([action])[0]
+        except ShortcutError:
+            # The batch stops at an invalid shortcut or package, see ActionSpace.execute_actions.
+            break
+        if command is not None:
+            gestures += sum(words[0] in GESTURE_COMMANDS for words in split_commands(command))
+    return gestures
+
+
+class EpisodeStep(NamedTuple):
+    frame: str
+    response: Optional[str]
+    actions: list
+    gestures: int
+
+
+class Episode:
+    def __init__(self, path, task=None, width=None, height=None, steps: List[EpisodeStep]=None):
+        self.path = path
+        self.task = task
+        self.width = width
+        self.height = height
+        self.steps = steps if steps is not None else []
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, EPISODE_FILE)) as f:
+            data = json.load(f)
+        steps = [EpisodeStep(step["frame"], step.get("response"), step.get("actions", []), step.get("gestures", 0)) for step in data["steps"]]
+        return cls(path, data.get("task"), data.get("width"), data.get("height"), steps)
+
+    def frame_path(self, index):
+        return os.path.join(self.path, self.steps[index].frame)
+
+    def responses(self):
+        return [step.response for step in self.steps if step.response is not None]
+
+    def frame_for_gestures(self, gestures):
+        """
+        Index of the step whose screen is shown after `gestures` input commands.
+        """
+        done = 0
+        for index, step in enumerate(self.steps):
+            done += step.gestures
+            if done > gestures:
+                return index
+        return len(self.steps) - 1
+
+    def add_step(self, image, response, actions):
+        """
+        Record a step: save the screen shown to the model, its response and the parsed action events.
+        """
+        os.makedirs(os.path.join(self.path, "frames"), exist_ok=True)
+        frame = f"frames/{len(self.steps) + 1:04d}.png"
+        image.save(os.path.join(self.path, frame), "PNG")
+        if self.width is None:
+            self.width, self.height = image.size
+        self.steps.append(EpisodeStep(frame, response, actions, count_gestures(actions)))
+        self.save()
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        data = {
+            "task": self.task,
+            "width": self.width,
+            "height": self.height,
+            "steps": [step._asdict() for step in self.steps],
+        }
+        with open(os.path.join(self.path, EPISODE_FILE), "w") as f:
+            json.dump(data, f, indent=1)
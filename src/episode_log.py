@@ -0,0 +1,309 @@
+"""
+Append-only log of the episodes run on a host. The frames of every step are written once into chunked
+blob files, content addressed so a frame seen before is not stored again, the step metadata (response,
+actions, timings) goes to an sqlite index. Readers get frames as memoryviews of the mmapped chunks.
+
+    <log>/index.sqlite        episodes, steps and the chunk, offset and length of every frame
+    <log>/chunks/000001.blob  frame bytes (as sent to the model), appended; full at `chunk_size`
+
+retain() bounds the disk usage: episodes older than max_age or beyond max_bytes of frames are dropped
+oldest first, chunks left without referenced frames are deleted and mostly unreferenced ones compacted.
+
+    python src/episode_log.py stats LOG
+    python src/episode_log.py export LOG EPISODE DIR      # episode.py directory, for replay
+    python src/episode_log.py retain LOG --max_bytes 20e9 --max_age_days 7
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+CHUNK_SIZE = 256 * 1024 * 1024
+
+
+class LoggedStep(NamedTuple):
+    episode: int
+    step: int
+    time: float
+    # Digest of the frame in the blob store, None for steps without a screen.
+    frame: Optional[bytes]
+    response: Optional[str]
+    actions: list
+    timings: dict
+
+
+def frame_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class EpisodeLog:
+    """
+    Thread safe, one writer per log directory.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(os.path.join(path, "chunks"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS frames (hash BLOB PRIMARY KEY, chunk INTEGER, offset INTEGER, length INTEGER, mime TEXT, width INTEGER, height INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS frames_chunk ON frames (chunk)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS episodes (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT, device TEXT, started REAL, status TEXT, steps INTEGER DEFAULT 0)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS steps (episode INTEGER, step INTEGER, time REAL, frame BLOB, response TEXT, actions TEXT, timings TEXT, "
+            "PRIMARY KEY (episode, step))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS steps_frame ON steps (frame)")
+        self.db.commit()
+        chunks = self.chunks()
+        self.chunk = chunks[-1] if chunks else 1
+        self.file = open(self.chunk_path(self.chunk), "ab")
+        self.maps = {}
+        self.deduplicated = 0
+
+    def chunk_path(self, chunk):
+        return os.path.join(self.path, "chunks", f"{chunk:06d}.blob")
+
+    def chunks(self):
+        return sorted(int(name.split(".")[0]) for name in os.listdir(os.path.join(self.path, "chunks")) if name.endswith(".blob"))
+
+    def __append__(self, data):
+        """
+        Append frame bytes to the current chunk, a new one is started when it would grow past chunk_size.
+        """
+        if self.file.tell() and self.file.tell() + len(data) > self.chunk_size:
+            self.file.close()
+            self.chunk += 1
+            self.file = open(self.chunk_path(self.chunk), "ab")
+        offset = self.file.tell()
+        self.file.write(data)
+        self.file.flush()
+        return self.chunk, offset
+
+    def put_frame(self, data, mime="image/jpeg", size=(None, None)):
+        """
+        Store encoded frame bytes unless they are stored already, returns their digest.
+        """
+        digest = frame_digest(data)
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM frames WHERE hash = ?", (digest,)).fetchone() is not None:
+                self.deduplicated += 1
+                return digest
+            chunk, offset = self.__append__(data)
+            self.db.execute("INSERT INTO frames VALUES (?, ?, ?, ?, ?, ?, ?)", (digest, chunk, offset, len(data), mime, *size))
+        return digest
+
+    def start_episode(self, task, device=None):
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO episodes (task, device, started) VALUES (?, ?, ?)", (task, device, time.time()))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def add_step(self, episode, frame_data, response, actions, timings=None, mime="image/jpeg", size=(None, None)):
+        """
+        Append a step of `episode`: the encoded frame the model was shown (or None), its response, the
+        parsed action events and the step timings in seconds. Returns the step index.
+        """
+        digest = self.put_frame(frame_data, mime, size) if frame_data is not None else None
+        with self.lock:
+            step = self.db.execute("SELECT steps FROM episodes WHERE id = ?", (episode,)).fetchone()[0]
+            self.db.execute(
+                "INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (episode, step, time.time(), digest, response, json.dumps(actions), json.dumps(timings or {})),
+            )
+            self.db.execute("UPDATE episodes SET steps = steps + 1 WHERE id = ?", (episode,))
+            self.db.commit()
+        return step
+
+    def finish_episode(self, episode, status):
+        with self.lock:
+            self.db.execute("UPDATE episodes SET status = ? WHERE id = ?", (status, episode))
+            self.db.commit()
+
+    def episodes(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, task, device, started, status, steps FROM episodes ORDER BY id").fetchall()
+        return [dict(zip(("id", "task", "device", "started", "status", "steps"), row)) for row in rows]
+
+    def steps(self, episode):
+        with self.lock:
+            rows = self.db.execute("SELECT episode, step, time, frame, response, actions, timings FROM steps WHERE episode = ? ORDER BY step", (episode,)).fetchall()
+        return [LoggedStep(*row[:5], json.loads(row[5]), json.loads(row[6])) for row in rows]
+
+    def frame(self, digest):
+        """
+        Frame bytes as a memoryview of the mmapped chunk, valid until the chunk is compacted away.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT chunk, offset, length FROM frames WHERE hash = ?", (digest,)).fetchone()
+            if row is None:
+                raise KeyError(digest.hex())
+            chunk, offset, length = row
+            mapped = self.maps.get(chunk)
+            if mapped is None or len(mapped) < offset + length:
+                # The current chunk grew since it was mapped. The old map is released with its last view.
+                with open(self.chunk_path(chunk), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[chunk] = mapped
+            return memoryview(mapped)[offset:offset + length]
+
+    def frame_mime(self, digest):
+        with self.lock:
+            return self.db.execute("SELECT mime FROM frames WHERE hash = ?", (digest,)).fetchone()[0]
+
+    def image(self, digest):
+        from PIL import Image
+        return Image.open(io.BytesIO(self.frame(digest)))
+
+    def image_url(self, digest):
+        """
+        Data URL of a frame, base64 encoded straight from the mapped chunk.
+        """
+        return f"data:{self.frame_mime(digest)};base64,{base64.b64encode(self.frame(digest)).decode('ascii')}"
+
+    def export(self, episode, path):
+        """
+        Write an episode as an episode.py directory (see fake_adb.py FAKE_ADB_EPISODE and stub_server.py).
+        """
+        from episode import Episode
+        task = next(row["task"] for row in self.episodes() if row["id"] == episode)
+        exported = Episode(path, task=task)
+        for step in self.steps(episode):
+            if step.frame is not None:
+                exported.add_step(self.image(step.frame), step.response, step.actions)
+        return exported
+
+    def __drop_episodes__(self, where, parameters=()):
+        ids = [row[0] for row in self.db.execute(f"SELECT id FROM episodes WHERE {where}", parameters)]
+        for episode in ids:
+            self.db.execute("DELETE FROM steps WHERE episode = ?", (episode,))
+            self.db.execute("DELETE FROM episodes WHERE id = ?", (episode,))
+        return len(ids)
+
+    def retain(self, max_bytes=None, max_age=None, compact_below=0.5):
+        """
+        Drop episodes older than max_age seconds, then the oldest finished ones while the referenced
+        frames take more than max_bytes. Chunks without referenced frames are deleted, the frames of
+        chunks with less than `compact_below` of their bytes referenced are moved to the current chunk.
+        On disk stays at most about max_bytes / compact_below plus one chunk.
+        """
+        freed = 0
+        with self.lock:
+            dropped = 0
+            if max_age is not None:
+                dropped += self.__drop_episodes__("started < ? AND status IS NOT NULL", (time.time() - max_age,))
+            self.db.execute("DELETE FROM frames WHERE hash NOT IN (SELECT frame FROM steps WHERE frame IS NOT NULL)")
+            if max_bytes is not None:
+                while True:
+                    total = self.db.execute("SELECT COALESCE(SUM(length), 0) FROM frames").fetchone()[0]
+                    if total <= max_bytes:
+                        break
+                    # Drop about half the share of episodes the excess corresponds to, then measure again.
+                    finished = self.db.execute("SELECT COUNT(*) FROM episodes WHERE status IS NOT NULL").fetchone()[0]
+                    count = max(1, int(finished * (total - max_bytes) / total / 2))
+                    removed = self.__drop_episodes__("id IN (SELECT id FROM episodes WHERE status IS NOT NULL ORDER BY id LIMIT ?)", (count,))
+                    if not removed:
+                        break
+                    dropped += removed
+                    self.db.execute("DELETE FROM frames WHERE hash NOT IN (SELECT frame FROM steps WHERE frame IS NOT NULL)")
+            self.db.commit()
+            compacted = 0
+            for chunk in self.chunks():
+                if chunk == self.chunk:
+                    continue
+                size = os.path.getsize(self.chunk_path(chunk))
+                live = self.db.execute("SELECT COALESCE(SUM(length), 0) FROM frames WHERE chunk = ?", (chunk,)).fetchone()[0]
+                if live and live >= compact_below * size:
+                    continue
+                rows = self.db.execute("SELECT hash, offset, length FROM frames WHERE chunk = ?", (chunk,)).fetchall()
+                if rows:
+                    with open(self.chunk_path(chunk), "rb") as f:
+                        for digest, offset, length in rows:
+                            f.seek(offset)
+                            new_chunk, new_offset = self.__append__(f.read(length))
+                            self.db.execute("UPDATE frames SET chunk = ?, offset = ? WHERE hash = ?", (new_chunk, new_offset, digest))
+                    self.db.commit()
+                    compacted += 1
+                self.maps.pop(chunk, None)
+                os.remove(self.chunk_path(chunk))
+                freed += size - live
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {"dropped_episodes": dropped, "compacted_chunks": compacted, "freed_bytes": freed}
+
+    def stats(self):
+        with self.lock:
+            episodes, steps = self.db.execute("SELECT COUNT(*), COALESCE(SUM(steps), 0) FROM episodes").fetchone()
+            frames, frame_bytes = self.db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM frames").fetchone()
+            framed_steps, logged_bytes = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(frames.length), 0) FROM steps JOIN frames ON steps.frame = frames.hash"
+            ).fetchone()
+        chunks = self.chunks()
+        return {
+            "episodes": episodes,
+            "steps": steps,
+            "frames": frames,
+            "frame_bytes": frame_bytes,
+            # Bytes the frames of all steps would take without deduplication.
+            "logged_bytes": logged_bytes,
+            "dedup_ratio": round(logged_bytes / frame_bytes, 2) if frame_bytes else 0.0,
+            "framed_steps": framed_steps,
+            "chunks": len(chunks),
+            "disk_bytes": sum(os.path.getsize(self.chunk_path(chunk)) for chunk in chunks) + os.path.getsize(os.path.join(self.path, "index.sqlite")),
+        }
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+                self.file.close()
+                self.maps = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect, export and trim an episode log.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stats_parser = subparsers.add_parser("stats", help="Episodes, steps, frames and disk usage.")
+    stats_parser.add_argument("log")
+    list_parser = subparsers.add_parser("list", help="Logged episodes.")
+    list_parser.add_argument("log")
+    export_parser = subparsers.add_parser("export", help="Write an episode as an episode.py directory for replay.")
+    export_parser.add_argument("log")
+    export_parser.add_argument("episode", type=int)
+    export_parser.add_argument("directory")
+    retain_parser = subparsers.add_parser("retain", help="Drop old episodes and reclaim their disk space.")
+    retain_parser.add_argument("log")
+    retain_parser.add_argument("--max_bytes", type=float, default=None, help="Frame bytes kept at most")
+    retain_parser.add_argument("--max_age_days", type=float, default=None, help="Age in days of the oldest episode kept")
+    args = parser.parse_args()
+
+    log = EpisodeLog(args.log)
+    try:
+        if args.command == "stats":
+            print(json.dumps(log.stats(), indent=2))
+        elif args.command == "list":
+            for episode in log.episodes():
+                print(json.dumps(episode))
+        elif args.command == "export":
+            exported = log.export(args.episode, args.directory)
+            print(f"Exported {len(exported.steps)} steps to {exported.path}")
+        elif args.command == "retain":
+            max_age = args.max_age_days * 24 * 3600 if args.max_age_days is not None else None
+            print(json.dumps(log.retain(max_bytes=args.max_bytes, max_age=max_age)))
+    finally:
+        log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""
+Offline evaluation of model configurations over recorded episodes (see episode.py), to choose between the
+DPO and SFT endpoints and the layers in front of them on accuracy, latency and cost without a device.
+
+    python src/evaluate.py episodes/ --configs dpo,sft,dpo+cache --concurrency 4 --report eval.json
+
+Every recorded step with a response is a case: the screen the model was shown and the actions taken on
+it. The conversation up to a step is rebuilt from the recording, the recorded responses stand in for the
+model's so every configuration sees the same context. Predicted actions match when they have the same
+types and arguments and their points are within `tolerance` of the recorded ones on the 1000x1000 grid.
+
+A configuration is a model with optional layers, e.g. "sft+cache+gateway":
+- cache:   a ResponseCache of its own (see response_cache.py), repeated screens skip the request.
+- gateway: requests go through an InferenceGateway (see gateway.py), identical ones are sent once.
+Every configuration replays the episodes with `concurrency` workers of its own, all configurations at
+the same time; frames are encoded once in worker threads and shared between them. Endpoints default to
+HF_DPO_ENDPOINT and HF_SFT_ENDPOINT, --dpo_endpoint / --sft_endpoint point them at stub_server.py or a
+local server. Cost comes from the usage of the responses (see utils.track_usage), priced with
+--prompt_price / --completion_price for models track_usage has no price for.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from typing import NamedTuple, Optional
+import httpx
+from PIL import Image
+from action_parser import ActionParseError, parse_actions
+from actions import ACTION_POINTS
+from constants import HF_TARS_BASE_ENDPOINT, HF_TARS_DPO_ENDPOINT
+from episode import EPISODE_FILE, Episode
+from history import ConversationHistory
+from image_pipeline import ImageEncodeConfig, preprocess_screenshot
+from inference_client import InferenceClient, RetryPolicy
+from main import AFTER_ACTION_TEXT, INITIAL_SCREEN_TEXT, screen_message
+from response_cache import ResponseCache
+from tars import AsyncTARS, MessageDict, TextMessageContent
+from tracing import Tracer, percentile
+from utils import get_image_url
+
+LAYERS = ("cache", "gateway")
+
+
+class EvalConfig(NamedTuple):
+    name: str
+    llm_type: str
+    layers: tuple
+
+    @classmethod
+    def parse(cls, name):
+        llm_type, *layers = name.strip().split("+")
+        if llm_type not in ("dpo", "sft"):
+            raise Exception(f"Unknown model '{llm_type}' in configuration '{name}', expected dpo or sft.")
+        for layer in layers:
+            if layer not in LAYERS:
+                raise Exception(f"Unknown layer '{layer}' in configuration '{name}', expected one of {', '.join(LAYERS)}.")
+        return cls(name.strip(), llm_type, tuple(layers))
+
+
+class StepResult(NamedTuple):
+    config: str
+    episode: str
+    step: int
+    latency: float
+    match: bool
+    type_match: bool
+    # Largest distance between a predicted and a recorded point on the 1000x1000 grid, None without points.
+    distance: Optional[float]
+    error: Optional[str]
+
+
+def load_episodes(paths):
+    """
+    Episodes at the given paths, or in their subdirectories.
+    """
+    episodes = []
+    for path in paths:
+        if os.path.exists(os.path.join(path, EPISODE_FILE)):
+            episodes.append(Episode.load(path))
+            continue
+        for name in sorted(os.listdir(path)):
+            if os.path.exists(os.path.join(path, name, EPISODE_FILE)):
+                episodes.append(Episode.load(os.path.join(path, name)))
+    if not episodes:
+        raise Exception(f"No recorded episodes in {', '.join(paths)}.")
+    return episodes
+
+
+def action_matches(predicted, expected, tolerance):
+    """
+    (match, distance) of a predicted action event against the recorded one.
+    """
+    if predicted["type"] != expected["type"]:
+        return False, None
+    distances = [
+        math.hypot(predicted[x] - expected[x], predicted[y] - expected[y])
+        for x, y in ACTION_POINTS.get(expected["type"], ())
+        if x in predicted and x in expected
+    ]
+    distance = max(distances) if distances else None
+    if distance is not None and distance > tolerance:
+        return False, distance
+    if expected["type"] == "shortcut":
+        return predicted["name"] == expected["name"] and predicted["args"] == expected["args"], distance
+    return predicted.get("content", "").strip() == expected.get("content", "").strip(), distance
+
+
+def score(response, expected, tolerance):
+    """
+    (match, type_match, distance, error) of a response against the recorded action events. The step
+    matches when every action does, type_match only compares the type of the first action.
+    """
+    if response is None:
+        return False, False, None, "no response"
+    try:
+        predicted = [action.to_event() for action in parse_actions(response)]
+    except ActionParseError as e:
+        return False, False, None, e.message
+    type_match = bool(predicted) and bool(expected) and predicted[0]["type"] == expected[0]["type"]
+    match = len(predicted) == len(expected)
+    distance = None
+    for action, recorded in zip(predicted, expected):
+        matches, action_distance = action_matches(action, recorded, tolerance)
+        match = match and matches
+        if action_distance is not None:
+            distance = max(distance or 0.0, action_distance)
+    return match, type_match, distance, None
+
+
+class FrameCache:
+    """
+    Data URLs of the episode frames, encoded once in a worker thread and dropped after the last
+    configuration used them.
+    """
+
+    def __init__(self, encode_config, users):
+        self.encode_config = encode_config
+        self.users = users
+        self.frames = {}
+
+    def __encode__(self, path):
+        with Image.open(path) as image:
+            frame = preprocess_screenshot(image.convert("RGB"), self.encode_config, log=False)
+        return get_image_url(frame.data, frame.mime_type)
+
+    async def get(self, path):
+        if path not in self.frames:
+            self.frames[path] = [asyncio.ensure_future(asyncio.to_thread(self.__encode__, path)), self.users]
+        entry = self.frames[path]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.frames[path]
+        return await entry[0]
+
+
+class UsageSink:
+    """
+    Tracer sink keeping the "usage" events of the responses (see tars.TARS.__track_usage__) per configuration.
+    """
+
+    def __init__(self):
+        self.usage = {}
+
+    def write(self, record):
+        if record["type"] == "event" and record["name"] == "usage":
+            self.usage.setdefault(record["attributes"]["config"], []).append(record["attributes"])
+
+    def close(self):
+        pass
+
+
+async def replay(config, episode, inference_client, response_cache, frames, tolerance, tracer):
+    """
+    Ask the model of a configuration for every recorded step of an episode, returns a StepResult per step.
+    """
+    agent = AsyncTARS(episode.task, "default", inference_client=inference_client, response_cache=response_cache, tracer=tracer)
+    history = ConversationHistory()
+    results = []
+    for index, step in enumerate(episode.steps):
+        if step.response is None:
+            continue
+        url = await frames.get(episode.frame_path(index))
+        history.append(screen_message(AFTER_ACTION_TEXT if results else INITIAL_SCREEN_TEXT, url))
+        start = time.monotonic()
+        error = None
+        try:
+            response = await agent.inference(history.messages())
+        except Exception as e:
+            response, error = None, str(e)
+        latency = time.monotonic() - start
+        match, type_match, distance, parse_error = score(response, step.actions, tolerance)
+        results.append(StepResult(config.name, episode.path, index, latency, match, type_match, distance, error or parse_error))
+        history.append(MessageDict(role="assistant", content=[TextMessageContent(type="text", text=step.response)]))
+    return results
+
+
+async def run_config(config, episodes, endpoints, frames, concurrency, tolerance, request_timeout, http_client, tracer, api_key=None):
+    """
+    Replay all episodes with one configuration, `concurrency` episodes at a time.
+    Returns (step results, layer statistics, seconds from the first request to the last response).
+    """
+    client = InferenceClient([(config.llm_type, endpoints[config.llm_type])], api_key=api_key or os.getenv("HF_API_KEY"), retry_policy=RetryPolicy(request_timeout=request_timeout), failover=False, http_client=http_client)
+    response_cache = ResponseCache() if "cache" in config.layers else None
+    gateway = None
+    if "gateway" in config.layers:
+        from gateway import InferenceGateway
+        gateway = InferenceGateway(client, max_concurrent=concurrency)
+    queue = list(episodes)
+    results = []
+
+    async def worker(index):
+        while queue:
+            episode = queue.pop(0)
+            session = gateway.session(f"worker-{index}") if gateway is not None else client
+            results.extend(await replay(config, episode, session, response_cache, frames, tolerance, tracer))
+
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    finally:
+        if gateway is not None:
+            await gateway.aclose()
+        await client.aclose()
+    elapsed = time.monotonic() - start
+    stats = {}
+    if response_cache is not None:
+        stats["cache"] = response_cache.stats()
+    if gateway is not None:
+        stats["gateway"] = {key: value for key, value in gateway.stats().items() if key in ("requests", "upstream", "coalesced")}
+    return results, stats, elapsed
+
+
+def summarize(config, results, stats, elapsed, usage, prompt_price=None, completion_price=None):
+    """
+    Accuracy, latency, throughput and cost of one configuration.
+    """
+    latencies = [result.latency for result in results]
+    distances = [result.distance for result in results if result.distance is not None]
+    prompt_tokens = sum(record.get("prompt_tokens") or 0 for record in usage)
+    completion_tokens = sum(record.get("completion_tokens") or 0 for record in usage)
+    cost = 0.0
+    for record in usage:
+        if record.get("prompt_token_price") is not None:
+            cost += record["prompt_token_price"] + record["completion_token_price"]
+        elif prompt_price is not None and completion_price is not None:
+            cost += ((record.get("prompt_tokens") or 0) * prompt_price + (record.get("completion_tokens") or 0) * completion_price) / 1000000
+        else:
+            cost = None
+            break
+    steps = len(results)
+    return {
+        "config": config.name,
+        "steps": steps,
+        "accuracy": sum(result.match for result in results) / steps if steps else 0.0,
+        "type_accuracy": sum(result.type_match for result in results) / steps if steps else 0.0,
+        "distance_p50": percentile(distances, 0.5),
+        "distance_p95": percentile(distances, 0.95),
+        "errors": sum(result.error is not None for result in results),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "steps_per_second": steps / elapsed if elapsed else None,
+        "requests": len(usage),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost": cost,
+        "cost_per_step": cost / steps if cost is not None and steps else None,
+        **stats,
+    }
+
+
+async def evaluate(episodes, configs, endpoints, concurrency=4, tolerance=30, request_timeout=120, encode_config=None, prompt_price=None, completion_price=None, api_key=None):
+    """
+    Evaluate all configurations over the episodes at the same time. Returns (summaries, step results).
+    api_key defaults to HF_API_KEY; stub and local endpoints accept any key.
+    """
+    encode_config = encode_config if encode_config is not None else ImageEncodeConfig.from_env()
+    frames = FrameCache(encode_config, len(configs))
+    sink = UsageSink()
+    tracer = Tracer(sink)
+    limits = httpx.Limits(max_connections=concurrency * len(configs), max_keepalive_connections=concurrency * len(configs))
+    async with httpx.AsyncClient(limits=limits, timeout=request_timeout) as http_client:
+        outcomes = await asyncio.gather(*(
+            run_config(config, episodes, endpoints, frames, concurrency, tolerance, request_timeout, http_client, tracer.child(config=config.name), api_key)
+            for config in configs
+        ))
+    summaries = []
+    steps = []
+    for config, (results, stats, elapsed) in zip(configs, outcomes):
+        summaries.append(summarize(config, results, stats, elapsed, sink.usage.get(config.name, []), prompt_price, completion_price))
+        steps.extend(results)
+    return summaries, steps
+
+
+def print_report(summaries):
+    def milliseconds(value):
+        return f"{value * 1000:7.0f}" if value is not None else f"{'-':>7}"
+
+    print(f"{'config':<20} {'steps':>6} {'acc':>6} {'type':>6} {'dist50':>7} {'p50 ms':>7} {'p95 ms':>7} {'steps/s':>8} {'tokens':>9} {'cost':>9}")
+    for summary in summaries:
+        distance = f"{summary['distance_p50']:7.1f}" if summary["distance_p50"] is not None else f"{'-':>7}"
+        cost = f"{summary['cost']:9.4f}" if summary["cost"] is not None else f"{'-':>9}"
+        print(
+            f"{summary['config']:<20} {summary['steps']:>6} {summary['accuracy']:6.1%} {summary['type_accuracy']:6.1%} {distance}"
+            f" {milliseconds(summary['latency_p50'])} {milliseconds(summary['latency_p95'])} {summary['steps_per_second'] or 0:8.2f}"
+            f" {summary['prompt_tokens'] + summary['completion_tokens']:>9} {cost}"
+        )
+        layers = {key: summary[key] for key in LAYERS if key in summary}
+        if layers or summary["errors"]:
+            print(f"{'':<20} errors={summary['errors']} {json.dumps(layers) if layers else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate DPO and SFT model configurations over recorded episodes.")
+    parser.add_argument("episodes", type=str, nargs="+", help="Episode directories (see --record), or directories of them")
+    parser.add_argument("--configs", type=str, default="dpo,sft", help="Comma separated configurations: dpo or sft, with +cache and/or +gateway layers")
+    parser.add_argument("--concurrency", type=int, default=4, help="Episodes replayed at once per configuration")
+    parser.add_argument("--tolerance", type=float, default=30, help="Distance on the 1000x1000 grid within which a predicted point matches")
+    parser.add_argument("--dpo_endpoint", type=str, default=HF_TARS_DPO_ENDPOINT, help="Endpoint of the DPO model, e.g. a local stub_server.py")
+    parser.add_argument("--sft_endpoint", type=str, default=HF_TARS_BASE_ENDPOINT, help="Endpoint of the SFT model")
+    parser.add_argument("--request_timeout", type=float, default=120, help="Timeout in seconds of a single model request")
+    parser.add_argument("--api_key", type=str, default=None, help="API key of the endpoints, defaults to HF_API_KEY (any value for stub or local endpoints)")
+    parser.add_argument("--prompt_price", type=float, default=None, help="USD per million prompt tokens, for models without a known price")
+    parser.add_argument("--completion_price", type=float, default=None, help="USD per million completion tokens, for models without a known price")
+    parser.add_argument("--report", type=str, default=None, help="Write the summaries and per step results to this JSON file")
+    args = parser.parse_args()
+
+    configs = [EvalConfig.parse(name) for name in args.configs.split(",") if name.strip()]
+    episodes = load_episodes(args.episodes)
+    print(f"Evaluating {', '.join(config.name for config in configs)} on {sum(len(episode.responses()) for episode in episodes)} steps of {len(episodes)} episodes.")
+    summaries, steps = asyncio.run(evaluate(
+        episodes,
+        configs,
+        {"dpo": args.dpo_endpoint, "sft": args.sft_endpoint},
+        concurrency=args.concurrency,
+        tolerance=args.tolerance,
+        request_timeout=args.request_timeout,
+        prompt_price=args.prompt_price,
+        completion_price=args.completion_price,
+        api_key=args.api_key,
+    ))
+    print_report(summaries)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"summaries": summaries, "steps": [step._asdict() for step in steps]}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
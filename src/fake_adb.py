@@ -0,0 +1,269 @@
+"""
+Minimal stand-in for the `adb` binary, used by benchmarks so they can run without a device.
+
+Use it as the adb_path: f"{sys.executable} src/fake_adb.py"
+Configured through environment variables:
+    FAKE_ADB_FRAME: PNG file served as the current screen.
+    FAKE_ADB_ROOT:  Host directory that plays the role of the device filesystem.
+    FAKE_ADB_LOG:   File where every received command line and gesture is appended.
+    FAKE_ADB_HIERARCHY: uiautomator dump XML served by `uiautomator dump`.
+    FAKE_ADB_EPISODE: Recorded episode directory (see episode.py), its frames are served in order, the
+                    next one once the gestures of the current step were received.
+    FAKE_ADB_DEVICE: Virtual device script (see virtual_device.py), or "default" for DEFAULT_SCRIPT. Its
+                    screens are rendered and its UI hierarchy served, gestures move between them and are
+                    appended to <device root>/gestures.jsonl; the screen is kept in virtual_state.json.
+    FAKE_ADB_TRANSITION: Seconds the screen slides in from the right after a gesture.
+    FAKE_ADB_PROGRESS: When set, an indeterminate progress bar pulses along the bottom edge, so the
+                    screen never settles while its content stays put.
+With `-s <serial>` the device root is FAKE_ADB_ROOT/<serial>, which may hold its own frame.png.
+`adb shell` without arguments starts an interactive host shell with fake `input` and `monkey` commands.
+"""
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+
+
+SERIAL = None
+
+
+def device_root():
+    root = os.getenv("FAKE_ADB_ROOT", ".")
+    return os.path.join(root, SERIAL) if SERIAL else root
+
+
+def device_path(path):
+    return os.path.join(device_root(), path.lstrip("/"))
+
+
+def gestures_received():
+    try:
+        with open(device_path("gestures")) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def frame_path():
+    episode_path = os.getenv("FAKE_ADB_EPISODE")
+    if episode_path:
+        from episode import Episode
+        episode = Episode.load(episode_path)
+        return episode.frame_path(episode.frame_for_gestures(gestures_received()))
+    path = os.path.join(device_root(), "frame.png")
+    return path if SERIAL and os.path.exists(path) else os.environ["FAKE_ADB_FRAME"]
+
+
+def virtual_device():
+    from virtual_device import VirtualDevice, load_script
+    path = os.environ["FAKE_ADB_DEVICE"]
+    state = None
+    if os.path.exists(device_path("virtual_state.json")):
+        with open(device_path("virtual_state.json")) as f:
+            state = json.load(f)
+    return VirtualDevice(None if path == "default" else load_script(path), state)
+
+
+def run_on_virtual_device(command):
+    """
+    Run a shell command on the virtual device and persist its screen and new gestures.
+    """
+    device = virtual_device()
+    code, output = device.run(command)
+    os.makedirs(device_root(), exist_ok=True)
+    with open(device_path("virtual_state.json"), "w") as f:
+        json.dump(device.state(), f)
+    if device.gestures:
+        with open(device_path("gestures.jsonl"), "a") as f:
+            for gesture in device.gestures:
+                f.write(json.dumps(gesture._asdict()) + "\n")
+        with open(device_path("gestures"), "w") as f:
+            f.write(f"{gestures_received() + len(device.gestures)}\n")
+    sys.stdout.write(output)
+    return code
+
+
+def log_command(args):
+    log_file = os.getenv("FAKE_ADB_LOG")
+    if log_file:
+        with open(log_file, "a") as f:
+            f.write((f"{SERIAL}: " if SERIAL else "") + " ".join(args) + "\n")
+
+
+def animating():
+    if os.getenv("FAKE_ADB_PROGRESS"):
+        return True
+    transition = float(os.getenv("FAKE_ADB_TRANSITION") or 0)
+    try:
+        return transition > 0 and time.time() - os.path.getmtime(device_path("gestures")) < transition
+    except FileNotFoundError:
+        return False
+
+
+def animate(image):
+    """
+    The frame as served at this moment with FAKE_ADB_TRANSITION and FAKE_ADB_PROGRESS.
+    """
+    from PIL import Image, ImageDraw
+    image = image.convert("RGB")
+    transition = float(os.getenv("FAKE_ADB_TRANSITION") or 0)
+    elapsed = time.time() - os.path.getmtime(device_path("gestures")) if os.path.exists(device_path("gestures")) else transition
+    if elapsed < transition:
+        canvas = Image.new("RGB", image.size, "#808080")
+        canvas.paste(image, (round(image.width * (1 - elapsed / transition)), 0))
+        image = canvas
+    if os.getenv("FAKE_ADB_PROGRESS"):
+        bar = round(image.height * 0.02)
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, image.height - bar, image.width, image.height), fill="#000000" if int(time.time() * 10) % 2 else "#ffffff")
+    return image
+
+
+def read_frame():
+    if os.getenv("FAKE_ADB_DEVICE") or animating():
+        import io
+        from PIL import Image
+        image = virtual_device().screenshot() if os.getenv("FAKE_ADB_DEVICE") else Image.open(frame_path())
+        data = io.BytesIO()
+        (animate(image) if animating() else image).save(data, "PNG")
+        return data.getvalue()
+    with open(frame_path(), "rb") as f:
+        return f.read()
+
+
+def read_raw_frame():
+    """
+    Raw `screencap` output: width, height, format and colorspace as little endian int32, then RGBA pixels.
+    """
+    from PIL import Image
+    image = virtual_device().screenshot() if os.getenv("FAKE_ADB_DEVICE") else Image.open(frame_path())
+    if animating():
+        image = animate(image)
+    image = image.convert("RGBA")
+    width, height = image.size
+    header = b"".join(value.to_bytes(4, "little") for value in (width, height, 1, 0))
+    return header + image.tobytes()
+
+
+def interactive_shell():
+    """
+    Replace this process with a host `sh` whose PATH has fake `input` and `monkey` commands that log and count gestures,
+    and a `pm` that reports every package as installed.
+    On a virtual device `input`, `pm` and `monkey` run on it instead.
+    """
+    if os.getenv("FAKE_ADB_DEVICE"):
+        bin_dir = device_path("virtual_bin")
+        os.makedirs(bin_dir, exist_ok=True)
+        serial = f"-s {SERIAL} " if SERIAL else ""
+        for name in ("input", "pm", "monkey"):
+            script = os.path.join(bin_dir, name)
+            with open(script, "w") as f:
+                f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" {serial}shell {name} "$@"\n')
+            os.chmod(script, 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        os.execvp("sh", ["sh"])
+    bin_dir = device_path("fake_bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    for name in ("input", "monkey"):
+        script = os.path.join(bin_dir, name)
+        if os.path.exists(script):
+            continue
+        with open(script, "w") as f:
+            prefix = f"{SERIAL}: " if SERIAL else ""
+            f.write(
+                "#!/bin/sh\n"
+                f'[ -n "$FAKE_ADB_LOG" ] && echo "{prefix}shell {name} $*" >> "$FAKE_ADB_LOG"\n'
+                f'count=$(cat "{device_path("gestures")}" 2>/dev/null || echo 0)\n'
+                f'echo $((count + 1)) > "{device_path("gestures")}"\n'
+                "exit 0\n"
+            )
+        os.chmod(script, 0o755)
+    # Every package counts as installed, like `pm path` over a single command.
+    pm_script = os.path.join(bin_dir, "pm")
+    if not os.path.exists(pm_script):
+        with open(pm_script, "w") as f:
+            f.write("#!/bin/sh\nexit 0\n")
+        os.chmod(pm_script, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.execvp("sh", ["sh"])
+
+
+def shell(args):
+    if not args:
+        interactive_shell()
+    if len(args) == 1 and ";" in args[0]:
+        # A command line of several commands, run one after the other like the device shell does.
+        from adb_session import split_commands
+        code = 0
+        for words in split_commands(args[0]):
+            code = shell(words)
+        return code
+    if len(args) == 1:
+        # A command string, which adb hands to the device shell as it is.
+        args = shlex.split(args[0])
+    if os.getenv("FAKE_ADB_DEVICE") and args[:2] != ["screencap", "-p"]:
+        return run_on_virtual_device(" ".join(shlex.quote(arg) for arg in args))
+    if args[:2] == ["wm", "size"]:
+        from PIL import Image
+        with Image.open(frame_path()) as image:
+            width, height = image.size
+        print(f"Physical size: {min(width, height)}x{max(width, height)}")
+        return 0
+    if args[:2] == ["wm", "density"]:
+        print("Physical density: 420")
+        return 0
+    if args[:2] == ["screencap", "-p"] and len(args) > 2:
+        path = device_path(args[2])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(read_frame())
+    elif args[:1] in (["input"], ["monkey"]):
+        count = gestures_received() + 1
+        os.makedirs(device_root(), exist_ok=True)
+        with open(device_path("gestures"), "w") as f:
+            f.write(f"{count}\n")
+    elif args[:1] == ["rm"] and len(args) > 1:
+        path = device_path(args[-1])
+        if os.path.exists(path):
+            os.remove(path)
+    return 0
+
+
+def main(argv):
+    global SERIAL
+    if argv[:1] == ["-s"]:
+        SERIAL = argv[1]
+        argv = argv[2:]
+    log_command(argv)
+    if not argv:
+        return 1
+    if argv == ["get-state"]:
+        print("device")
+        return 0
+    if argv[:3] == ["exec-out", "screencap", "-p"]:
+        sys.stdout.buffer.write(read_frame())
+        return 0
+    if argv[:2] == ["exec-out", "screencap"]:
+        sys.stdout.buffer.write(read_raw_frame())
+        return 0
+    if argv[:4] == ["exec-out", "uiautomator", "dump", "/dev/tty"] and os.getenv("FAKE_ADB_DEVICE"):
+        sys.stdout.write(virtual_device().hierarchy_xml())
+        sys.stdout.write("UI hierchary dumped to: /dev/tty\n")
+        return 0
+    if argv[:4] == ["exec-out", "uiautomator", "dump", "/dev/tty"] and os.getenv("FAKE_ADB_HIERARCHY"):
+        with open(os.environ["FAKE_ADB_HIERARCHY"], "rb") as f:
+            sys.stdout.buffer.write(f.read())
+        sys.stdout.buffer.write(b"UI hierchary dumped to: /dev/tty\n")
+        return 0
+    if argv[0] == "shell":
+        return shell(argv[1:])
+    if argv[0] == "pull" and len(argv) == 3:
+        shutil.copyfile(device_path(argv[1]), argv[2])
+        return 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import httpx
+from dotenv import load_dotenv
+from main import run_task_async, print_endpoint_metrics
+from tars import create_inference_client
+from inference_client import RetryPolicy
+from response_cache import ResponseCache
+from tracing import Tracer, JsonlSink
+from trajectory_cache import TrajectoryStore
+
+load_dotenv()
+
+
+async def run_fleet(
+    serials,
+    tasks,
+    max_concurrency=None,
+    llm_type="dpo",
+    max_itr=10,
+    adb_path=None,
+    response_cache=None,
+    request_timeout=None,
+    task_timeout=None,
+    failover=False,
+    tracer=None,
+    trajectory_store=None,
+    change_detection=False,
+    gateway=False,
+    max_concurrent_requests=4,
+    tokens_per_minute=None,
+    episode_log=None,
+):
+    """
+    Run a queue of tasks over several devices from one process.
+    Every device takes the next task from the queue when it is done with the previous one, at most
+    `max_concurrency` sessions run at once. All sessions share one inference client, so one HTTP
+    connection pool, circuit breakers and latency histograms per endpoint.
+    Spans of all tasks are recorded on tracer, tagged with the device serial.
+    A shared trajectory_store lets a device replay what another one learned for the same instruction.
+    With change_detection, every task compares its captures with a ChangeDetector of its own.
+    With gateway, the sessions submit to one InferenceGateway instead (micro-batches, fair turns between
+    devices, identical requests merged) with max_concurrent_requests and tokens_per_minute per endpoint.
+    A shared episode_log (see episode_log.py) gets the steps of every task, tagged with the device serial.
+    Returns one result dict per task.
+    """
+    adb_path = adb_path or os.getenv("ADB_PATH", "adb")
+    if change_detection:
+        from change_detection import ChangeDetector
+    if gateway:
+        from gateway import InferenceGateway
+    max_concurrency = max_concurrency or len(serials)
+    queue = asyncio.Queue()
+    for task in tasks:
+        queue.put_nowait(task)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = []
+    tracer = tracer if tracer is not None else Tracer()
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=request_timeout) as http_client:
+        inference_client = create_inference_client(
+            llm_type,
+            failover=failover,
+            retry_policy=RetryPolicy(request_timeout=request_timeout),
+            http_client=http_client,
+        )
+        inference_gateway = InferenceGateway(inference_client, max_concurrent=max_concurrent_requests, tokens_per_minute=tokens_per_minute, tracer=tracer) if gateway else None
+
+        async def device_worker(serial):
+            while True:
+                try:
+                    task = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                async with semaphore:
+                    print(f"[{serial}] Starting task: {task}")
+                    start = time.monotonic()
+                    result = {"device": serial, "task": task}
+                    try:
+                        outcome = await asyncio.wait_for(
+                            run_task_async(
+                                task,
+                                max_itr=max_itr,
+                                llm_type=llm_type,
+                                response_cache=response_cache,
+                                adb_path=f"{adb_path} -s {serial}",
+                                inference_client=inference_gateway.session(serial) if inference_gateway is not None else inference_client,
+                                tracer=tracer.child(device=serial),
+                                trajectory_store=trajectory_store,
+                                change_detector=ChangeDetector() if change_detection else None,
+                                episode_log=episode_log,
+                            ),
+                            timeout=task_timeout,
+                        )
+                        result.update(outcome)
+                    except asyncio.TimeoutError:
+                        result["status"] = "timeout"
+                    except Exception as e:
+                        result["status"] = "error"
+                        result["error"] = str(e)
+                    result["duration"] = time.monotonic() - start
+                    print(f"[{serial}] {result['status']} in {result['duration']:.1f}s: {task}")
+                    results.append(result)
+
+        await asyncio.gather(*(device_worker(serial) for serial in serials))
+        if inference_gateway is not None:
+            inference_gateway.print_stats()
+            await inference_gateway.aclose()
+        print_endpoint_metrics(inference_client)
+        tracer.print_summary()
+        await inference_client.aclose()
+    return results
+
+
+def summarize(results):
+    """
+    Per device task counts, finished tasks and total busy time.
+    """
+    summary = {}
+    for result in results:
+        device = summary.setdefault(result["device"], {"tasks": 0, "finished": 0, "busy_time": 0.0})
+        device["tasks"] += 1
+        device["finished"] += result["status"] == "finished"
+        device["busy_time"] += result["duration"]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a queue of TARS tasks over several devices concurrently.")
+    parser.add_argument("tasks", type=str, nargs="*", help="Task queries")
+    parser.add_argument("--devices", type=str, required=True, help="Comma separated adb device serials")
+    parser.add_argument("--tasks_file", type=str, default=None, help="File with one task query per line")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="Maximum number of concurrent sessions, defaults to the number of devices")
+    parser.add_argument("--llm_type", type=str, default="dpo", help="dpo/sft: DPO-trained llm or SFT-trained llm")
+    parser.add_argument("--max_itr", type=int, default=10, help="Maximum number of iterations per task")
+    parser.add_argument("--response_cache", type=str, default=None, help="Shared response cache: 'memory' or a sqlite file path")
+    parser.add_argument("--request_timeout", type=float, default=120, help="Timeout in seconds of a single model request")
+    parser.add_argument("--task_timeout", type=float, default=None, help="Timeout in seconds of a single task")
+    parser.add_argument("--failover", action="store_true", help="Fail over between the DPO and SFT endpoints when one keeps failing")
+    parser.add_argument("--results", type=str, default=None, help="Write per task results to this JSONL file")
+    parser.add_argument("--trajectory_cache", type=str, default=None, help="Shared trajectory cache: 'memory' or a sqlite file path")
+    parser.add_argument("--trace", type=str, default=None, help="Write timed spans of every step to this JSONL file")
+    parser.add_argument("--change_detection", action="store_true", help="Do not re-send or re-ask about screens that did not change since the last one sent")
+    parser.add_argument("--gateway", action="store_true", help="Submit the requests of all sessions through one batching gateway with fair queuing")
+    parser.add_argument("--max_concurrent_requests", type=int, default=4, help="With --gateway, requests in flight per endpoint at most")
+    parser.add_argument("--tokens_per_minute", type=int, default=None, help="With --gateway, token rate limit per endpoint (prompt estimate + max_tokens)")
+    parser.add_argument("--episode_log", type=str, default=None, help="Append the steps of all tasks to the episode log in this directory")
+    parser.add_argument("--episode_retention_bytes", type=float, default=None, help="With --episode_log, frame bytes kept at the end of the run (oldest episodes dropped)")
+    args = parser.parse_args()
+
+    tasks = list(args.tasks)
+    if args.tasks_file:
+        with open(args.tasks_file) as f:
+            tasks.extend(line.strip() for line in f if line.strip())
+    if not tasks:
+        raise Exception("No tasks provided.")
+    serials = [serial.strip() for serial in args.devices.split(",") if serial.strip()]
+    response_cache = None
+    if args.response_cache:
+        response_cache = ResponseCache(path=None if args.response_cache == "memory" else args.response_cache)
+    trajectory_store = None
+    if args.trajectory_cache:
+        trajectory_store = TrajectoryStore(path=None if args.trajectory_cache == "memory" else args.trajectory_cache)
+    episode_log = None
+    if args.episode_log:
+        from episode_log import EpisodeLog
+        episode_log = EpisodeLog(args.episode_log)
+    sink = JsonlSink(args.trace) if args.trace else None
+    try:
+        results = asyncio.run(
+            run_fleet(
+                serials,
+                tasks,
+                max_concurrency=args.max_concurrency,
+                llm_type=args.llm_type,
+                max_itr=args.max_itr,
+                response_cache=response_cache,
+                request_timeout=args.request_timeout,
+                task_timeout=args.task_timeout,
+                failover=args.failover,
+                tracer=Tracer(sink),
+                trajectory_store=trajectory_store,
+                change_detection=args.change_detection,
+                gateway=args.gateway,
+                max_concurrent_requests=args.max_concurrent_requests,
+                tokens_per_minute=args.tokens_per_minute,
+                episode_log=episode_log,
+            )
+        )
+    finally:
+        if episode_log is not None:
+            if args.episode_retention_bytes is not None:
+                print("Episode log retention: ", episode_log.retain(max_bytes=args.episode_retention_bytes))
+            print("Episode log: ", episode_log.stats())
+            episode_log.close()
+        if trajectory_store is not None:
+            trajectory_store.close()
+        if sink is not None:
+            sink.close()
+        if response_cache is not None:
+            response_cache.close()
+    if args.results:
+        with open(args.results, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    print(json.dumps(summarize(results), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Inference gateway shared by many sessions in one process, in front of an InferenceClient.
+
+- Requests arriving within `window` seconds are dispatched together as a micro-batch, sessions take
+  turns (round robin) so one busy session does not starve the others.
+- Identical deterministic requests (temperature 0, same messages and arguments) in flight at the same
+  time are sent once and answered together. Requests of a batch are sent grouped by their system
+  prompt, so the endpoint sees identical prefixes back to back and can reuse its prefix cache.
+- Every endpoint admits at most `max_concurrent` requests and, with `tokens_per_minute`, an estimate
+  of prompt + max_tokens per request from a token bucket.
+
+    gateway = InferenceGateway(create_inference_client("dpo"), max_concurrent=4)
+    agent = AsyncTARS(task, "default", inference_client=gateway.session("emulator-5554"))
+
+Queue waits, admission waits and batch sizes are reported by stats(). Streamed requests take their
+turn like the others but are never merged, their admission ends when the stream starts.
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from prompt import estimate_tokens
+from tracing import percentile
+
+
+class TokenBucket:
+    """
+    Token rate limit. A request larger than `capacity` waits for a full bucket and leaves it in debt.
+    """
+
+    def __init__(self, tokens_per_minute, capacity=None):
+        self.rate = tokens_per_minute / 60
+        self.capacity = capacity if capacity is not None else tokens_per_minute / 6
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def __refill__(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens):
+        while True:
+            self.__refill__()
+            needed = min(tokens, self.capacity)
+            if self.level >= needed:
+                self.level -= tokens
+                return
+            await asyncio.sleep((needed - self.level) / self.rate)
+
+
+class EndpointLimiter:
+    def __init__(self, max_concurrent, tokens_per_minute=None):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.tokens = 0
+
+    @asynccontextmanager
+    async def admit(self, tokens, waits):
+        started = time.monotonic()
+        async with self.semaphore:
+            if self.bucket is not None:
+                await self.bucket.acquire(tokens)
+            waits.append(time.monotonic() - started)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.tokens += tokens
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+
+
+class GatewayRequest:
+    def __init__(self, session, kwargs, future, key=None):
+        self.session = session
+        self.kwargs = kwargs
+        self.future = future
+        self.submitted = time.monotonic()
+        # request_key of the request, None when it is never shared.
+        self.key = key
+        self.prefix = prefix_key(kwargs)
+        # Callers waiting for the response, the request is dropped once all of them gave up.
+        self.waiters = 0
+        self.task = None
+
+
+def request_key(kwargs):
+    """
+    Digest of a request that may share its response with identical ones, None otherwise.
+    """
+    if kwargs.get("stream") or kwargs.get("temperature", 1.0) != 0:
+        return None
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def prefix_key(kwargs):
+    messages = kwargs.get("messages") or []
+    if not messages or messages[0]["role"] != "system":
+        return ""
+    return hashlib.sha1(json.dumps(messages[0]["content"], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def request_tokens(kwargs):
+    """
+    Tokens a request is charged for: the estimated prompt plus its max_tokens.
+    """
+    messages = kwargs.get("messages") or []
+    return sum(estimate_tokens(message) for message in messages) + (kwargs.get("max_tokens") or 0)
+
+
+class GatewaySession:
+    """
+    What one session uses as its inference_client (see tars.TARS).
+    """
+
+    def __init__(self, gateway, name):
+        self.gateway = gateway
+        self.name = name
+
+    async def acreate(self, **kwargs):
+        return await self.gateway.submit(self.name, kwargs)
+
+    def metrics(self):
+        return self.gateway.client.metrics()
+
+    async def aclose(self):
+        pass
+
+
+class InferenceGateway:
+    """
+    client:            InferenceClient the requests are sent with (retries, breakers, failover).
+    window:            Seconds requests are collected before a batch is dispatched.
+    max_batch:         Requests per batch at most.
+    max_concurrent:    Requests in flight per endpoint at most.
+    tokens_per_minute: Token rate limit per endpoint, None for no limit.
+    """
+
+    def __init__(self, client, window=0.02, max_batch=8, max_concurrent=4, tokens_per_minute=None, tracer=None):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.max_concurrent = max_concurrent
+        self.tokens_per_minute = tokens_per_minute
+        self.tracer = tracer
+        self.limiters = {}
+        # Upstream requests the dispatcher keeps in flight, more would only queue on the endpoint limiters.
+        self.capacity = max_concurrent * (len(client.endpoints) if client.failover else 1)
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.in_flight = 0
+        # Queued or in flight GatewayRequest per request key, identical requests wait for it.
+        self.shared = {}
+        self.prefixes = set()
+        self.changed = asyncio.Event()
+        self.runner = None
+        self.requests = 0
+        self.upstream = 0
+        self.coalesced = 0
+        self.prefix_reuse = 0
+        self.batch_sizes = []
+        self.queue_waits = []
+        self.admission_waits = []
+        self.sessions = {}
+
+    def session(self, name):
+        return GatewaySession(self, name)
+
+    def limiter(self, endpoint):
+        if endpoint.name not in self.limiters:
+            self.limiters[endpoint.name] = EndpointLimiter(self.max_concurrent, self.tokens_per_minute)
+        return self.limiters[endpoint.name]
+
+    async def submit(self, session, kwargs):
+        if self.runner is None or self.runner.done():
+            self.runner = asyncio.ensure_future(self.__run__())
+        self.requests += 1
+        self.sessions[session] = self.sessions.get(session, 0) + 1
+        key = request_key(kwargs)
+        if key is not None and key in self.shared:
+            # The same request is queued or in flight already, wait for its response.
+            self.coalesced += 1
+            return await self.__wait__(self.shared[key])
+        request = GatewayRequest(session, kwargs, asyncio.get_running_loop().create_future(), key)
+        self.queues.setdefault(session, deque()).append(request)
+        self.queued += 1
+        if request.key is not None:
+            self.shared[request.key] = request
+        self.changed.set()
+        return await self.__wait__(request)
+
+    async def __wait__(self, request):
+        request.waiters += 1
+        try:
+            return await asyncio.shield(request.future)
+        finally:
+            request.waiters -= 1
+            if not request.waiters and not request.future.done() and request.task is not None:
+                request.task.cancel()
+
+    def __release__(self, request):
+        if request.key is not None and self.shared.get(request.key) is request:
+            del self.shared[request.key]
+
+    def __next_batch__(self, size):
+        """
+        Up to `size` queued requests, one per session in turn.
+        """
+        batch = []
+        while self.queues and len(batch) < size:
+            session, queue = next(iter(self.queues.items()))
+            request = queue.popleft()
+            self.queued -= 1
+            del self.queues[session]
+            if queue:
+                self.queues[session] = queue
+            if request.waiters:
+                batch.append(request)
+            else:
+                request.future.cancel()
+                self.__release__(request)
+        return batch
+
+    async def __run__(self):
+        while True:
+            while not self.queued:
+                self.changed.clear()
+                await self.changed.wait()
+            if self.window:
+                await asyncio.sleep(self.window)
+            while self.in_flight >= self.capacity:
+                self.changed.clear()
+                await self.changed.wait()
+            batch = self.__next_batch__(min(self.max_batch, self.capacity - self.in_flight))
+            if not batch:
+                continue
+            self.batch_sizes.append(len(batch))
+            # Requests with the same prefix go out back to back, already seen prefixes first.
+            batch.sort(key=lambda request: (request.prefix not in self.prefixes, request.prefix))
+            for request in batch:
+                self.prefix_reuse += request.prefix in self.prefixes
+                self.prefixes.add(request.prefix)
+                self.in_flight += 1
+                request.task = asyncio.ensure_future(self.__send__(request))
+
+    async def __send__(self, request):
+        wait = time.monotonic() - request.submitted
+        self.queue_waits.append(wait)
+        if self.tracer is not None:
+            self.tracer.record("gateway_wait", wait, session=request.session)
+        try:
+            tokens = request_tokens(request.kwargs)
+            self.upstream += 1
+            response = await self.client.acreate(admission=lambda endpoint: self.limiter(endpoint).admit(tokens, self.admission_waits), **request.kwargs)
+            if not request.future.done():
+                request.future.set_result(response)
+        except asyncio.CancelledError:
+            request.future.cancel()
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            self.__release__(request)
+            self.in_flight -= 1
+            self.changed.set()
+
+    def stats(self):
+        def milliseconds(values, q):
+            value = percentile(values, q)
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            "requests": self.requests,
+            "upstream": self.upstream,
+            "coalesced": self.coalesced,
+            "prefix_reuse": self.prefix_reuse,
+            "batches": len(self.batch_sizes),
+            "batch_mean": round(sum(self.batch_sizes) / len(self.batch_sizes), 2) if self.batch_sizes else 0,
+            "batch_max": max(self.batch_sizes, default=0),
+            "queue_wait_p50_ms": milliseconds(self.queue_waits, 0.5),
+            "queue_wait_p95_ms": milliseconds(self.queue_waits, 0.95),
+            "admission_wait_p95_ms": milliseconds(self.admission_waits, 0.95),
+            "endpoints": {name: {"max_in_flight": limiter.max_in_flight, "tokens": limiter.tokens} for name, limiter in self.limiters.items()},
+            "sessions": dict(self.sessions),
+        }
+
+    def print_stats(self):
+        print("Gateway: ", json.dumps(self.stats()))
+
+    async def aclose(self):
+        if self.runner is not None:
+            self.runner.cancel()
+            try:
+                await self.runner
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,120 @@
+import copy
+from collections import deque
+from typing import List
+from tars import MessageDict, TextMessageContent
+from prompt import estimate_tokens
+
+
+def summarize_response(text, max_length=200):
+    """
+    Text only summary of an assistant turn: its Action part, or the beginning of the response.
+    """
+    index = text.rfind("Action:")
+    summary = text[index + len("Action:"):] if index != -1 else text
+    summary = " ".join(summary.split())
+    return summary[:max_length]
+
+
+class ConversationHistory:
+    """
+    Messages of one task with a bounded footprint.
+    - Only the last `max_images` screenshots are kept, older image payloads are dropped as soon as they
+      fall out of that window.
+    - At most `max_turns` user/assistant turns are sent, older assistant turns survive as a one line
+      action summary (the last `max_summary_actions` of them).
+    - The estimated tokens of the window stay below `max_tokens`.
+    Appending is O(1) amortized and the window always starts with a user message. A user message appended
+    right after another one (the request in between failed) replaces it, so roles keep alternating.
+    """
+
+    def __init__(self, max_images=2, max_turns=1, max_tokens=None, max_summary_actions=20):
+        self.max_images = max_images
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.window = deque()
+        self.window_tokens = 0
+        self.image_messages = deque()
+        self.summary = deque(maxlen=max_summary_actions)
+
+    def __len__(self):
+        return len(self.window)
+
+    def append(self, message: MessageDict):
+        if type(message["content"]) != list:
+            message["content"] = [message["content"]]
+        if message["role"] == "user" and self.window and self.window[-1][0]["role"] == "user":
+            self.__replace_last__()
+        tokens = estimate_tokens(message)
+        self.window.append((message, tokens))
+        self.window_tokens += tokens
+        if any(content["type"] == "image_url" for content in message["content"]):
+            self.image_messages.append(message)
+            while len(self.image_messages) > self.max_images:
+                self.__drop_images__(self.image_messages.popleft())
+        while self.__over_budget__():
+            self.__evict__()
+        while self.window and self.window[0][0]["role"] != "user":
+            self.__evict__()
+
+    def image_count(self):
+        """
+        Screenshots still in the window.
+        """
+        return len(self.image_messages)
+
+    def __over_budget__(self):
+        if len(self.window) <= 1:
+            return False
+        if len(self.window) > 2 * self.max_turns + 1:
+            return True
+        return self.max_tokens is not None and self.window_tokens > self.max_tokens
+
+    def __drop_images__(self, message: MessageDict):
+        # The message is replaced by a copy, stored messages are never changed (see preview).
+        text_only = MessageDict(role=message["role"], content=[content for content in message["content"] if content["type"] != "image_url"])
+        for index in range(len(self.window) - 1, -1, -1):
+            if self.window[index][0] is message:
+                tokens = estimate_tokens(text_only)
+                self.window_tokens += tokens - self.window[index][1]
+                self.window[index] = (text_only, tokens)
+                break
+
+    def __replace_last__(self):
+        message, tokens = self.window.pop()
+        self.window_tokens -= tokens
+        if self.image_messages and self.image_messages[-1] is message:
+            self.image_messages.pop()
+
+    def __evict__(self):
+        message, tokens = self.window.popleft()
+        self.window_tokens -= tokens
+        if self.image_messages and self.image_messages[0] is message:
+            self.image_messages.popleft()
+        if message["role"] == "assistant":
+            self.summary.append(summarize_response("".join(content.get("text", "") for content in message["content"])))
+
+    def preview(self, message: MessageDict) -> List[MessageDict]:
+        """
+        Messages that would be sent after appending `message`, without appending it. Appending only
+        replaces stored messages, so copies of the deques share them and the screenshots they hold.
+        """
+        history = copy.copy(self)
+        history.window = deque(self.window)
+        history.image_messages = deque(self.image_messages)
+        history.summary = deque(self.summary, maxlen=self.summary.maxlen)
+        history.append(dict(message))
+        return history.messages()
+
+    def messages(self) -> List[MessageDict]:
+        """
+        Messages to send: the bounded window, with the summary of older actions prepended to the first user message.
+        """
+        messages = [message for message, _ in self.window]
+        if self.summary and messages:
+            actions = "\n".join(f"{index + 1}. {action}" for index, action in enumerate(self.summary))
+            first = messages[0]
+            messages[0] = MessageDict(
+                role=first["role"],
+                content=[TextMessageContent(type="text", text=f"Previous actions:\n{actions}"), *first["content"]],
+            )
+        return messages
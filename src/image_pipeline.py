@@ -0,0 +1,69 @@
+import os
+import time
+from typing import NamedTuple, Optional, Tuple
+from PIL import Image
+from utils import encode_screenshot
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+class ImageEncodeConfig(NamedTuple):
+    """
+    max_side:    Longest side of the encoded frame in pixels, None keeps the device resolution.
+    format:      JPEG, WEBP or PNG.
+    quality:     Encoder quality for JPEG/WEBP.
+    grayscale:   Drop color information.
+    crop_top:    Fraction of the screen height removed at the top (status bar).
+    crop_bottom: Fraction of the screen height removed at the bottom (navigation bar).
+    """
+    max_side: Optional[int] = 1280
+    format: str = "JPEG"
+    quality: int = 75
+    grayscale: bool = False
+    crop_top: float = 0.0
+    crop_bottom: float = 0.0
+
+    @classmethod
+    def from_env(cls):
+        max_side = os.getenv("SCREENSHOT_MAX_SIDE", "1280")
+        return cls(
+            max_side=int(max_side) if max_side and max_side != "0" else None,
+            format=os.getenv("SCREENSHOT_FORMAT", "JPEG").upper(),
+            quality=int(os.getenv("SCREENSHOT_QUALITY", "75")),
+            grayscale=os.getenv("SCREENSHOT_GRAYSCALE", "false").lower() in ("1", "true", "yes"),
+            crop_top=float(os.getenv("SCREENSHOT_CROP_TOP", "0")),
+            crop_bottom=float(os.getenv("SCREENSHOT_CROP_BOTTOM", "0")),
+        )
+
+
+class EncodedFrame(NamedTuple):
+    data: bytes
+    mime_type: str
+    size: Tuple[int, int]
+    source_size: Tuple[int, int]
+    encode_time: float
+
+
+def crop_box(width, height, crop_top=0.0, crop_bottom=0.0):
+    return (0, round(height * crop_top), width, height - round(height * crop_bottom))
+
+
+def preprocess_screenshot(image, config=ImageEncodeConfig(), log=True):
+    """
+    Crop, downscale, convert and encode a screenshot for the model.
+    Coordinates predicted by the model are relative to the cropped area, see ActionSpace crop_top/crop_bottom.
+    """
+    start = time.perf_counter()
+    source_size = image.size
+    if config.crop_top or config.crop_bottom:
+        image = image.crop(crop_box(*image.size, config.crop_top, config.crop_bottom))
+    if config.max_side is not None and max(image.size) > config.max_side:
+        scale = config.max_side / max(image.size)
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+    image = image.convert("L" if config.grayscale else "RGB")
+    save_kwargs = {} if config.format == "PNG" else {"quality": config.quality}
+    data = encode_screenshot(image, config.format, **save_kwargs)
+    encode_time = time.perf_counter() - start
+    if log:
+        print(f"Encoded frame {source_size[0]}x{source_size[1]} -> {image.width}x{image.height} {config.format}: {len(data)} bytes in {encode_time*1000:.1f}ms")
+    return EncodedFrame(data, MIME_TYPES[config.format], image.size, source_size, encode_time)
@@ -0,0 +1,345 @@
+import asyncio
+import bisect
+import contextlib
+import random
+import threading
+import time
+from typing import NamedTuple, Optional
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+CONTEXT_OVERFLOW_HINTS = ("context length", "context_length", "maximum context", "too many tokens", "input validation error", "max_total_tokens")
+
+
+class InferenceError(Exception):
+    """
+    kind is one of: rate_limit, timeout, connection, server, context_overflow, client, unavailable, deadline,
+    unknown (an API error of no other kind) or internal (not an API error, e.g. a missing api_key or a bug in
+    the request, raised right away).
+    """
+    def __init__(self, kind, message, endpoint=None):
+        self.kind = kind
+        self.endpoint = endpoint
+        super().__init__(f"{kind}: {message}" + (f" ({endpoint})" if endpoint else ""))
+
+
+RETRYABLE_ERRORS = {"rate_limit", "timeout", "connection", "server", "unknown"}
+# Errors that say something about the health of the endpoint and count towards opening its circuit breaker.
+BREAKER_ERRORS = {"timeout", "connection", "server"}
+
+
+def classify_error(error):
+    if isinstance(error, InferenceError):
+        return error.kind
+    # openai is imported on first use, it dominates the startup time of the CLI.
+    import openai
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code >= 500:
+            return "server"
+        if any(hint in str(error).lower() for hint in CONTEXT_OVERFLOW_HINTS):
+            return "context_overflow"
+        return "client"
+    if isinstance(error, openai.APIError):
+        return "unknown"
+    return "internal"
+
+
+def retry_after(error):
+    """
+    Seconds requested by a Retry-After header, if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(NamedTuple):
+    """
+    Jittered exponential backoff ("full jitter") bounded by an overall deadline per request.
+    """
+    max_attempts: int = 6
+    base_delay: float = 1.0
+    max_delay: float = 20.0
+    deadline: float = 180.0
+    request_timeout: Optional[float] = 120.0
+
+    def delay(self, attempt, error=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        requested = retry_after(error) if error is not None else None
+        return max(delay, min(requested, self.max_delay)) if requested is not None else delay
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures; once `reset_timeout` seconds passed a single
+    trial request is let through (half open), which closes the breaker again on success.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release(self):
+        """
+        End an attempt that says nothing about the endpoint (cancelled, or failed before it was sent),
+        so a half open breaker lets the next trial through.
+        """
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+            self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), self.counts)},
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class Endpoint:
+    def __init__(self, name, url, api_key, breaker, http_client=None):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.breaker = breaker
+        self.http_client = http_client
+        self.latency = LatencyHistogram()
+        self.errors = {}
+        self._sync_client = None
+        self._async_client = None
+
+    @property
+    def sync_client(self):
+        if self._sync_client is None:
+            from openai import OpenAI
+            self._sync_client = OpenAI(base_url=self.url, api_key=self.api_key, max_retries=0)
+        return self._sync_client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(base_url=self.url, api_key=self.api_key, max_retries=0, http_client=self.http_client)
+        return self._async_client
+
+    async def aclose(self):
+        if self._async_client is not None and self.http_client is None:
+            await self._async_client.close()
+        if self._sync_client is not None:
+            self._sync_client.close()
+
+
+class InferenceClient:
+    """
+    Chat completion client over one or more OpenAI compatible endpoints, in priority order.
+    Failed requests are retried with jittered exponential backoff until the policy deadline; errors that
+    can not succeed on retry (bad request, context overflow) are raised right away as InferenceError.
+    Every endpoint has a circuit breaker; with failover, a retry goes to the next healthy endpoint.
+    """
+
+    def __init__(self, endpoints, api_key=None, retry_policy=RetryPolicy(), failover=True, http_client=None, failure_threshold=5, reset_timeout=30.0):
+        self.endpoints = [
+            Endpoint(name, url, api_key, CircuitBreaker(failure_threshold, reset_timeout), http_client=http_client)
+            for name, url in endpoints
+        ]
+        self.retry_policy = retry_policy
+        self.failover = failover
+
+    def __select__(self, last_failed):
+        """
+        First endpoint whose breaker lets the request through, preferring one that did not fail last.
+        """
+        candidates = self.endpoints if self.failover else self.endpoints[:1]
+        if last_failed is not None and len(candidates) > 1:
+            candidates = [endpoint for endpoint in candidates if endpoint is not last_failed] + [last_failed]
+        for endpoint in candidates:
+            if endpoint.breaker.allow():
+                return endpoint
+        return None
+
+    def __record__(self, endpoint, started, error=None):
+        endpoint.latency.observe(time.monotonic() - started)
+        if error is None:
+            endpoint.breaker.record_success()
+            return None
+        kind = classify_error(error)
+        endpoint.errors[kind] = endpoint.errors.get(kind, 0) + 1
+        if kind == "internal":
+            endpoint.breaker.release()
+        elif kind in BREAKER_ERRORS:
+            endpoint.breaker.record_failure()
+        else:
+            # The endpoint answered, so it is healthy even though the request failed.
+            endpoint.breaker.record_success()
+        return kind
+
+    def __next_delay__(self, attempt, deadline, error, kind, endpoint):
+        """
+        Seconds to sleep before the next attempt, raises InferenceError when it should not be retried.
+        """
+        if kind not in RETRYABLE_ERRORS:
+            raise InferenceError(kind, str(error), endpoint.name) from error
+        if attempt + 1 >= self.retry_policy.max_attempts:
+            raise InferenceError(kind, f"failed after {attempt + 1} attempts: {error}", endpoint.name) from error
+        delay = self.retry_policy.delay(attempt, error)
+        if time.monotonic() + delay >= deadline:
+            raise InferenceError("deadline", f"deadline of {self.retry_policy.deadline}s exceeded: {error}", endpoint.name) from error
+        print(f"{kind} error from {endpoint.name}, retrying in {delay:.1f}s...")
+        return delay
+
+    def create(self, **kwargs):
+        deadline = time.monotonic() + self.retry_policy.deadline
+        last_failed = None
+        for attempt in range(self.retry_policy.max_attempts):
+            endpoint = self.__select__(last_failed)
+            if endpoint is None:
+                raise InferenceError("unavailable", "all endpoint circuit breakers are open")
+            started = time.monotonic()
+            try:
+                response = endpoint.sync_client.chat.completions.create(timeout=self.__timeout__(deadline), **kwargs)
+            except Exception as e:
+                kind = self.__record__(endpoint, started, e)
+                last_failed = endpoint
+                time.sleep(self.__next_delay__(attempt, deadline, e, kind, endpoint))
+                continue
+            except BaseException:
+                endpoint.breaker.release()
+                raise
+            self.__record__(endpoint, started)
+            return response
+
+    async def acreate(self, admission=None, **kwargs):
+        """
+        admission(endpoint), when given, returns an async context manager every attempt is sent in, e.g.
+        the concurrency and token rate limits of gateway.InferenceGateway.
+        """
+        deadline = time.monotonic() + self.retry_policy.deadline
+        last_failed = None
+        for attempt in range(self.retry_policy.max_attempts):
+            endpoint = self.__select__(last_failed)
+            if endpoint is None:
+                raise InferenceError("unavailable", "all endpoint circuit breakers are open")
+            started = time.monotonic()
+            try:
+                async with admission(endpoint) if admission is not None else contextlib.nullcontext():
+                    started = time.monotonic()
+                    response = await endpoint.async_client.chat.completions.create(timeout=self.__timeout__(deadline), **kwargs)
+            except asyncio.CancelledError:
+                endpoint.breaker.release()
+                raise
+            except Exception as e:
+                kind = self.__record__(endpoint, started, e)
+                last_failed = endpoint
+                await asyncio.sleep(self.__next_delay__(attempt, deadline, e, kind, endpoint))
+                continue
+            self.__record__(endpoint, started)
+            return response
+
+    def __timeout__(self, deadline):
+        remaining = max(deadline - time.monotonic(), 0.1)
+        if self.retry_policy.request_timeout is None:
+            return remaining
+        return min(self.retry_policy.request_timeout, remaining)
+
+    def metrics(self):
+        return {
+            endpoint.name: {
+                "url": endpoint.url,
+                "breaker": endpoint.breaker.state,
+                "errors": dict(endpoint.errors),
+                "latency": endpoint.latency.to_dict(),
+            }
+            for endpoint in self.endpoints
+        }
+
+    def prometheus(self):
+        """
+        Latency histograms in the Prometheus text exposition format.
+        """
+        lines = ["# TYPE tars_inference_latency_seconds histogram"]
+        for endpoint in self.endpoints:
+            histogram = endpoint.latency
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'tars_inference_latency_seconds_bucket{{endpoint="{endpoint.name}",le="{bound}"}} {cumulative}')
+            lines.append(f'tars_inference_latency_seconds_sum{{endpoint="{endpoint.name}"}} {histogram.total}')
+            lines.append(f'tars_inference_latency_seconds_count{{endpoint="{endpoint.name}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    async def aclose(self):
+        for endpoint in self.endpoints:
+            await endpoint.aclose()
@@ -1,118 +1,471 @@
+import asyncio
 import os
 import time
-from PIL import Image
+import uuid
 from dotenv import load_dotenv
 from tars import (
-    TARS,
+    AsyncTARS,
     MessageDict,
     TextMessageContent,
     ImageMessageContent,
     ImageURLDict,
 )
-from utils import get_image_url, get_screenshot, extract_action
+from utils import get_image_url, capture_screenshot_async, device_state
+from image_pipeline import ImageEncodeConfig, preprocess_screenshot
+from action_parser import parse_actions, ActionParseError
 from actions import ActionSpace
+from response_cache import ResponseCache, perceptual_hash, hamming_distance
+from trajectory_cache import TrajectoryStore, TrajectoryStep
+from history import ConversationHistory
+from tracing import Tracer, JsonlSink
+from episode import Episode
+from ui_hierarchy import dump_ui_hierarchy_async, simple_target
+from display import DisplayTracker
+from speculation import Speculator
 import argparse
 
 
 load_dotenv()
 
+INITIAL_SCREEN_TEXT = "Here is the initial state of the screen'."
+AFTER_ACTION_TEXT = "Here is the screen after last execution of previous action suggested"
 
-def run_task_with_user_plan(user_plan, max_itr=20, llm_type="dpo"):
+
+def screen_message(text, image_url=None):
+    content = [TextMessageContent(type="text", text=text)]
+    if image_url is not None:
+        content.append(
+            ImageMessageContent(
+                type="image_url",
+                image_url=ImageURLDict(url=image_url),
+            )
+        )
+    return MessageDict(role="user", content=content)
+
+
+async def capture_frame(adb_path, encode_config, tracer=None, detector=None):
+    """
+    Capture and encode a screenshot. Returns (screenshot, frame, change): with a detector the screenshot
+    is first compared with the last frame shown to the model and is not encoded when it did not change
+    (frame is None), without a detector change is None.
+    """
+    tracer = tracer if tracer is not None else Tracer()
+    with tracer.span("capture"):
+        screenshot = await capture_screenshot_async(adb_path=adb_path)
+    if screenshot is None:
+        raise Exception("Failed to capture screenshot.")
+    change = None
+    if detector is not None:
+        with tracer.span("diff"):
+            change = await asyncio.to_thread(detector.compare, screenshot)
+        if not change.changed:
+            return screenshot, None, change
+    frame = await encode_frame(screenshot, encode_config, tracer)
+    return screenshot, frame, change
+
+
+async def encode_frame(screenshot, encode_config, tracer):
+    frame = await asyncio.to_thread(preprocess_screenshot, screenshot, encode_config)
+    tracer.record("encode", frame.encode_time, size=len(frame.data))
+    return frame
+
+
+async def speculative_request(agent, messages, tracer):
+    with tracer.span("speculative_request"):
+        return await agent.inference(messages)
+
+
+async def speculate(agent, speculator, history, adb_path, encode_config, base_phash, tracer, interval=0.2):
+    """
+    While the actions of a step execute, start requests for the next step on captured frames that held
+    still for one interval, differ from the screen the actions were taken on and are not speculated on yet.
+    """
+    previous = None
+    while True:
+        await asyncio.sleep(interval)
+        screenshot = await capture_screenshot_async(adb_path=adb_path, max_retry=1)
+        if screenshot is None:
+            continue
+        phash = perceptual_hash(screenshot)
+        stable = previous is not None and hamming_distance(phash, previous) <= speculator.max_distance
+        previous = phash
+        if not stable or hamming_distance(phash, base_phash) <= speculator.max_distance or speculator.covers(phash):
+            continue
+        frame = await encode_frame(screenshot, encode_config, tracer)
+        message = screen_message(AFTER_ACTION_TEXT, get_image_url(frame.data, frame.mime_type))
+        print("Speculative request started on an intermediate frame.")
+        speculator.start(phash, message, speculative_request(agent, history.preview(message), tracer))
+
+
+async def log_step(episode_log, episode, screenshot, frame, response, actions, timings, encode_config, tracer):
+    """
+    Append a step to the episode log with the frame as sent to the model; screens that were not sent
+    again (unchanged, speculated) are encoded here.
+    """
+    if frame is None:
+        frame = await encode_frame(screenshot, encode_config, tracer)
+    with tracer.span("log"):
+        await asyncio.to_thread(episode_log.add_step, episode, frame.data, response, actions, timings, frame.mime_type, frame.size)
+
+
+async def dump_hierarchy(adb_path, tracer):
+    with tracer.span("hierarchy"):
+        return await dump_ui_hierarchy_async(adb_path)
+
+
+def print_endpoint_metrics(inference_client):
+    for name, metrics in inference_client.metrics().items():
+        if metrics["latency"]["count"]:
+            print(f"Endpoint {name}: breaker={metrics['breaker']} errors={metrics['errors']} requests={metrics['latency']['count']} p50<={metrics['latency']['p50']}s p95<={metrics['latency']['p95']}s")
+
+
+async def cancel_task(task):
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+
+
+async def run_task_async(user_plan, max_itr=20, llm_type="dpo", response_cache=None, adb_path=None, http_client=None, request_timeout=None, history=None, failover=False, inference_client=None, stream=False, tracer=None, record=None, ui_fast_path=False, snap_distance=None, trajectory_store=None, change_detector=None, max_static_waits=2, action_space=None, display_tracker=None, speculative=False, max_speculative=1, episode_log=None, max_prompt_tokens=None, plan_every=None):
+    """
+    Run one task on one device. Returns {"status": "finished" | "max_iterations", "steps": <iterations>}.
+    With stream, actions start executing as soon as the Action section of the response is complete.
+    Every stage of every step is traced as a span on tracer (see tracing.Tracer), tagged with the task
+    id and step; without a tracer the per stage summary is printed at the end of the task.
+    With record, the screens, responses and actions are saved as an episode in that directory (see episode.py).
+    With episode_log, every step is appended to that EpisodeLog instead, with its model and step time
+    (see episode_log.py).
+    With ui_fast_path, a "tap <label>" task is resolved from the UI hierarchy without asking the model
+    once the element is on screen. With snap_distance, clicks are snapped onto clickable elements at
+    most that many pixels away (see ui_hierarchy.py).
+    With trajectory_store, a stored trajectory of the same instruction is replayed while the screens
+    match, and the steps of a successful run are stored (see trajectory_cache.py).
+    With change_detector, every capture is compared with the last screen sent to the model (see
+    change_detection.py). An unchanged screen is not sent again: after a wait the loop waits again
+    without asking the model, up to max_static_waits times, otherwise the model is told in text that
+    the last action did not change the screen.
+    With speculative, requests for the next step start on intermediate frames while the actions execute
+    and the screen settles, at most max_speculative at once; one whose frame matches the settled screen
+    is used instead of a new request (see speculation.py).
+    With max_prompt_tokens, every request is trimmed to about that many tokens, images of older
+    messages first (see prompt.PromptAssembler).
+    With plan_every, the manager prompt asks for a plan and subgoal on the first screen and every
+    plan_every steps after it, they are sent with every request; invalid actions and actions that did
+    not change the screen are shown to it as failed attempts.
+    A resident process (see daemon.py) passes its action_space and display_tracker to keep the adb
+    shell session and the display values across tasks; they are not closed at the end of the task.
+    """
     if not user_plan:
         raise Exception("User plan is not provided.")
-    agent = TARS(base_type=llm_type if llm_type else "dpo", system_name="default", user_instruction=user_plan)
-    messages = []
+    owns_tracer = tracer is None
+    tracer = (tracer if tracer is not None else Tracer()).child(task_id=uuid.uuid4().hex[:12])
+    agent = AsyncTARS(
+        base_type=llm_type if llm_type else "dpo",
+        system_name="default",
+        user_instruction=user_plan,
+        response_cache=response_cache,
+        http_client=http_client,
+        request_timeout=request_timeout,
+        failover=failover,
+        inference_client=inference_client,
+        tracer=tracer,
+        max_prompt_tokens=max_prompt_tokens,
+    )
+    history = history if history is not None else ConversationHistory()
+    episode = Episode(record, task=user_plan) if record else None
+    log_episode = episode_log.start_episode(user_plan, tracer.attributes.get("device")) if episode_log is not None else None
+    target = simple_target(user_plan) if ui_fast_path else None
+    if target is not None:
+        print(f"UI fast path: looking for '{target}'.")
+    trajectory = trajectory_store.lookup(user_plan) if trajectory_store is not None else None
+    if trajectory is not None:
+        print(f"Trajectory cache: replaying {len(trajectory.steps)} recorded steps while the screens match.")
+    replayed = 0
+    # Steps of this run, stored as a trajectory when the task finishes.
+    trajectory_steps = []
     iter = 1
-    actionOperator = None
+    actionOperator = action_space
     response = None
-    screenshot_file = "./screenshot/screenshot.jpg"
+    adb_path = adb_path or os.getenv("ADB_PATH", "adb")
     invalid_last_action = False
-    while True:
-        get_screenshot(adb_path="adb", save_path=screenshot_file)
-        if max_itr is not None and iter >= max_itr:
-            print("Max iteration reached. Stopping...")
-            break
-        if iter == 1:
-            width, height = Image.open(screenshot_file).size
-            actionOperator = ActionSpace(
-                adb_path=os.getenv("ADB_PATH", "adb"),
-                image_width=width,
-                image_height=height,
-            )
-            messages.append(
-                MessageDict(
-                    role="user",
-                    content=[
-                        TextMessageContent(
-                            type="text",
-                            text="Here is the initial state of the screen'.",
-                        ),
-                        ImageMessageContent(
-                            type="image_url",
-                            image_url=ImageURLDict(url=get_image_url(screenshot_file)),
-                        ),
-                    ],
-                ),
-            )
-        else:
-            if not invalid_last_action:
-                messages.append(
+    parse_error = None
+    encode_config = ImageEncodeConfig.from_env()
+    # Geometry of every frame, actions are mapped onto the frame the model was shown.
+    display_tracker = display_tracker if display_tracker is not None else DisplayTracker(adb_path)
+    # Frame captured and encoded while the last request was in flight, reused when no action touched the screen.
+    prefetch = None
+    # Consecutive waits skipped because the screen did not change.
+    static_waits = 0
+    actions = []
+    # Actions of the current step, dispatched while the response may still be streaming.
+    execution = None
+    # UI hierarchy of the current screen, dumped while the request is in flight.
+    hierarchy_task = None
+    # Model request of the current step, raced against the UI fast path.
+    request_task = None
+    speculator = Speculator(max_concurrent=max_speculative) if speculative else None
+    # Captures frames and starts speculative requests while the actions of a step execute.
+    watcher = None
+    status = "max_iterations"
+
+    async def perform(actions):
+        """
+        Execute parsed action events, returns True when the task is finished.
+        """
+        nonlocal prefetch
+        await cancel_task(prefetch)
+        prefetch = None
+        if snap_distance and hierarchy_task is not None:
+            hierarchy = await hierarchy_task
+            if hierarchy is not None:
+                actions = actionOperator.snap_to_elements(actions, hierarchy, snap_distance)
+        if len(actions) == 1 and actions[0]["type"] in ("wait", "sleep"):
+            with actionOperator.tracer.span("wait"):
+                await asyncio.sleep(actions[0].get("time", 1))
+            return False
+        executed, finished = await asyncio.to_thread(actionOperator.execute_actions, actions, actionOperator.screen_settled)
+        print(f"Executed {executed}/{len(actions)} actions.")
+        return finished
+
+    try:
+        while True:
+            if max_itr is not None and iter >= max_itr:
+                print("Max iteration reached. Stopping...")
+                break
+            step_tracer = tracer.child(step=iter)
+            agent.tracer = step_tracer
+            step_started = time.monotonic()
+            if prefetch is not None:
+                screenshot, frame, change = await prefetch
+                prefetch = None
+            else:
+                screenshot, frame, change = await capture_frame(adb_path, encode_config, step_tracer, change_detector)
+            await cancel_task(watcher)
+            watcher = None
+            unchanged = change is not None and not change.changed and not invalid_last_action
+            if change is not None:
+                print(f"Screen change: {change.changed_fraction:.1%} of the cells, mean difference {change.mean_difference:.3f}, {len(change.regions)} regions, bbox {change.bbox}")
+                step_tracer.event("change", changed=change.changed, changed_fraction=change.changed_fraction, mean_difference=change.mean_difference, regions=len(change.regions))
+            waited = len(actions) == 1 and actions[0]["type"] in ("wait", "sleep")
+            if unchanged and waited and static_waits < max_static_waits:
+                static_waits += 1
+                print(f"Screen unchanged after waiting, waiting again without asking the model ({static_waits}/{max_static_waits}).")
+                with step_tracer.span("wait"):
+                    await asyncio.sleep(actions[0].get("time", 1))
+                iter += 1
+                continue
+            static_waits = 0
+            phash = perceptual_hash(screenshot) if trajectory_store is not None or speculator is not None else None
+            speculation = None
+            if speculator is not None:
+                speculation = speculator.take(phash) if iter > 1 and not unchanged and not invalid_last_action else None
+                speculator.discard()
+                if speculation is not None:
+                    print(f"Speculative request committed, started {time.monotonic() - speculation.started:.2f}s ago on a matching frame.")
+                    step_tracer.event("speculation", committed=True, head_start=time.monotonic() - speculation.started)
+            image_url = None
+            if speculation is not None:
+                if change_detector is not None:
+                    change_detector.commit(screenshot)
+            # The last screenshot may have left the window, the model is then shown the screen again.
+            elif not unchanged or not history.image_count():
+                if frame is None:
+                    frame = await encode_frame(screenshot, encode_config, step_tracer)
+                with step_tracer.span("base64"):
+                    image_url = get_image_url(frame.data, frame.mime_type)
+                if change_detector is not None:
+                    change_detector.commit(screenshot)
+            with step_tracer.span("display"):
+                display = await asyncio.to_thread(display_tracker.update, screenshot.size)
+            if iter == 1:
+                print(f"Display: {display.width}x{display.height} {display.orientation}, density {display.density}")
+                if actionOperator is None:
+                    actionOperator = ActionSpace(
+                        adb_path=adb_path,
+                        image_width=display.width,
+                        image_height=display.height,
+                        crop_top=encode_config.crop_top,
+                        crop_bottom=encode_config.crop_bottom,
+                        tracer=step_tracer,
+                    )
+                actionOperator.set_display(display)
+                history.append(
                     MessageDict(
                         role="user",
                         content=[
                             TextMessageContent(
                                 type="text",
-                                text="Here is the screen after last execution of previous action suggested",
+                                text=INITIAL_SCREEN_TEXT,
                             ),
                             ImageMessageContent(
                                 type="image_url",
-                                image_url=ImageURLDict(
-                                    url=get_image_url(screenshot_file)
-                                ),
+                                image_url=ImageURLDict(url=image_url),
                             ),
                         ],
-                    )
+                    ),
                 )
             else:
-                messages.append(
+                if actionOperator.set_display(display):
+                    print(f"Display changed to {display.width}x{display.height} {display.orientation}, mapping actions onto the new geometry.")
+                if plan_every and invalid_last_action:
+                    agent.prompt.add_error(f"Invalid action ({parse_error})" if parse_error else "Invalid action")
+                elif plan_every and unchanged:
+                    agent.prompt.add_error(f"{', '.join(action['type'] for action in actions)} did not change the screen")
+                elif plan_every:
+                    agent.prompt.clear_errors()
+                if speculation is not None:
+                    text = None
+                elif unchanged:
+                    text = "The screen did not change after the last action"
+                elif not invalid_last_action:
+                    text = AFTER_ACTION_TEXT
+                else:
+                    text = f"Invalid Last action ({parse_error}), Please try again" if parse_error else "Invalid Last action, Please try again"
+                    invalid_last_action = False
+                    parse_error = None
+                # A committed speculative request was sent with its own message, the one kept in the history.
+                history.append(speculation.payload if speculation is not None else screen_message(text, image_url))
+            actionOperator.tracer = step_tracer
+            prefetch = asyncio.ensure_future(capture_frame(adb_path, encode_config, tracer.child(step=iter + 1), change_detector))
+            execution = None
+            actions = []
+            requested = time.monotonic()
+            if trajectory is not None:
+                if trajectory.matches(replayed, phash, trajectory_store.max_distance):
+                    response, actions = trajectory.steps[replayed].response, trajectory.steps[replayed].actions
+                    replayed += 1
+                    print(f"Trajectory cache: replaying step {replayed}/{len(trajectory.steps)}, skipping the model.")
+                    execution = asyncio.ensure_future(perform(actions))
+                else:
+                    print(f"Trajectory cache: screen diverged at step {replayed + 1}, falling back to the model.")
+                    trajectory_store.record_replay(trajectory, replayed, False)
+                    trajectory = None
+            if plan_every and execution is None and (iter - 1) % plan_every == 0:
+                with step_tracer.span("plan"):
+                    await agent.plan(history.messages())
+            hierarchy_task = None
+            if target is not None or snap_distance:
+                hierarchy_task = asyncio.ensure_future(dump_hierarchy(adb_path, step_tracer))
+            async def request_response():
+                if speculation is not None:
+                    with step_tracer.span("request", speculative=True):
+                        return await speculation.task
+                if stream:
+                    def dispatch(parsed):
+                        nonlocal execution, actions
+                        actions = [action.to_event() for action in parsed]
+                        execution = asyncio.ensure_future(perform(actions))
+                    with step_tracer.span("request", stream=True):
+                        result = await agent.stream_inference(history.messages(), on_action=dispatch)
+                    if result.time_to_action is not None:
+                        print(f"Actions dispatched after {result.time_to_action:.2f}s (first token {result.time_to_first_token:.2f}s, stream {'cancelled' if result.cancelled else 'completed'} at {result.total_time:.2f}s)")
+                    return result.text
+                with step_tracer.span("request"):
+                    return await agent.inference(history.messages())
+            element = None
+            if execution is None:
+                request_task = asyncio.ensure_future(request_response())
+            if target is not None and request_task is not None:
+                # The model request runs while the hierarchy is dumped, and is cancelled when the target is found.
+                hierarchy = await hierarchy_task
+                element = hierarchy.find(target) if hierarchy is not None else None
+                if element is not None and execution is None:
+                    await cancel_task(request_task)
+                    request_task = None
+                else:
+                    element = None
+            if element is not None:
+                x, y = actionOperator.grid_point(*element.center)
+                print(f"UI fast path: '{target}' found at {element.bounds}, skipping the model.")
+                response = f"Thought: The element '{target}' is on the screen, tapping it.\nAction: click(start_box='({x},{y})')"
+                actions = [{"type": "click", "x": x, "y": y}, {"type": "finished", "content": ""}]
+                execution = asyncio.ensure_future(perform(actions))
+            elif request_task is not None:
+                response = await request_task
+                request_task = None
+            model_time = time.monotonic() - requested
+            print("Response: ", response)
+            print("------------------------------------")
+            if response is not None:
+                history.append(
                     MessageDict(
-                        role="user",
+                        role="assistant",
                         content=[
-                            TextMessageContent(
-                                type="text",
-                                text="Invalid Last action, Please try again",
-                            )
+                            TextMessageContent(type="text", text=response),
                         ],
                     )
                 )
-                invalid_last_action = False
-        response = None
-        response = agent.inference(messages)
-        print("Response: ", response)
-        print("------------------------------------")
-        if response is not None:
-            messages.append(
-                MessageDict(
-                    role="assistant",
-                    content=[
-                        TextMessageContent(type="text", text=response),
-                    ],
-                )
-            )
-            action = extract_action(response)
-            if not action or (type(action) == dict and "type" not in action):
-                invalid_last_action = True
-            elif type(action) == dict:
-                if action.get("type") == "finished":
-                    print("Task completed.")
-                    break
-                elif action.get("type") == "wait" or action.get("type") == "sleep":
-                    time.sleep(action.get("time", 1))
+                if execution is None:
+                    try:
+                        with step_tracer.span("parse"):
+                            actions = [action.to_event() for action in parse_actions(response)]
+                    except ActionParseError as e:
+                        print("Invalid action: ", e)
+                        parse_error = e.message
+                        actions = []
+                    if actions:
+                        execution = asyncio.ensure_future(perform(actions))
+                if episode is not None:
+                    await asyncio.to_thread(episode.add_step, screenshot, response, actions)
+                if episode_log is not None:
+                    timings = {"model": model_time, "step": time.monotonic() - step_started}
+                    await log_step(episode_log, log_episode, screenshot, frame, response, actions, timings, encode_config, step_tracer)
+                if trajectory_store is not None and actions:
+                    trajectory_steps.append(TrajectoryStep(phash, response, actions))
+                if execution is None:
+                    invalid_last_action = True
                 else:
-                    actionOperator.map_generate_action_to_event(action)
-        else:
-            invalid_last_action = True
-        iter += 1
+                    if speculator is not None and not any(action["type"] == "finished" for action in actions):
+                        watcher = asyncio.ensure_future(speculate(agent, speculator, history, adb_path, encode_config, phash, step_tracer))
+                    if await execution:
+                        print("Task completed.")
+                        status = "finished"
+                        break
+            else:
+                invalid_last_action = True
+            iter += 1
+    finally:
+        await cancel_task(prefetch)
+        await cancel_task(execution)
+        await cancel_task(hierarchy_task)
+        await cancel_task(request_task)
+        await cancel_task(watcher)
+        if speculator is not None:
+            speculator.discard()
+            print("Speculation: ", speculator.stats())
+        if inference_client is None:
+            print_endpoint_metrics(agent.client)
+        await agent.close()
+        if actionOperator is not None and action_space is None:
+            actionOperator.close()
+        if response_cache is not None:
+            print("Response cache: ", response_cache.stats())
+        if trajectory is not None:
+            trajectory_store.record_replay(trajectory, replayed, status == "finished")
+        elif trajectory_store is not None and status == "finished":
+            trajectory_store.record(user_plan, trajectory_steps)
+        if trajectory_store is not None:
+            print("Trajectory cache: ", trajectory_store.stats())
+        if episode_log is not None:
+            episode_log.finish_episode(log_episode, status)
+        if owns_tracer:
+            tracer.print_summary()
+    return {"status": status, "steps": iter}
+
+
+def run_task_with_user_plan(user_plan, max_itr=20, llm_type="dpo", response_cache=None, request_timeout=None, task_timeout=None, history=None, failover=False, stream=False, tracer=None, record=None, ui_fast_path=False, snap_distance=None, trajectory_store=None, change_detector=None, max_static_waits=2, speculative=False, max_speculative=1, episode_log=None, max_prompt_tokens=None, plan_every=None):
+    """
+    Synchronous entry point, runs run_task_async on a new event loop.
+    """
+    return asyncio.run(
+        asyncio.wait_for(
+            run_task_async(user_plan, max_itr=max_itr, llm_type=llm_type, response_cache=response_cache, request_timeout=request_timeout, history=history, failover=failover, stream=stream, tracer=tracer, record=record, ui_fast_path=ui_fast_path, snap_distance=snap_distance, trajectory_store=trajectory_store, change_detector=change_detector, max_static_waits=max_static_waits, speculative=speculative, max_speculative=max_speculative, episode_log=episode_log, max_prompt_tokens=max_prompt_tokens, plan_every=plan_every),
+            timeout=task_timeout,
+        )
+    )
 
 
 def main():
@@ -120,11 +473,88 @@ def main():
     parser.add_argument("user_query", type=str, help="Task Query")
     parser.add_argument("--llm_type", type=str, default="dpo", help="dpo/sft: DPO-trained llm or SFT-trained llm")
     parser.add_argument("--max_itr", type=int, default=10, help="Maximum number of iterations to run the task")
+    parser.add_argument("--response_cache", type=str, default=None, help="Cache model responses for repeated screens: 'memory' or a sqlite file path")
+    parser.add_argument("--cache_distance", type=int, default=4, help="Maximum perceptual hash distance (bits) for a response cache hit")
+    parser.add_argument("--request_timeout", type=float, default=120, help="Timeout in seconds of a single model request")
+    parser.add_argument("--task_timeout", type=float, default=None, help="Timeout in seconds of the whole task")
+    parser.add_argument("--max_images", type=int, default=2, help="Screenshots kept in the conversation sent to the model")
+    parser.add_argument("--max_turns", type=int, default=1, help="Previous turns sent to the model, older turns are summarized")
+    parser.add_argument("--max_context_tokens", type=int, default=None, help="Estimated token budget of the conversation sent to the model")
+    parser.add_argument("--failover", action="store_true", help="Fail over between the DPO and SFT endpoints when one keeps failing")
+    parser.add_argument("--stream", action="store_true", help="Stream responses and start executing actions before the response is complete")
+    parser.add_argument("--trace", type=str, default=None, help="Write timed spans of every step to this JSONL file")
+    parser.add_argument("--record", type=str, default=None, help="Record the task as an episode in this directory, for offline replay")
+    parser.add_argument("--ui_fast_path", action="store_true", help="Resolve 'tap <label>' tasks from the uiautomator hierarchy without the model")
+    parser.add_argument("--snap_distance", type=int, default=None, help="Snap clicks onto clickable elements at most this many pixels away (uses uiautomator dumps)")
+    parser.add_argument("--trajectory_cache", type=str, default=None, help="Replay stored action sequences of repeated instructions: 'memory' or a sqlite file path")
+    parser.add_argument("--change_detection", action="store_true", help="Do not re-send or re-ask about screens that did not change since the last one sent")
+    parser.add_argument("--max_static_waits", type=int, default=2, help="With --change_detection, waits repeated without the model while the screen does not change")
+    parser.add_argument("--speculative", action="store_true", help="Start requests for the next step on intermediate frames while the screen settles")
+    parser.add_argument("--max_speculative", type=int, default=1, help="With --speculative, speculative requests in flight at most")
+    parser.add_argument("--episode_log", type=str, default=None, help="Append the steps of the task to the episode log in this directory (see episode_log.py)")
+    parser.add_argument("--max_prompt_tokens", type=int, default=None, help="Trim every request to about this many tokens, system prompt and images included")
+    parser.add_argument("--plan_every", type=int, default=None, help="Ask the manager prompt for a plan on the first screen and every this many steps, the plan is sent with every request")
     args = parser.parse_args()
     user_query = args.user_query
+    # Fail before building clients and caches when there is nothing to run the task on.
+    state = device_state(os.getenv("ADB_PATH", "adb"))
+    if state != "device":
+        raise Exception(f"No device ready, adb get-state: {state}")
+    change_detector = None
+    if args.change_detection:
+        from change_detection import ChangeDetector
+        change_detector = ChangeDetector()
     llm_type = args.llm_type
     max_itr = args.max_itr
-    run_task_with_user_plan(user_query, max_itr=max_itr, llm_type=llm_type)
+    response_cache = None
+    if args.response_cache:
+        response_cache = ResponseCache(
+            max_distance=args.cache_distance,
+            path=None if args.response_cache == "memory" else args.response_cache,
+        )
+    trajectory_store = None
+    if args.trajectory_cache:
+        trajectory_store = TrajectoryStore(path=None if args.trajectory_cache == "memory" else args.trajectory_cache)
+    episode_log = None
+    if args.episode_log:
+        from episode_log import EpisodeLog
+        episode_log = EpisodeLog(args.episode_log)
+    sink = JsonlSink(args.trace) if args.trace else None
+    tracer = Tracer(sink, device=os.getenv("ANDROID_SERIAL", "default"))
+    try:
+        run_task_with_user_plan(
+            user_query,
+            max_itr=max_itr,
+            llm_type=llm_type,
+            response_cache=response_cache,
+            request_timeout=args.request_timeout,
+            task_timeout=args.task_timeout,
+            history=ConversationHistory(max_images=args.max_images, max_turns=args.max_turns, max_tokens=args.max_context_tokens),
+            failover=args.failover,
+            stream=args.stream,
+            tracer=tracer,
+            record=args.record,
+            ui_fast_path=args.ui_fast_path,
+            snap_distance=args.snap_distance,
+            trajectory_store=trajectory_store,
+            change_detector=change_detector,
+            max_static_waits=args.max_static_waits,
+            speculative=args.speculative,
+            max_speculative=args.max_speculative,
+            episode_log=episode_log,
+            max_prompt_tokens=args.max_prompt_tokens,
+            plan_every=args.plan_every,
+        )
+    finally:
+        tracer.print_summary()
+        if sink is not None:
+            sink.close()
+        if response_cache is not None:
+            response_cache.close()
+        if trajectory_store is not None:
+            trajectory_store.close()
+        if episode_log is not None:
+            episode_log.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,107 @@
+"""
+Responses for action parser property checks and fuzzing, built from the action templates of the system
+prompt. Used by tests/test_action_parser.py and `python src/benchmark.py parser`.
+"""
+import json
+import re
+from action_parser import ActionParser, ActionParseError
+from constants import TARS_SYSTEM_PROMPT
+
+# Texts as models write them: apostrophes left unescaped, "\\n" at the end to submit.
+RAW_TEXTS = ("It's a test", "don't stop\\n", "rock 'n' roll", "l'hôtel, paris", "O'Brien\\n", "what's new?", "line\\nbreak")
+
+
+def action_templates():
+    """
+    Action and shortcut call templates listed in TARS_SYSTEM_PROMPT, e.g. click(start_box='<|box_start|>(x1,y1)<|box_end|>').
+    """
+    return re.findall(r"^- ([A-Za-z_]+\(.*?\))(?=:|\s*#|\s*$)", TARS_SYSTEM_PROMPT, re.MULTILINE)
+
+
+def fill_template(template, rng):
+    """
+    Replace placeholders of a template with random values. Returns the call, the points and the texts used.
+    """
+    points = []
+    texts = []
+
+    def point(_):
+        points.append((rng.randint(0, 1000), rng.randint(0, 1000)))
+        return f"({points[-1][0]},{points[-1][1]})"
+
+    def text(_):
+        if rng.random() < 0.3:
+            texts.append(rng.choice(RAW_TEXTS))
+            return f"'{texts[-1]}'"
+        texts.append("".join(rng.choice("abcXYZ 019,.!?()[]\"\\'") for _ in range(rng.randint(0, 12))))
+        return "'" + texts[-1].replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+    call = re.sub(r"\(x\d,y\d\)", point, template)
+    call = re.sub(r"(content=)''", lambda m: m.group(1) + text(m), call)
+    call = re.sub(r", text\)$", lambda m: ", text=" + text(m) + ")", call)
+    return call, points, texts
+
+
+def parser_corpus(size, rng):
+    """
+    `size` responses of 1 to 3 calls, as a JSON list or space separated, in a json fence.
+    Returns (response, calls) pairs, calls as returned by fill_template.
+    """
+    corpus = []
+    templates = action_templates()
+    for _ in range(size):
+        calls = [fill_template(rng.choice(templates), rng) for _ in range(rng.randint(1, 3))]
+        body = json.dumps([call for call, _, _ in calls]) if rng.random() < 0.7 else " ".join(call for call, _, _ in calls)
+        corpus.append((f"Thought: step.\nAction: ```json{body}```", calls))
+    return corpus
+
+
+def property_violations(corpus):
+    """
+    Responses of the corpus whose parse does not give back the calls, points and texts they were built
+    from, or whose rendered actions do not parse to the same actions.
+    """
+    violations = []
+    for response, calls in corpus:
+        actions = ActionParser(strict=True).parse(response)
+        points = [point for _, call_points, _ in calls for point in call_points]
+        parsed_points = [value for action in actions for value in action.args.values() if isinstance(value, tuple)]
+        texts = [text for _, _, call_texts in calls for text in call_texts]
+        parsed_texts = [value for action in actions for key, value in action.args.items() if key in ("content", "text")]
+        reparsed = ActionParser(strict=True).parse("Action: " + " ".join(action.render() for action in actions))
+        if len(actions) != len(calls) or points != parsed_points or texts != parsed_texts or [(a.name, a.args) for a in reparsed] != [(a.name, a.args) for a in actions]:
+            violations.append(response)
+    return violations
+
+
+def mutate(text, rng):
+    text = list(text)
+    for _ in range(rng.randint(1, 4)):
+        position = rng.randrange(len(text))
+        operation = rng.random()
+        if operation < 0.4:
+            del text[position]
+        elif operation < 0.8:
+            text.insert(position, rng.choice("()[],'\"=<|> \n"))
+        else:
+            text[position] = rng.choice("abc019")
+    return "".join(text)
+
+
+def fuzz(corpus, count, rng):
+    """
+    Parse `count` mutated corpus responses in lenient and strict mode. Returns the number of parses
+    rejected with ActionParseError and the (response, exception) pairs of any other exception.
+    """
+    rejected = 0
+    crashes = []
+    for _ in range(count):
+        response = mutate(rng.choice(corpus)[0], rng)
+        for strict in (False, True):
+            try:
+                ActionParser(strict=strict).parse(response)
+            except ActionParseError:
+                rejected += 1
+            except Exception as e:
+                crashes.append((response, e))
+    return rejected, crashes
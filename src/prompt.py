@@ -0,0 +1,207 @@
+"""
+Prompt assembly for TARS requests. The system message (system prompt and user instruction) is rendered
+once per task and sent as the same object every step, so requests start with a byte identical prefix
+the server can keep in its prefix cache. Requests are kept within a token budget estimated per message:
+text at about 4 characters per token, images by the 28x28 pixel tiles the vision encoder turns into
+one token each. The manager (planning) prompt is rendered from MANAGER_PROMPT_TEMPLATE the same way:
+the instruction header once per task, the plan, progress and error blocks when they change.
+"""
+import base64
+import io
+import math
+import struct
+import re
+from functools import lru_cache
+from string import Template
+from constants import MANAGER_PROMPT_TEMPLATE
+
+CHARS_PER_TOKEN = 4
+# Pixels per side of the image area that becomes one token (14px patches merged 2x2, Qwen2-VL / UI-TARS).
+IMAGE_TILE = 28
+# Estimate for an image whose size can not be read from its header.
+IMAGE_TOKENS = 1000
+
+INITIAL_PLANNING_BLOCK = (
+    "---\nMake a high-level plan to achieve the user's instruction. If it is complex, break it down into subgoals. "
+    "The screenshot shows the current state of the phone."
+)
+PLAN_DESCRIPTION = "The updated plan, numbered subgoals; keep the subgoals that are done unless the screen shows otherwise."
+SUBGOAL_DESCRIPTION = "The next subgoal to work on, in one concise sentence."
+MANAGER_RESPONSE_PATTERN = re.compile(r"### Thought ###\s*(?P<thought>.*?)\s*### Plan ###\s*(?P<plan>.*?)\s*### Current Subgoal ###\s*(?P<subgoal>.*?)\s*$", re.DOTALL)
+
+
+def header_size(data):
+    """
+    (width, height) from the header bytes of a PNG or JPEG image, None when they do not cover it.
+    """
+    if data.startswith(b"\x89PNG") and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    offset = 2
+    while offset + 9 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        # Start of frame markers, except DHT, JPG and DAC which share the range.
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + struct.unpack(">H", data[offset + 2:offset + 4])[0]
+    return None
+
+
+@lru_cache(maxsize=8)
+def image_size(url):
+    """
+    (width, height) of a data URL image, read from its header; None when unknown.
+    """
+    if not url.startswith("data:") or "," not in url:
+        return None
+    encoded = url[url.index(",") + 1:]
+    # The size is in the first few hundred bytes of PNG and of the JPEG files PIL writes.
+    for length in (1024, 16384):
+        size = header_size(base64.b64decode(encoded[:length]))
+        if size is not None:
+            return size
+    from PIL import Image
+    try:
+        return Image.open(io.BytesIO(base64.b64decode(encoded))).size
+    except Exception:
+        return None
+
+
+def image_tokens(url, tile=IMAGE_TILE):
+    size = image_size(url)
+    if size is None:
+        return IMAGE_TOKENS
+    # Plus the vision start and end tokens.
+    return math.ceil(size[0] / tile) * math.ceil(size[1] / tile) + 2
+
+
+def message_content(message):
+    """
+    Content parts of a message; string content, a single part or string parts become text parts.
+    """
+    content = message["content"]
+    if type(content) != list:
+        content = [content]
+    return [{"type": "text", "text": item} if type(item) == str else item for item in content]
+
+
+def estimate_tokens(message):
+    tokens = 0
+    for content in message_content(message):
+        if content["type"] == "image_url":
+            tokens += image_tokens(content["image_url"]["url"])
+        else:
+            tokens += len(content.get("text", "")) // CHARS_PER_TOKEN + 1
+    return tokens
+
+
+def parse_manager_response(text):
+    """
+    (thought, plan, subgoal) of a response to the manager prompt, None when its sections are missing.
+    """
+    match = MANAGER_RESPONSE_PATTERN.search(text or "")
+    if not match or not match.group("plan") or not match.group("subgoal"):
+        return None
+    return match.group("thought"), match.group("plan"), match.group("subgoal")
+
+
+class PromptAssembler:
+    """
+    system_prompt:             Static part of the system message, e.g. constants.TARS_SYSTEM_PROMPT.
+    max_tokens:                Estimated token budget of a whole request, system message included; None for none.
+    shortcuts_reference_block: Shortcut reference of the manager prompt.
+    max_errors:                Failed attempts shown in the manager prompt.
+    """
+
+    def __init__(self, system_prompt, instruction, max_tokens=None, shortcuts_reference_block="", max_errors=3):
+        self.system_prompt = system_prompt
+        self.instruction = instruction
+        self.max_tokens = max_tokens
+        self.system_message = {"role": "system", "content": [{"type": "text", "text": f"{system_prompt}\n## User Instruction\n{instruction}"}]}
+        self.system_tokens = estimate_tokens(self.system_message)
+        # Requests that were over the budget and trimmed.
+        self.trimmed = 0
+        # The manager prompt up to the first per-step block is rendered once, the rest keeps the
+        # per-step placeholders with everything else substituted.
+        head, tail = MANAGER_PROMPT_TEMPLATE.template.split("$planning_block", 1)
+        self.manager_prefix = Template(head).substitute(instruction=instruction)
+        self.manager_template = Template(Template("$planning_block" + tail).safe_substitute(
+            shortcuts_reference_block=shortcuts_reference_block.replace("$", "$$"),
+            plan_description=PLAN_DESCRIPTION,
+            current_subgoal_description=SUBGOAL_DESCRIPTION,
+        ))
+        self.manager_blocks = {"planning_block": INITIAL_PLANNING_BLOCK, "error_handling_block": "", "plan_checkpoint_meta_metadata": ""}
+        self.manager_rendered = None
+        self.max_errors = max_errors
+        self.errors = []
+        # Plan, subgoal and progress appended to the last message of every request once a plan is set.
+        self.plan_context = None
+
+    def __update_block__(self, name, text):
+        if self.manager_blocks[name] != text:
+            self.manager_blocks[name] = text
+            self.manager_rendered = None
+
+    def set_plan(self, plan, subgoal, progress=""):
+        self.__update_block__("planning_block", f"### Current Plan ###\n{plan}\n\n### Previous Subgoal ###\n{subgoal}\n\n### Progress Status ###\n{progress}")
+        self.plan_context = f"## Plan\n{plan}\n## Current Subgoal\n{subgoal}" + (f"\n## Progress Status\n{progress}" if progress else "")
+
+    def add_error(self, error):
+        """
+        A failed attempt; the last `max_errors` of them are shown in the manager prompt.
+        """
+        self.errors = (self.errors + [error])[-self.max_errors:]
+        logs = "\n".join(f"- {error}" for error in self.errors)
+        self.__update_block__("error_handling_block", f"### Potentially Stuck! ###\nThe last attempts failed:\n{logs}")
+
+    def clear_errors(self):
+        self.errors = []
+        self.__update_block__("error_handling_block", "")
+
+    def manager_prompt(self):
+        """
+        Text of the manager prompt, rendered again only when a block changed.
+        """
+        if self.manager_rendered is None:
+            self.manager_rendered = self.manager_prefix + self.manager_template.substitute(self.manager_blocks)
+        return self.manager_rendered
+
+    def assemble(self, messages):
+        """
+        The system message followed by the conversation from its first user message, trimmed to the
+        budget: images of older messages go first, then the oldest turns; the last message is kept, with
+        the plan context after its content when a plan is set.
+        Returns (messages, estimated tokens).
+        """
+        start = 0
+        while start < len(messages) and messages[start]["role"] != "user":
+            start += 1
+        messages = list(messages[start:])
+        if self.plan_context is not None and messages:
+            messages[-1] = {**messages[-1], "content": [*message_content(messages[-1]), {"type": "text", "text": self.plan_context}]}
+        tokens = [estimate_tokens(message) for message in messages]
+        total = self.system_tokens + sum(tokens)
+        if self.max_tokens is None or total <= self.max_tokens:
+            return [self.system_message, *messages], total
+        self.trimmed += 1
+        for index in range(len(messages) - 1):
+            if total <= self.max_tokens:
+                break
+            content = message_content(messages[index])
+            if any(item["type"] == "image_url" for item in content):
+                messages[index] = {**messages[index], "content": [item for item in content if item["type"] != "image_url"]}
+                before, tokens[index] = tokens[index], estimate_tokens(messages[index])
+                total += tokens[index] - before
+        while total > self.max_tokens and len(messages) > 1:
+            # Whole turns, so the conversation still starts with a user message.
+            total -= tokens.pop(0)
+            messages.pop(0)
+            while len(messages) > 1 and messages[0]["role"] != "user":
+                total -= tokens.pop(0)
+                messages.pop(0)
+        if total > self.max_tokens:
+            print(f"Prompt of about {total} tokens is over the budget of {self.max_tokens} with only the last message left.")
+        return [self.system_message, *messages], total
+
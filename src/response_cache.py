@@ -0,0 +1,164 @@
+import base64
+import hashlib
+import io
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from PIL import Image
+
+
+def perceptual_hash(image, hash_size=8):
+    """
+    Difference hash: compares neighbouring pixels of a small grayscale thumbnail.
+    Visually identical screens (recompression, tiny clock changes) end up a few bits apart.
+    """
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def image_from_data_url(url):
+    encoded = url.split(",", 1)[1]
+    return Image.open(io.BytesIO(base64.b64decode(encoded)))
+
+
+def latest_screenshot(messages):
+    """
+    Image of the last user message, or None when it has no image (e.g. an invalid action note).
+    """
+    for message in reversed(messages):
+        if message["role"] != "user":
+            continue
+        content = message["content"] if type(message["content"]) == list else [message["content"]]
+        for item in content:
+            if item["type"] == "image_url":
+                return image_from_data_url(item["image_url"]["url"])
+        return None
+    return None
+
+
+def action_history_digest(messages, history_size=3):
+    """
+    Digest of the Action part of the last assistant messages, thoughts are ignored.
+    """
+    actions = []
+    for message in messages:
+        if message["role"] != "assistant":
+            continue
+        content = message["content"] if type(message["content"]) == list else [message["content"]]
+        text = "".join(item.get("text", "") for item in content)
+        index = text.rfind("Action:")
+        actions.append(text[index:] if index != -1 else text)
+    return hashlib.sha1("\n".join(actions[-history_size:]).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache of model responses keyed on (user instruction, recent action history, screenshot perceptual hash).
+    Screens match when their hashes are at most `max_distance` bits apart.
+    Entries are evicted least recently used beyond `max_entries` and after `ttl` seconds.
+    With `path`, entries are persisted in sqlite and loaded back on start.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600, max_distance=4, history_size=3, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.history_size = history_size
+        self.entries = OrderedDict()
+        self.buckets = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS response_cache (bucket TEXT, phash TEXT, response TEXT, created REAL, PRIMARY KEY (bucket, phash))")
+            self.db.execute("DELETE FROM response_cache WHERE created < ?", (time.time() - self.ttl,))
+            self.db.commit()
+            rows = self.db.execute("SELECT bucket, phash, response, created FROM response_cache ORDER BY created DESC LIMIT ?", (self.max_entries,))
+            for bucket, phash, response, created in reversed(rows.fetchall()):
+                self.__store__((bucket, int(phash, 16)), response, created)
+
+    def key(self, instruction, messages):
+        """
+        Cache key for the messages about to be sent, or None when the last user message has no screenshot.
+        """
+        screenshot = latest_screenshot(messages)
+        if screenshot is None:
+            return None
+        history = action_history_digest(messages, self.history_size)
+        bucket = hashlib.sha1(f"{instruction}\n{history}".encode("utf-8")).hexdigest()
+        return bucket, perceptual_hash(screenshot)
+
+    def get(self, key):
+        if key is None:
+            return None
+        bucket, phash = key
+        with self.lock:
+            now = time.time()
+            best = None
+            for candidate in list(self.buckets.get(bucket, ())):
+                response, created = self.entries[(bucket, candidate)]
+                if now - created > self.ttl:
+                    self.__remove__((bucket, candidate))
+                    continue
+                distance = hamming_distance(phash, candidate)
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, candidate, response)
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end((bucket, best[1]))
+            return best[2]
+
+    def put(self, key, response):
+        if key is None or response is None:
+            return
+        with self.lock:
+            created = time.time()
+            self.__store__(key, response, created)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)", (key[0], f"{key[1]:016x}", response, created))
+                self.db.commit()
+
+    def __store__(self, key, response, created):
+        self.entries[key] = (response, created)
+        self.entries.move_to_end(key)
+        self.buckets.setdefault(key[0], set()).add(key[1])
+        while len(self.entries) > self.max_entries:
+            self.__remove__(next(iter(self.entries)))
+
+    def __remove__(self, key):
+        del self.entries[key]
+        self.buckets[key[0]].discard(key[1])
+        if not self.buckets[key[0]]:
+            del self.buckets[key[0]]
+        if self.db is not None:
+            self.db.execute("DELETE FROM response_cache WHERE bucket = ? AND phash = ?", (key[0], f"{key[1]:016x}"))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
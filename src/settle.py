@@ -0,0 +1,80 @@
+import os
+import time
+from typing import NamedTuple
+from PIL import Image, ImageChops, ImageStat
+from utils import capture_raw_frame
+
+DIFF_SIZE = (64, 64)
+
+
+class SettleResult(NamedTuple):
+    settled: bool
+    waited: float
+    frames: int
+
+
+class AdbFrameSource:
+    """
+    Grabs low resolution raw frames from the device.
+    """
+    def __init__(self, adb_path="adb", max_size=256):
+        self.adb_path = adb_path
+        self.max_size = max_size
+
+    def __call__(self):
+        return capture_raw_frame(self.adb_path, max_size=self.max_size)
+
+
+class ReplayFrameSource:
+    """
+    Replays a recorded sequence of frames, repeating the last one once the sequence is exhausted.
+    """
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.index = 0
+
+    @classmethod
+    def from_directory(cls, directory):
+        names = sorted(name for name in os.listdir(directory) if name.lower().endswith((".png", ".jpg", ".jpeg")))
+        return cls(Image.open(os.path.join(directory, name)) for name in names)
+
+    def __call__(self):
+        frame = self.frames[min(self.index, len(self.frames) - 1)]
+        self.index += 1
+        return frame
+
+
+def frame_difference(frame, other):
+    """
+    Mean absolute difference of two frames on a small grayscale thumbnail, in the range [0, 1].
+    """
+    a = frame.convert("L").resize(DIFF_SIZE)
+    b = other.convert("L").resize(DIFF_SIZE)
+    return ImageStat.Stat(ImageChops.difference(a, b)).mean[0] / 255
+
+
+def wait_for_screen_settle(frame_source, threshold=0.01, stable_frames=2, timeout=3.0, poll_interval=0.15):
+    """
+    Poll frames until `stable_frames` consecutive frame differences are below threshold or timeout expires.
+    Returns SettleResult with the time actually waited.
+    """
+    start = time.monotonic()
+    previous = frame_source()
+    frames = 1
+    stable = 0
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= timeout:
+            return SettleResult(False, elapsed, frames)
+        time.sleep(min(poll_interval, timeout - elapsed))
+        frame = frame_source()
+        frames += 1
+        if frame is None or previous is None:
+            stable = 0
+        elif frame_difference(previous, frame) < threshold:
+            stable += 1
+            if stable >= stable_frames:
+                return SettleResult(True, time.monotonic() - start, frames)
+        else:
+            stable = 0
+        previous = frame
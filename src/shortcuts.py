@@ -0,0 +1,144 @@
+"""
+Shortcut functions: named macros over the atomic ActionSpace operations, run in one go on the device.
+The "Shortcut Functions" block of TARS_SYSTEM_PROMPT is generated from DEFAULT_SHORTCUTS.
+"""
+import re
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+PACKAGE_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)+$")
+# Finger movements on the 1000x1000 grid that bring the content in `direction` into view.
+SWIPES = {
+    "down": ((500, 750), (500, 250)),
+    "up": ((500, 250), (500, 750)),
+    "right": ((850, 500), (150, 500)),
+    "left": ((150, 500), (850, 500)),
+}
+
+
+class ShortcutError(Exception):
+    pass
+
+
+class Shortcut(NamedTuple):
+    """
+    arguments: (name, kind) pairs in positional order, kind is "point" or "text".
+    expand:    Bound arguments -> atomic action events (see ActionSpace.map_generate_action_to_event).
+    check:     Optional (action_space, arguments) -> bool run on the device before the macro, for
+               preconditions that can be verified without the model.
+    """
+    name: str
+    arguments: Tuple[Tuple[str, str], ...]
+    description: str
+    precondition: str
+    expand: Callable[[dict], List[dict]]
+    check: Optional[Callable] = None
+
+    def signature(self):
+        return ", ".join(
+            f"{name}='<|box_start|>(x1,y1)<|box_end|>'" if kind == "point" else name
+            for name, kind in self.arguments
+        )
+
+    def reference(self):
+        return f"- {self.name}({self.signature()}): {self.description} | Precondition: {self.precondition}"
+
+    def bind(self, args):
+        """
+        Arguments of a parsed call by name, positional ones (arg0, arg1, ...) in declaration order.
+        """
+        bound = {}
+        for index, (name, kind) in enumerate(self.arguments):
+            value = args.get(name, args.get(f"arg{index}"))
+            if value is None or value == "":
+                raise ShortcutError(f"{self.name}() is missing argument {name!r}")
+            if kind == "point" and not (isinstance(value, tuple) and len(value) == 2):
+                raise ShortcutError(f"{self.name}() argument {name!r} must be a point, got {value!r}")
+            bound[name] = value
+        return bound
+
+
+class ShortcutRegistry:
+    def __init__(self, shortcuts=()):
+        self.shortcuts = {}
+        for shortcut in shortcuts:
+            self.register(shortcut)
+
+    def register(self, shortcut: Shortcut):
+        self.shortcuts[shortcut.name] = shortcut
+        return shortcut
+
+    def get(self, name):
+        return self.shortcuts.get(name)
+
+    def names(self):
+        return set(self.shortcuts)
+
+    def __contains__(self, name):
+        return name in self.shortcuts
+
+    def reference_block(self):
+        """
+        Shortcut list in the format described by TARS_SYSTEM_PROMPT.
+        """
+        return "\n".join(shortcut.reference() for shortcut in self.shortcuts.values())
+
+    def resolve(self, event):
+        """
+        Shortcut and bound arguments of a shortcut event ({"type": "shortcut", "name": ..., "args": ...}).
+        """
+        shortcut = self.get(event["name"])
+        if shortcut is None:
+            raise ShortcutError(f"Unknown shortcut {event['name']!r}")
+        return shortcut, shortcut.bind(event.get("args", {}))
+
+
+def tap_type_and_enter(args):
+    x, y = args["start_box"]
+    return [
+        {"type": "click", "x": x, "y": y},
+        {"type": "type", "content": str(args["text"])},
+        {"type": "press_enter"},
+    ]
+
+
+def open_app(args):
+    return [{"type": "launch_app", "content": args["package"]}]
+
+
+def app_installed(action_space, args):
+    package = str(args["package"])
+    return bool(PACKAGE_PATTERN.match(package)) and action_space.run_shell(f"pm path {package}") == 0
+
+
+def swipe_page(args):
+    direction = str(args["direction"]).lower()
+    if direction not in SWIPES:
+        raise ShortcutError(f"Swipe_Page() direction must be one of {', '.join(SWIPES)}, got {direction!r}")
+    (x, y), (x1, y1) = SWIPES[direction]
+    return [{"type": "scroll", "start_x": x, "start_y": y, "end_x": x1, "end_y": y1}]
+
+
+DEFAULT_SHORTCUTS = ShortcutRegistry([
+    Shortcut(
+        "Tap_Type_and_Enter",
+        (("start_box", "point"), ("text", "text")),
+        'Tap an input box at the given start_box coordinate, type the "text", and then perform the Enter operation',
+        "There is a text input box on the screen.",
+        tap_type_and_enter,
+    ),
+    Shortcut(
+        "Open_App",
+        (("package", "text"),),
+        "Launch the app with the given Android package name, e.g. com.google.android.youtube",
+        "The app is installed on the phone.",
+        open_app,
+        check=app_installed,
+    ),
+    Shortcut(
+        "Swipe_Page",
+        (("direction", "text"),),
+        'Swipe across the middle of the screen to bring the content in "direction" (up, down, left or right) into view',
+        "The screen has scrollable content.",
+        swipe_page,
+    ),
+])
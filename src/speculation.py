@@ -0,0 +1,94 @@
+"""
+Speculative inference: while the actions of a step execute and the screen settles, requests for the next
+step are started on intermediate frames. Once the screen settled, a request whose frame matches the final
+capture (perceptual hash, see response_cache.perceptual_hash) is committed, the others are thrown away.
+"""
+import asyncio
+import time
+from typing import Any, NamedTuple
+from response_cache import hamming_distance
+
+
+class SpeculativeRequest(NamedTuple):
+    phash: int
+    # Whatever the caller needs to commit the request, e.g. the frame and the message it was sent with.
+    payload: Any
+    task: asyncio.Future
+    started: float
+
+
+def retrieve(task):
+    """
+    Done callback that consumes the outcome of a speculative request nobody awaits.
+    """
+    if not task.cancelled():
+        task.exception()
+
+
+class Speculator:
+    """
+    max_concurrent: Speculative requests in flight at most, starting another one cancels the oldest.
+    max_distance:   Maximum perceptual hash distance (bits) between a speculated and the final frame.
+    """
+
+    def __init__(self, max_concurrent=1, max_distance=4):
+        self.max_concurrent = max_concurrent
+        self.max_distance = max_distance
+        self.pending = []
+        self.started = 0
+        self.committed = 0
+        self.discarded = 0
+        self.superseded = 0
+        # Seconds the committed requests had already been running when they were committed.
+        self.head_start = 0.0
+
+    def covers(self, phash):
+        """
+        Whether a pending request was started on a frame matching phash.
+        """
+        return any(hamming_distance(phash, request.phash) <= self.max_distance for request in self.pending)
+
+    def start(self, phash, payload, coroutine):
+        while len(self.pending) >= self.max_concurrent:
+            self.pending.pop(0).task.cancel()
+            self.superseded += 1
+        task = asyncio.ensure_future(coroutine)
+        task.add_done_callback(retrieve)
+        self.pending.append(SpeculativeRequest(phash, payload, task, time.monotonic()))
+        self.started += 1
+
+    def take(self, phash):
+        """
+        Pending request closest to phash within max_distance, or None. The other requests are cancelled.
+        """
+        best = None
+        for request in self.pending:
+            distance = hamming_distance(phash, request.phash)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, request)
+        request = best[1] if best is not None else None
+        for other in self.pending:
+            if other is not request:
+                other.task.cancel()
+                self.discarded += 1
+        self.pending = []
+        if request is not None:
+            self.committed += 1
+            self.head_start += time.monotonic() - request.started
+        return request
+
+    def discard(self):
+        for request in self.pending:
+            request.task.cancel()
+            self.discarded += 1
+        self.pending = []
+
+    def stats(self):
+        return {
+            "started": self.started,
+            "committed": self.committed,
+            "discarded": self.discarded,
+            "superseded": self.superseded,
+            "hit_rate": self.committed / self.started if self.started else 0.0,
+            "head_start": round(self.head_start, 3),
+        }
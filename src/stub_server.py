@@ -0,0 +1,199 @@
+"""
+Local OpenAI compatible chat completion server for benchmarks, it stands in for the TGI endpoint.
+Example: `python src/stub_server.py --port 8080 --responses responses.json --latency 0.5`
+or, replaying a recorded episode: `python src/stub_server.py --port 8080 --episode episodes/youtube`
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_RESPONSE = "Thought: The task is done.\nAction: finished(content='')"
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # Bursts of concurrent requests overflow the default listen backlog of 5 and get refused.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class StubServer:
+    """
+    responses:     Completion texts, served in order and repeated.
+    latency:       Seconds to wait before answering.
+    fail_status:   HTTP status returned for injected failures (e.g. 503, 429).
+    fail_first:    Number of first requests that fail.
+    fail_rate:     Probability that any other request fails.
+    token_latency: Seconds to generate a chunk of `chunk_size` characters, streamed requests get them one by one.
+    """
+
+    def __init__(self, responses=None, host="127.0.0.1", port=0, latency=0.0, fail_status=503, fail_first=0, fail_rate=0.0, token_latency=0.0, chunk_size=4):
+        self.responses = itertools.cycle(responses or [DEFAULT_RESPONSE])
+        self.latency = latency
+        self.fail_status = fail_status
+        self.fail_first = fail_first
+        self.fail_rate = fail_rate
+        self.token_latency = token_latency
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.cancelled_streams = 0
+        # Requests whose client went away before the answer, e.g. cancelled ones.
+        self.cancelled_requests = 0
+        # Requests being answered now and the most at any time.
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = StubHTTPServer((host, port), self.__handler__())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def next_response(self, request):
+        with self.lock:
+            return next(self.responses)
+
+    def should_fail(self):
+        with self.lock:
+            self.requests += 1
+            return self.requests <= self.fail_first or random.random() < self.fail_rate
+
+    def completion(self, text, request):
+        return {
+            "id": f"chatcmpl-stub-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "tgi"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": len(json.dumps(request.get("messages", []))) // 4, "completion_tokens": len(text) // 4, "total_tokens": 0},
+        }
+
+    def pieces(self, text):
+        return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+
+    def chunk(self, request, delta, finish_reason=None):
+        return {
+            "id": f"chatcmpl-stub-{self.requests}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "tgi"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def __handler__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                with stub.lock:
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    self.answer()
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+
+            def answer(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.should_fail():
+                    self.send_json(stub.fail_status, {"error": {"message": "Injected failure", "type": "stub"}})
+                    return
+                if request.get("stream"):
+                    self.send_stream(request, stub.next_response(request))
+                else:
+                    text = stub.next_response(request)
+                    if stub.token_latency:
+                        time.sleep(stub.token_latency * len(stub.pieces(text)))
+                    self.send_json(200, stub.completion(text, request))
+
+            def send_stream(self, request, text):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                events = [stub.chunk(request, {"role": "assistant", "content": ""})]
+                events += [stub.chunk(request, {"content": piece}) for piece in stub.pieces(text)]
+                events.append(stub.chunk(request, {}, "stop"))
+                try:
+                    for event in events:
+                        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                        if stub.token_latency:
+                            time.sleep(stub.token_latency)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    with stub.lock:
+                        stub.cancelled_streams += 1
+
+            def send_json(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                try:
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+                    with stub.lock:
+                        stub.cancelled_requests += 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI compatible stub server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--responses", type=str, default=None, help="JSON file with a list of completion texts")
+    parser.add_argument("--episode", type=str, default=None, help="Recorded episode directory whose responses are replayed")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fail_status", type=int, default=503)
+    parser.add_argument("--fail_first", type=int, default=0)
+    parser.add_argument("--fail_rate", type=float, default=0.0)
+    parser.add_argument("--token_latency", type=float, default=0.0)
+    args = parser.parse_args()
+    responses = None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+    if args.episode:
+        from episode import Episode
+        responses = Episode.load(args.episode).responses()
+    server = StubServer(responses, args.host, args.port, args.latency, args.fail_status, args.fail_first, args.fail_rate, args.token_latency)
+    print(f"Serving on {server.url}")
+    server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
-from openai import OpenAI
 import json
 import os
-from time import sleep
-from typing import List, TypedDict, Literal, Union
+import time
+from typing import List, NamedTuple, Optional, TypedDict, Literal, Union
 from constants import TARS_SYSTEM_PROMPT, HF_TARS_BASE_ENDPOINT, HF_TARS_DPO_ENDPOINT
 from utils import track_usage, encode_image
+from inference_client import InferenceClient, InferenceError, RetryPolicy
+from action_parser import ActionParseError, action_section_end, parse_actions
+from prompt import PromptAssembler, message_content, parse_manager_response
+from shortcuts import DEFAULT_SHORTCUTS
 
 class TextMessageContent(TypedDict):
     type: Literal["text"]
@@ -25,16 +28,39 @@ SYSTEM_PROMPTS = {
     "default": TARS_SYSTEM_PROMPT,
 }
 
+def create_inference_client(base_type="dpo", api_key=os.getenv("HF_API_KEY"), failover=False, retry_policy=RetryPolicy(), http_client=None):
+    """
+    InferenceClient for the DPO or SFT endpoint, with the other one as failover target when enabled.
+    """
+    endpoints = [("dpo", HF_TARS_DPO_ENDPOINT), ("sft", HF_TARS_BASE_ENDPOINT)]
+    if base_type != "dpo":
+        endpoints.reverse()
+    print(f"Using {endpoints[0][0]}:{endpoints[0][1]} endpoint" + (f", failover to {endpoints[1][0]}:{endpoints[1][1]}." if failover else "."))
+    return InferenceClient(endpoints, api_key=api_key, retry_policy=retry_policy, failover=failover, http_client=http_client)
+
 class TARS:
-    def __init__(self, user_instruction, system_name, base_type="dpo", api_key = os.getenv("HF_API_KEY"), model="tgi"):
-        url = HF_TARS_DPO_ENDPOINT if base_type == "dpo" else HF_TARS_BASE_ENDPOINT
-        print(f"Using {base_type}:{url} endpoint.")
-        self.client = OpenAI(base_url=url, api_key=api_key)
+    def __init__(self, user_instruction, system_name, base_type="dpo", api_key = os.getenv("HF_API_KEY"), model="tgi", response_cache=None, failover=False, retry_policy=RetryPolicy(), http_client=None, inference_client=None, tracer=None, max_prompt_tokens=None):
+        """
+        An InferenceClient shared between sessions can be passed as inference_client, so its circuit
+        breakers and latency histograms cover all of them. Otherwise one is created for this instance.
+        Token usage of every response is recorded as a "usage" event on tracer (see tracing.Tracer), the
+        estimated prompt tokens of every request as a "prompt" event.
+        Requests are assembled by a PromptAssembler (see prompt.py) within max_prompt_tokens.
+        """
+        self.owns_client = inference_client is None
+        if inference_client is None:
+            inference_client = create_inference_client(base_type, api_key, failover=failover, retry_policy=retry_policy, http_client=http_client)
+        self.client = inference_client
         self.model = model
         self.system_name = system_name
         self.user_instruction = user_instruction
         self.system_prompt = SYSTEM_PROMPTS.get(system_name, None)
+        self.max_prompt_tokens = max_prompt_tokens
+        # Rendered once per task, or on the first request that brings its own system_prompt.
+        self.prompt = PromptAssembler(self.system_prompt, user_instruction, max_prompt_tokens, DEFAULT_SHORTCUTS.reference_block()) if self.system_prompt is not None else None
         self.messages = []
+        self.response_cache = response_cache
+        self.tracer = tracer
 
     def __fix_message_serizalization__(self, messages: List[MessageDict]):
         for i in range(len(messages)):
@@ -45,7 +71,7 @@ class TARS:
 
     def __inference__(self, messages: List[MessageDict]=[], usage_tracking_jsonl=None, **kwargs):
         """
-        Inference language models with retry mechanism.
+        Inference language models with retry mechanism (see inference_client.InferenceClient).
         System name is used to fetch system prompt (first message to system) from system_message dictionary.
         If system_name is not provided, messages list is used as it is.
         If system_name is provided, A system message is placed before all messages in the list.
@@ -54,90 +80,112 @@ class TARS:
         messages = self.__fix_message_serizalization__(messages)
         if not self.__validate_messages__(messages):
             raise Exception("Invalid messages.")
-        max_retry = 5
-        sleep_sec = 20
-        while True:
-            try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    **kwargs,
-                )
-                if usage_tracking_jsonl:
-                    usage = track_usage(response, api_key="hf-inference-endpoint")
-                    with open(usage_tracking_jsonl, "a") as f:
-                        f.write(json.dumps(usage) + "\n")
-                return response.choices[0].message.content
-            except Exception as e:
-                print("Error in Sending request to OpenAI API.",)
-            print(f"Sleep {sleep_sec} before retry...")
-            sleep(sleep_sec)
-            max_retry -= 1
-            if max_retry < 0:
-                print(f"Failed after {max_retry} retries...")
-                return None
-            
-    def __prune_message__(self, messages: List[MessageDict]):
-        """
-        Prune the messages to remove the irrelevant messages to avoid hitting the maximum context limit of LLM/VLM.
-        Irrelevant message is defined as:
-            - All the ImageMessageContent before last assistant message.
-        """
-        last_assistant_message_index = None
-        pruned_messages = []
-        for i in range(len(messages)-1, -1, -1):
-            if messages[i]['role'] == "system" or messages[i]["role"] == "assistant":
-                last_assistant_message_index = i
-                break
-        if last_assistant_message_index is not None:
-            for message in messages[:last_assistant_message_index+1]:
-                if message['role'] == "user":
-                    if type(message["content"]) == list:
-                        current_message = []
-                        for content in message["content"]:
-                            if content["type"] != "image_url":
-                                current_message.append(content)
-                        pruned_messages.append({"role": "user", "content": current_message})
-                    else:
-                        if message["content"]["type"] != "image_url":
-                            pruned_messages.append(message)
-                else:
-                    pruned_messages.append(message)
-            return pruned_messages
-        else:
-            return messages
-        
+        try:
+            response = self.client.create(model=self.model, messages=messages, **kwargs)
+        except InferenceError as e:
+            if e.kind == "context_overflow" and len(messages) > 2:
+                print("Context overflow, retrying with the last user message only.")
+                return self.__inference__(messages=[messages[0], messages[-1]], usage_tracking_jsonl=usage_tracking_jsonl, **kwargs)
+            print("Error in Sending request to OpenAI API: ", e)
+            return None
+        self.__track_usage__(response, usage_tracking_jsonl)
+        return response.choices[0].message.content
+
+    def __track_usage__(self, response, usage_tracking_jsonl=None):
+        if usage_tracking_jsonl is None and self.tracer is None:
+            return
+        usage = track_usage(response, api_key="hf-inference-endpoint")
+        if self.tracer is not None:
+            self.tracer.event("usage", **{key: value for key, value in usage.items() if key != "api_key"})
+        if usage_tracking_jsonl:
+            with open(usage_tracking_jsonl, "a") as f:
+                f.write(json.dumps(usage) + "\n")
+
     def inference(self, messages: List[MessageDict]=[], usage_tracking_jsonl=None, **kwargs):
         """
         Public method to perform inference.
         """
         if not messages:
             raise Exception("Messages are not provided.")
-        system_prompt = None
-        formatted_system_prompt = None
-        user_instruction = self.user_instruction
-        if self.system_prompt is not None:
-            system_prompt = self.system_prompt
-        elif self.system_name is not None:
-            system_prompt = f"{self.system_name}\n{user_instruction}" if SYSTEM_PROMPTS.get(self.system_name, None) else None
-        elif kwargs.get("system_prompt", None):
-            system_prompt = kwargs["system_prompt"]
-        else:
-            raise Exception("System prompt is not provided.")
-        formatted_system_prompt = f"{system_prompt}\n## User Instruction\n{user_instruction}"
-        self.system_prompt = formatted_system_prompt
-        messages = [
-            MessageDict(role="system", content=[TextMessageContent(type="text", text=formatted_system_prompt)]),
-            *messages[-3:],
-            # *self.__prune_message__(messages)
-        ]
-        if kwargs is None:
-            kwargs = {}
+        cache_key, cached_response = self.__cache_lookup__(messages)
+        if cached_response is not None:
+            return cached_response
+        messages, kwargs = self.__prepare_request__(messages, kwargs)
+        response = self.__inference__(messages=messages, usage_tracking_jsonl=usage_tracking_jsonl, **kwargs)
+        self.__cache_store__(cache_key, response)
+        return response
+
+    def __cache_lookup__(self, messages: List[MessageDict]):
+        if self.response_cache is None:
+            return None, None
+        # Responses to the same screen under another plan are not reused.
+        plan_context = self.prompt.plan_context if self.prompt is not None else None
+        cache_key = self.response_cache.key(self.user_instruction if plan_context is None else f"{self.user_instruction}\n{plan_context}", messages)
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            print("Response cache hit.")
+        return cache_key, cached_response
+
+    def __cache_store__(self, cache_key, response):
+        if self.response_cache is not None:
+            self.response_cache.put(cache_key, response)
+
+    def __prepare_request__(self, messages: List[MessageDict], kwargs):
+        """
+        Place the system message before the messages and fill default sampling arguments.
+        Messages are sent as given (see history.ConversationHistory for bounding them) unless they are
+        over max_prompt_tokens, leading assistant messages are dropped so the conversation starts with
+        a user message. The system message is the same for every request of the task.
+        """
+        kwargs = dict(kwargs or {})
+        system_prompt = kwargs.pop("system_prompt", None)
+        if self.prompt is None or (system_prompt is not None and system_prompt != self.prompt.system_prompt):
+            if system_prompt is None:
+                raise Exception("System prompt is not provided.")
+            self.prompt = PromptAssembler(system_prompt, self.user_instruction, self.max_prompt_tokens, DEFAULT_SHORTCUTS.reference_block())
+        messages, tokens = self.prompt.assemble(messages)
+        if self.tracer is not None:
+            self.tracer.event("prompt", estimated_tokens=tokens, messages=len(messages))
         if kwargs.get("max_tokens", None) is None:
             kwargs["max_tokens"] = 2048
         if kwargs.get("temperature", None) is None:
             kwargs["temperature"] = 0.0
-        return self.__inference__(messages=messages, usage_tracking_jsonl=usage_tracking_jsonl, **kwargs)
+        return messages, kwargs
+
+    def __prepare_planning_request__(self, messages: List[MessageDict], kwargs):
+        """
+        The manager prompt (see prompt.PromptAssembler.manager_prompt) with the screenshots of the last
+        user message, sent without the system message and conversation of the action requests.
+        """
+        if self.prompt is None:
+            raise Exception("System prompt is not provided.")
+        images = [item for item in message_content(messages[-1]) if item["type"] == "image_url"] if messages else []
+        kwargs = dict(kwargs or {})
+        if kwargs.get("max_tokens", None) is None:
+            kwargs["max_tokens"] = 1024
+        if kwargs.get("temperature", None) is None:
+            kwargs["temperature"] = 0.0
+        return [{"role": "user", "content": [{"type": "text", "text": self.prompt.manager_prompt()}, *images]}], kwargs
+
+    def __update_plan__(self, response):
+        if response is None:
+            return False
+        parsed = parse_manager_response(response)
+        if parsed is None:
+            print("Invalid planning response, keeping the current plan: ", response)
+            return False
+        thought, plan, subgoal = parsed
+        self.prompt.set_plan(plan, subgoal, thought)
+        print(f"Plan updated, current subgoal: {subgoal}")
+        return True
+
+    def plan(self, messages: List[MessageDict]=[], **kwargs):
+        """
+        Ask for an updated plan on the current screen (the last user message of messages). The plan and
+        subgoal are then sent with every request. Returns False when no valid plan was received.
+        """
+        messages, kwargs = self.__prepare_planning_request__(messages, kwargs)
+        return self.__update_plan__(self.__inference__(messages=messages, **kwargs))
     
     def __validate_messages__(self, messages: List[MessageDict]):
         try:
@@ -157,6 +205,136 @@ class TARS:
             print(e)
             return False
     
+class StreamResult(NamedTuple):
+    """
+    Outcome of AsyncTARS.stream_inference, times are in seconds from the start of the call.
+    actions holds the parsed actions handed to on_action, empty when none were dispatched early.
+    """
+    text: Optional[str]
+    actions: list
+    time_to_first_token: Optional[float]
+    time_to_action: Optional[float]
+    total_time: float
+    cancelled: bool
+
+
+class AsyncTARS(TARS):
+    """
+    TARS on top of AsyncOpenAI, so requests can overlap with capture and actuation.
+    Pass a shared httpx.AsyncClient as http_client to reuse one connection pool across sessions.
+    """
+    def __init__(self, user_instruction, system_name, base_type="dpo", api_key=os.getenv("HF_API_KEY"), model="tgi", response_cache=None, http_client=None, request_timeout=None, failover=False, retry_policy=RetryPolicy(), inference_client=None, tracer=None, max_prompt_tokens=None):
+        if request_timeout is not None:
+            retry_policy = retry_policy._replace(request_timeout=request_timeout)
+        super().__init__(user_instruction, system_name, base_type=base_type, api_key=api_key, model=model, response_cache=response_cache, failover=failover, retry_policy=retry_policy, http_client=http_client, inference_client=inference_client, tracer=tracer, max_prompt_tokens=max_prompt_tokens)
+
+    async def __inference__(self, messages: List[MessageDict]=[], usage_tracking_jsonl=None, **kwargs):
+        messages = self.__fix_message_serizalization__(messages)
+        if not self.__validate_messages__(messages):
+            raise Exception("Invalid messages.")
+        try:
+            response = await self.client.acreate(model=self.model, messages=messages, **kwargs)
+        except InferenceError as e:
+            if e.kind == "context_overflow" and len(messages) > 2:
+                print("Context overflow, retrying with the last user message only.")
+                return await self.__inference__(messages=[messages[0], messages[-1]], usage_tracking_jsonl=usage_tracking_jsonl, **kwargs)
+            print("Error in Sending request to OpenAI API: ", e)
+            return None
+        self.__track_usage__(response, usage_tracking_jsonl)
+        return response.choices[0].message.content
+
+    async def inference(self, messages: List[MessageDict]=[], usage_tracking_jsonl=None, **kwargs):
+        if not messages:
+            raise Exception("Messages are not provided.")
+        cache_key, cached_response = self.__cache_lookup__(messages)
+        if cached_response is not None:
+            return cached_response
+        messages, kwargs = self.__prepare_request__(messages, kwargs)
+        response = await self.__inference__(messages=messages, usage_tracking_jsonl=usage_tracking_jsonl, **kwargs)
+        self.__cache_store__(cache_key, response)
+        return response
+
+    async def plan(self, messages: List[MessageDict]=[], **kwargs):
+        messages, kwargs = self.__prepare_planning_request__(messages, kwargs)
+        return self.__update_plan__(await self.__inference__(messages=messages, **kwargs))
+
+    async def stream_inference(self, messages: List[MessageDict]=[], on_action=None, cancel_after_action=True, **kwargs):
+        """
+        Streamed inference: the Action section is parsed as soon as it is complete and handed to
+        `on_action(actions)` while the rest of the response is still being generated.
+        With cancel_after_action the stream is closed right after, which stops generation on the server.
+        Usage is not tracked for streamed requests.
+        """
+        if not messages:
+            raise Exception("Messages are not provided.")
+        started = time.monotonic()
+        cache_key, cached_response = self.__cache_lookup__(messages)
+        if cached_response is not None:
+            actions = self.__dispatch__(cached_response, on_action)
+            elapsed = time.monotonic() - started
+            return StreamResult(cached_response, actions, elapsed, elapsed if actions else None, elapsed, False)
+        messages, kwargs = self.__prepare_request__(messages, kwargs)
+        messages = self.__fix_message_serizalization__(messages)
+        if not self.__validate_messages__(messages):
+            raise Exception("Invalid messages.")
+        try:
+            stream = await self.client.acreate(model=self.model, messages=messages, stream=True, **kwargs)
+        except InferenceError as e:
+            print("Error in Sending request to OpenAI API: ", e)
+            return StreamResult(None, [], None, None, time.monotonic() - started, False)
+        text = ""
+        actions = []
+        first_token = None
+        action_time = None
+        cancelled = False
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                text += delta
+                if action_time is not None:
+                    continue
+                end = action_section_end(text)
+                if end is None:
+                    continue
+                action_time = time.monotonic() - started
+                actions = self.__dispatch__(text[:end], on_action)
+                if actions and cancel_after_action:
+                    cancelled = True
+                    text = text[:end]
+                    break
+        except Exception as e:
+            # The connection broke mid stream, keep what was generated so far.
+            print("Error while streaming the response: ", e)
+            if not text:
+                text = None
+        finally:
+            await stream.close()
+        if not actions:
+            action_time = None
+        self.__cache_store__(cache_key, text)
+        return StreamResult(text, actions, first_token, action_time, time.monotonic() - started, cancelled)
+
+    def __dispatch__(self, text, on_action):
+        """
+        Parse the actions of a (partial) response and hand them to on_action, parse errors are left to
+        the caller that parses the full response.
+        """
+        try:
+            actions = parse_actions(text)
+        except ActionParseError:
+            return []
+        if actions and on_action is not None:
+            on_action(actions)
+        return actions
+
+    async def close(self):
+        if self.owns_client:
+            await self.client.aclose()
+
 def test():
         tars_instance = TARS(
             base_type="dpo",
@@ -181,6 +359,7 @@ def test():
 def raw_test():
     instruction = "Pause Video Player"
     screenshot_path = "/Users/lokendrabairwa/Pictures/screenshot.png"
+    from openai import OpenAI
     client = OpenAI(
         base_url=HF_TARS_DPO_ENDPOINT, 
     )
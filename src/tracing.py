@@ -0,0 +1,119 @@
+"""
+Timed spans for the stages of the agent loop (capture, encode, base64, request, parse, actuation, settle).
+Spans are written to a JSONL sink, one record per line, and summarized per stage.
+
+    {"type": "span", "name": "capture", "span_id": "...", "start": 1733455676.1, "duration": 0.16,
+     "status": "ok", "attributes": {"task_id": "...", "device": "emulator-5554", "step": 3}}
+"""
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+def percentile(values, q):
+    """
+    Nearest rank percentile of a list of numbers, q in [0, 1].
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class JsonlSink:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Tracer:
+    """
+    Records spans tagged with the tracer's attributes (task_id, device, step, ...).
+    child(**attributes) returns a tracer with more attributes that shares the sink and the per stage
+    durations, so a fleet run or a task summarizes over all of its steps.
+    Failed or cancelled spans go to the sink but are left out of the summary.
+    """
+
+    def __init__(self, sink=None, **attributes):
+        self.sink = sink
+        self.attributes = attributes
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def child(self, **attributes):
+        tracer = Tracer(self.sink, **{**self.attributes, **attributes})
+        tracer.durations = self.durations
+        tracer.lock = self.lock
+        return tracer
+
+    @contextmanager
+    def span(self, name, **attributes):
+        start = time.time()
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, start=start, error=error, **attributes)
+
+    def record(self, name, duration, start=None, error=None, **attributes):
+        """
+        Record a span measured elsewhere, e.g. the encode time reported by preprocess_screenshot.
+        """
+        if error is None:
+            with self.lock:
+                self.durations.setdefault(name, []).append(duration)
+        if self.sink is not None:
+            record = {
+                "type": "span",
+                "name": name,
+                "span_id": uuid.uuid4().hex[:16],
+                "start": start if start is not None else time.time() - duration,
+                "duration": duration,
+                "status": "ok" if error is None else "error",
+                "attributes": {**self.attributes, **attributes},
+            }
+            if error is not None:
+                record["error"] = error
+            self.sink.write(record)
+
+    def event(self, name, **attributes):
+        """
+        Point in time record, e.g. token usage of a response.
+        """
+        if self.sink is not None:
+            self.sink.write({"type": "event", "name": name, "time": time.time(), "attributes": {**self.attributes, **attributes}})
+
+    def summary(self):
+        with self.lock:
+            durations = {name: list(values) for name, values in self.durations.items()}
+        return {
+            name: {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+            }
+            for name, values in durations.items()
+        }
+
+    def print_summary(self):
+        for name, stats in self.summary().items():
+            print(f"{name:<10} n={stats['count']:<4} p50={stats['p50']*1000:8.1f}ms p95={stats['p95']*1000:8.1f}ms total={stats['total']:7.2f}s")
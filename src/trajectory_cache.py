@@ -0,0 +1,127 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+from response_cache import hamming_distance
+
+
+def instruction_key(instruction):
+    """
+    Instructions match regardless of case, punctuation and spacing.
+    """
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", instruction.lower()).split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+class TrajectoryStep(NamedTuple):
+    phash: int
+    response: str
+    actions: list
+
+
+class Trajectory(NamedTuple):
+    id: int
+    instruction: str
+    steps: list
+
+    def matches(self, index, phash, max_distance):
+        """
+        Whether the screen (perceptual hash) at step `index` looks like the one recorded.
+        """
+        return index < len(self.steps) and hamming_distance(phash, self.steps[index].phash) <= max_distance
+
+
+class TrajectoryStore:
+    """
+    Action sequences of successful runs, keyed on the normalized instruction, with the perceptual hash of
+    the screen every step was taken on (see response_cache.perceptual_hash).
+    A new run of a stored instruction replays the actions as long as the screens match within
+    `max_distance` bits and falls back to the model once they diverge.
+    Kept in sqlite (in memory without `path`), at most `max_trajectories` evicted least recently used;
+    trajectories failing more than half of at least `min_replays` replays are dropped.
+    """
+
+    def __init__(self, path=None, max_trajectories=256, max_distance=5, min_replays=3):
+        self.max_trajectories = max_trajectories
+        self.max_distance = max_distance
+        self.min_replays = min_replays
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS trajectories (id INTEGER PRIMARY KEY, instruction_key TEXT UNIQUE, instruction TEXT, "
+            "steps TEXT, created REAL, last_used REAL, replays INTEGER DEFAULT 0, successes INTEGER DEFAULT 0, replayed_steps INTEGER DEFAULT 0)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS trajectories_last_used ON trajectories (last_used)")
+        self.db.commit()
+
+    def lookup(self, instruction):
+        with self.lock:
+            row = self.db.execute("SELECT id, instruction, steps FROM trajectories WHERE instruction_key = ?", (instruction_key(instruction),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE trajectories SET last_used = ? WHERE id = ?", (time.time(), row[0]))
+            self.db.commit()
+        steps = [TrajectoryStep(int(step["phash"], 16), step["response"], step["actions"]) for step in json.loads(row[2])]
+        return Trajectory(row[0], row[1], steps)
+
+    def record(self, instruction, steps):
+        """
+        Store the steps of a successful run, replacing an earlier trajectory of the same instruction
+        and its replay counts.
+        """
+        data = json.dumps([{"phash": f"{step.phash:016x}", "response": step.response, "actions": step.actions} for step in steps])
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO trajectories (instruction_key, instruction, steps, created, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(instruction_key) DO UPDATE SET steps = excluded.steps, created = excluded.created, last_used = excluded.last_used, "
+                "replays = 0, successes = 0, replayed_steps = 0",
+                (instruction_key(instruction), instruction, data, now, now),
+            )
+            self.db.execute(
+                "DELETE FROM trajectories WHERE id NOT IN (SELECT id FROM trajectories ORDER BY last_used DESC LIMIT ?)",
+                (self.max_trajectories,),
+            )
+            self.db.commit()
+
+    def record_replay(self, trajectory, replayed_steps, success):
+        """
+        Outcome of a replay: the number of steps replayed before finishing or diverging.
+        """
+        with self.lock:
+            self.db.execute(
+                "UPDATE trajectories SET replays = replays + 1, successes = successes + ?, replayed_steps = replayed_steps + ? WHERE id = ?",
+                (int(success), replayed_steps, trajectory.id),
+            )
+            self.db.execute(
+                "DELETE FROM trajectories WHERE id = ? AND replays >= ? AND successes * 2 < replays",
+                (trajectory.id, self.min_replays),
+            )
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            count, replays, successes, replayed_steps = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(replays), 0), COALESCE(SUM(successes), 0), COALESCE(SUM(replayed_steps), 0) FROM trajectories"
+            ).fetchone()
+        return {
+            "trajectories": count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "replays": replays,
+            "success_rate": successes / replays if replays else 0.0,
+            "replayed_steps": replayed_steps,
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,232 @@
+"""
+UI hierarchy from `uiautomator dump`, indexed for local target lookups and coordinate snapping.
+Used as a fast path in front of the model: a target that can be found by its label is tapped without a
+model round trip, and points predicted by the model are snapped onto the clickable element they aim at.
+"""
+import asyncio
+import re
+import subprocess
+import xml.etree.ElementTree as ElementTree
+from typing import NamedTuple, Optional, Tuple
+from utils import adb_command
+
+BOUNDS_PATTERN = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+# Instructions that only ask to tap one labelled element, e.g. "Tap the element labelled Search".
+SIMPLE_TARGET_PATTERN = re.compile(
+    r"""^\s*(?:tap|click|press|select)\s+(?:on\s+)?(?:the\s+)?
+    (?:(?:element|button|icon|tab|item|link)\s+)?
+    (?:(?:labell?ed|named|called|saying|with\s+(?:the\s+)?(?:text|label))\s+)?
+    (?P<quote>["'“‘]?)(?P<label>[^"'“”‘’]+?)(?P=quote)[”’]?
+    (?:\s+(?:element|button|icon|tab|item|link))?\s*\.?\s*$""",
+    re.IGNORECASE | re.VERBOSE,
+)
+# Labels that are really several steps ("search and type cats") are left to the model.
+COMPOUND_PATTERN = re.compile(r"\b(?:and|then|after)\b|[,;]", re.IGNORECASE)
+GRID_CELL = 128
+DUMP_PATH = "/sdcard/window_dump.xml"
+
+
+def parse_bounds(bounds):
+    match = BOUNDS_PATTERN.match(bounds or "")
+    if not match:
+        return None
+    return tuple(int(value) for value in match.groups())
+
+
+def simple_target(instruction):
+    """
+    Label of the element a one step "tap X" instruction refers to, or None for anything else.
+    """
+    match = SIMPLE_TARGET_PATTERN.match(instruction or "")
+    if not match:
+        return None
+    label = match.group("label").strip()
+    if COMPOUND_PATTERN.search(label) or len(label.split()) > 5:
+        return None
+    return label
+
+
+class UiElement(NamedTuple):
+    index: int
+    text: str
+    resource_id: str
+    content_desc: str
+    class_name: str
+    bounds: Tuple[int, int, int, int]
+    clickable: bool
+    enabled: bool
+    # Index of the closest clickable element containing this one (itself when clickable), or None.
+    clickable_index: Optional[int]
+
+    @property
+    def center(self):
+        x1, y1, x2, y2 = self.bounds
+        return (x1 + x2) // 2, (y1 + y2) // 2
+
+    @property
+    def area(self):
+        x1, y1, x2, y2 = self.bounds
+        return max(0, x2 - x1) * max(0, y2 - y1)
+
+    def contains(self, x, y):
+        x1, y1, x2, y2 = self.bounds
+        return x1 <= x < x2 and y1 <= y < y2
+
+    def distance(self, x, y):
+        """
+        Distance in pixels from the point to the element bounds, 0 inside.
+        """
+        x1, y1, x2, y2 = self.bounds
+        dx = max(x1 - x, 0, x - (x2 - 1))
+        dy = max(y1 - y, 0, y - (y2 - 1))
+        return (dx * dx + dy * dy) ** 0.5
+
+
+class UiHierarchy:
+    """
+    Flat list of the elements of a dump, in document order, with lookup indexes:
+    - labels: lower cased text and content-desc to element indexes
+    - resource ids: full id and the part after ":id/" to element indexes
+    - a grid of GRID_CELL pixel cells to the clickable elements overlapping them, for snapping.
+    """
+
+    def __init__(self, elements):
+        self.elements = elements
+        self.labels = {}
+        self.resource_ids = {}
+        self.grid = {}
+        for element in elements:
+            for label in (element.text, element.content_desc):
+                if label:
+                    self.labels.setdefault(label.strip().lower(), []).append(element.index)
+            if element.resource_id:
+                self.resource_ids.setdefault(element.resource_id, []).append(element.index)
+                short_id = element.resource_id.split(":id/", 1)[-1]
+                if short_id != element.resource_id:
+                    self.resource_ids.setdefault(short_id, []).append(element.index)
+            if element.clickable and element.enabled and element.area:
+                x1, y1, x2, y2 = element.bounds
+                for cell_x in range(max(x1, 0) // GRID_CELL, max(x2 - 1, 0) // GRID_CELL + 1):
+                    for cell_y in range(max(y1, 0) // GRID_CELL, max(y2 - 1, 0) // GRID_CELL + 1):
+                        self.grid.setdefault((cell_x, cell_y), []).append(element.index)
+
+    def __len__(self):
+        return len(self.elements)
+
+    @classmethod
+    def from_xml(cls, xml):
+        """
+        Parse a `uiautomator dump` document (str or bytes).
+        """
+        root = ElementTree.fromstring(xml)
+        elements = []
+        # (node, index of the closest clickable ancestor)
+        stack = [(child, None) for child in reversed(list(root))]
+        while stack:
+            node, clickable_ancestor = stack.pop()
+            bounds = parse_bounds(node.get("bounds"))
+            if bounds is not None:
+                clickable = node.get("clickable") == "true" or node.get("long-clickable") == "true"
+                index = len(elements)
+                clickable_index = index if clickable else clickable_ancestor
+                elements.append(UiElement(
+                    index,
+                    node.get("text", ""),
+                    node.get("resource-id", ""),
+                    node.get("content-desc", ""),
+                    node.get("class", ""),
+                    bounds,
+                    clickable,
+                    node.get("enabled", "true") == "true",
+                    clickable_index,
+                ))
+                clickable_ancestor = clickable_index
+            stack.extend((child, clickable_ancestor) for child in reversed(list(node)))
+        return cls(elements)
+
+    def find(self, label):
+        """
+        Element to tap for a label: exact text/content-desc (case insensitive), then resource id, then a
+        unique whole word partial label match. The closest clickable ancestor is returned when there is one.
+        Returns None when the label is missing or ambiguous.
+        """
+        key = label.strip().lower()
+        candidates = self.labels.get(key) or self.resource_ids.get(label.strip())
+        if not candidates:
+            word = re.compile(rf"\b{re.escape(key)}\b")
+            candidates = [index for text, indexes in self.labels.items() if word.search(text) for index in indexes]
+        targets = {self.__target__(index) for index in candidates}
+        targets.discard(None)
+        if len(targets) != 1:
+            return None
+        return self.elements[targets.pop()]
+
+    def __target__(self, index):
+        element = self.elements[index]
+        if element.clickable_index is not None:
+            target = self.elements[element.clickable_index]
+            return target.index if target.enabled else None
+        return index if element.enabled and element.area else None
+
+    def snap(self, x, y, max_distance=48):
+        """
+        Clickable element hit by a point: the smallest one containing it, or the closest one at most
+        `max_distance` pixels away. Returns None when there is none.
+        """
+        best = None
+        reach = int(max_distance) // GRID_CELL + 1
+        cell_x, cell_y = int(x) // GRID_CELL, int(y) // GRID_CELL
+        seen = set()
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                for index in self.grid.get((cell_x + dx, cell_y + dy), ()):
+                    if index in seen:
+                        continue
+                    seen.add(index)
+                    element = self.elements[index]
+                    distance = element.distance(x, y)
+                    if distance > max_distance:
+                        continue
+                    rank = (distance, element.area)
+                    if best is None or rank < best[0]:
+                        best = (rank, element)
+        return best[1] if best is not None else None
+
+
+def extract_hierarchy_xml(output):
+    """
+    The XML document in `uiautomator dump /dev/tty` output, which ends with a status line.
+    """
+    text = output.decode("utf-8", "replace") if isinstance(output, bytes) else output
+    start = text.find("<?xml")
+    if start == -1:
+        start = text.find("<hierarchy")
+    end = text.rfind("</hierarchy>")
+    if start == -1 or end == -1:
+        return None
+    return text[start:end + len("</hierarchy>")]
+
+
+def dump_ui_hierarchy(adb_path, timeout=10):
+    """
+    Dump the current UI hierarchy, streamed over `exec-out` when the device supports dumping to
+    /dev/tty, otherwise through a file on the device. Returns a UiHierarchy or None on failure.
+    """
+    try:
+        result = subprocess.run(adb_command(adb_path, "exec-out", "uiautomator", "dump", "/dev/tty"), capture_output=True, timeout=timeout)
+        xml = extract_hierarchy_xml(result.stdout)
+        if xml is None:
+            subprocess.run(adb_command(adb_path, "shell", "uiautomator", "dump", DUMP_PATH), capture_output=True, timeout=timeout)
+            result = subprocess.run(adb_command(adb_path, "exec-out", "cat", DUMP_PATH), capture_output=True, timeout=timeout)
+            xml = extract_hierarchy_xml(result.stdout)
+        if xml is None:
+            print("UI hierarchy dump failed: ", result.stderr.decode("utf-8", "replace").strip())
+            return None
+        return UiHierarchy.from_xml(xml)
+    except Exception as e:
+        print("UI hierarchy dump failed: ", e)
+        return None
+
+
+async def dump_ui_hierarchy_async(adb_path, timeout=10):
+    return await asyncio.to_thread(dump_ui_hierarchy, adb_path, timeout)
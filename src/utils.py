@@ -1,16 +1,21 @@
+import asyncio
 import base64
+import io
 import time
+import shlex
 import subprocess
 from PIL import Image
 import os
-import re
+from action_parser import parse_actions, ActionParseError
 
-def track_usage(res_json, api_key):
+def track_usage(response, api_key):
     """
+    Token usage and price of a chat completion, given as an openai ChatCompletion or its dict form:
     {'id': 'chatcmpl-AbJIS3o0HMEW9CWtRjU43bu2Ccrdu', 'object': 'chat.completion', 'created': 1733455676, 'model': 'gpt-4o-2024-11-20', 'choices': [...], 'usage': {'prompt_tokens': 2731, 'completion_tokens': 235, 'total_tokens': 2966, 'prompt_tokens_details': {'cached_tokens': 0, 'audio_tokens': 0}, 'completion_tokens_details': {'reasoning_tokens': 0, 'audio_tokens': 0, 'accepted_prediction_tokens': 0, 'rejected_prediction_tokens': 0}}, 'system_fingerprint': 'fp_28935134ad'}
     """
-    model = res_json['model']
-    usage = res_json['usage']
+    res_json = response.model_dump() if hasattr(response, "model_dump") else response
+    model = res_json.get('model') or ""
+    usage = res_json.get('usage') or {}
     if "prompt_tokens" in usage and "completion_tokens" in usage:
         prompt_tokens, completion_tokens = usage['prompt_tokens'], usage['completion_tokens']
     elif "promptTokens" in usage and "completionTokens" in usage:
@@ -34,7 +39,7 @@ def track_usage(res_json, api_key):
             completion_token_price = (15 / 1000000) * completion_tokens
     return {
         "api_key": api_key,
-        "id": res_json['id'] if "id" in res_json else None,
+        "id": res_json.get('id'),
         "model": model,
         "prompt_tokens": prompt_tokens,
         "completion_tokens": completion_tokens,
@@ -58,9 +63,118 @@ def get_screen_x_coordinate(x, image_width):
 def get_screen_y_coordinate(y, image_height):
     return round(image_height*y/1000)
 
-def get_image_url(image_path):
-    encoded_string = encode_image(image_path)
-    return f"data:image/jpeg;base64,{encoded_string}"
+def get_image_url(image, mime_type="image/jpeg"):
+    """
+    Build a base64 data url for the model.
+    `image` can be a file path, already encoded bytes (see encode_screenshot) or a PIL Image.
+    """
+    if isinstance(image, Image.Image):
+        image = encode_screenshot(image)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        encoded_string = base64.b64encode(image).decode('utf-8')
+    else:
+        encoded_string = encode_image(image)
+    return f"data:{mime_type};base64,{encoded_string}"
+
+def adb_command(adb_path, *args):
+    """
+    Split adb_path (which may carry extra flags, e.g. "adb -s emulator-5554") into an argv list.
+    """
+    return shlex.split(adb_path) + [str(arg) for arg in args]
+
+def device_state(adb_path, timeout=5):
+    """
+    `adb get-state` of the device, "device" when it is attached and online, None when adb fails.
+    """
+    try:
+        result = subprocess.run(adb_command(adb_path, "get-state"), capture_output=True, text=True, timeout=timeout)
+    except Exception as e:
+        print("adb get-state failed: ", e)
+        return None
+    return result.stdout.strip() or result.stderr.strip() or None
+
+def capture_screenshot(adb_path, max_retry=3, timeout=10):
+    """
+    Capture the screen in memory by streaming `screencap -p` over `adb exec-out`.
+    No file is written on the device or the host. Returns a PIL Image or None on failure.
+    """
+    command = adb_command(adb_path, "exec-out", "screencap", "-p")
+    while max_retry > 0:
+        try:
+            result = subprocess.run(command, capture_output=True, timeout=timeout)
+            if result.returncode == 0 and result.stdout:
+                image = Image.open(io.BytesIO(result.stdout))
+                image.load()
+                return image
+            print("Screenshot capture failed: ", result.stderr.decode("utf-8", "replace").strip())
+        except Exception as e:
+            print("Screenshot capture failed: ", e)
+        max_retry -= 1
+    return None
+
+async def capture_screenshot_async(adb_path, max_retry=3, timeout=10):
+    """
+    asyncio version of capture_screenshot, the event loop stays free while adb streams the frame.
+    """
+    command = adb_command(adb_path, "exec-out", "screencap", "-p")
+    while max_retry > 0:
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+            if process.returncode == 0 and stdout:
+                image = Image.open(io.BytesIO(stdout))
+                image.load()
+                return image
+            print("Screenshot capture failed: ", stderr.decode("utf-8", "replace").strip())
+        except asyncio.CancelledError:
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.communicate()
+            raise
+        except Exception as e:
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.communicate()
+            print("Screenshot capture failed: ", e)
+        max_retry -= 1
+    return None
+
+def capture_raw_frame(adb_path, max_size=None, timeout=10):
+    """
+    Capture the screen as raw RGBA (`screencap` without -p) which skips PNG compression on the device.
+    The frame is optionally downscaled so that its longest side is at most max_size.
+    Returns a PIL Image or None on failure.
+    """
+    try:
+        result = subprocess.run(adb_command(adb_path, "exec-out", "screencap"), capture_output=True, timeout=timeout)
+    except Exception as e:
+        print("Raw frame capture failed: ", e)
+        return None
+    data = result.stdout
+    if result.returncode != 0 or len(data) < 12:
+        return None
+    width = int.from_bytes(data[0:4], "little")
+    height = int.from_bytes(data[4:8], "little")
+    # Newer Android versions append a colorspace field, making the header 16 bytes instead of 12.
+    header_size = len(data) - width * height * 4
+    if header_size not in (12, 16):
+        return None
+    image = Image.frombuffer("RGBA", (width, height), data[header_size:], "raw", "RGBA", 0, 1)
+    if max_size is not None:
+        image = image.copy()
+        image.thumbnail((max_size, max_size))
+    return image
+
+def encode_screenshot(image, format="JPEG", **save_kwargs):
+    """
+    Encode a PIL Image into an in-memory buffer and return the bytes.
+    """
+    buffer = io.BytesIO()
+    if format.upper() == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image.save(buffer, format, **save_kwargs)
+    return buffer.getvalue()
 
 def get_screenshot(adb_path, save_path="./screenshot/screenshot.jpg"):
     max_retry = 3
@@ -83,54 +197,28 @@ def get_screenshot(adb_path, save_path="./screenshot/screenshot.jpg"):
             time.sleep(2)
             max_retry -= 1
 
+def extract_actions(agent_response: str, strict=False):
+    """
+    Return every action of the `Action:` line in order as ActionSpace action dicts, e.g.
+    Action: ```json["click(start_box='(509,155)')", "type(content='Hello')", "finished(content='')"]```
+    Returns an empty list when the response can not be parsed, use action_parser.parse_actions for the error.
+    """
+    try:
+        return [action.to_event() for action in parse_actions(agent_response, strict=strict)]
+    except ActionParseError:
+        return []
+
 def extract_action(agent_response: str):
-    action_dict = {}
-    agent_response = agent_response.lower()  # Convert to lowercase to avoid case sensitivity issues
-    
-    # Extract action type and parameters using regex
-    click_match = re.search(r"action: click\(start_box='\((\d+),(\d+)\)'\)", agent_response)
-    long_press_match = re.search(r"action: long_press\(start_box='\((\d+),(\d+)\)'\)", agent_response)
-    type_match = re.search(r"action: type\(content=['\"](.+?)['\"]\)", agent_response)
-    scroll_match = re.search(r"action: scroll\(start_box='\((\d+),(\d+)\)', end_box='\((\d+),(\d+)\)'\)", agent_response)
-    press_home_match = re.search(r'action: press_home\(\)', agent_response)
-    press_back_match = re.search(r'action: press_back\(\)', agent_response)
-    finished_match = re.search(r'action: finished\(\)', agent_response)
-    wait_match = re.search(r'action: wait\(\)', agent_response)
-    double_click_match = re.search(r"action: double_click\(start_box='\((\d+),(\d+)\)'\)", agent_response)
-    
-    if click_match:
-        action_dict["type"] = "click"
-        action_dict["x"] = int(click_match.group(1))
-        action_dict["y"] = int(click_match.group(2))
-    elif scroll_match:
-        action_dict["type"] = "scroll"
-        action_dict["start_x"] = int(scroll_match.group(1))
-        action_dict["start_y"] = int(scroll_match.group(2))
-        action_dict["end_x"] = int(scroll_match.group(3))
-        action_dict["end_y"] = int(scroll_match.group(4))
-    elif type_match:
-        action_dict["type"] = "type"
-        action_dict["content"] = type_match.group(1)
-    elif wait_match:
-        action_dict["type"] = "wait"
-    elif finished_match:
-        action_dict["type"] = "finished"
-    elif long_press_match:
-        action_dict["type"] = "long_press"
-        action_dict["x"] = int(long_press_match.group(1))
-        action_dict["y"] = int(long_press_match.group(2))
-    elif press_back_match:
-        action_dict["type"] = "press_back"
-    elif press_home_match:
-        action_dict["type"] = "press_home"
-    elif double_click_match:
-        action_dict["type"] = "double_click"
-        action_dict["x"] = int(double_click_match.group(1))
-        action_dict["y"] = int(double_click_match.group(2))
-    
-    return action_dict
+    """
+    Return the first action of the response, or an empty dict when there is none.
+    """
+    actions = extract_actions(agent_response)
+    return actions[0] if actions else {}
 
 if __name__ == "__main__":
+    print(extract_actions("""Thought: Open the search bar and search.
+Action: ```json["click(start_box='<|box_start|>(509,155)<|box_end|>')", "type(content='Hello World')", "finished(content='')"]```
+"""))
     print(extract_action("""
 1. To move the video to the desired timestamp of 01:10:00, I need to use the progress bar to calculate the appropriate position. Since the video is currently at 19:22, the next step is to drag the progress bar to the left to reach the target time of 01:10:00.
 2. The progress bar is located at the bottom of the video player interface, and the current seek position is indicated by the red marker.
@@ -0,0 +1,214 @@
+"""
+Scriptable virtual device: renders simple screens and records the gestures it receives, in process.
+Used directly as an ActionSpace shell_session for load tests, and by fake_adb.py (FAKE_ADB_DEVICE) as
+the device behind the fake `adb` binary.
+
+A script describes the screens and how gestures move between them:
+
+    {"width": 1080, "height": 2400, "density": 420, "start": "home", "packages": ["com.example"],
+     "screens": {
+        "home": {"color": "#ffffff", "rotation": 0, "back": "home", "swipe": "list",
+                 "elements": [{"id": "search", "text": "Search", "bounds": [40, 200, 1040, 340],
+                               "color": "#3050c8", "tap": "results", "long_press": "menu"}]},
+        ...}}
+
+Element bounds are in the pixels of their screen, whose size is width x height turned by `rotation`
+quarter turns. A tap hitting an element moves to its `tap` screen, `back` and `swipe` are the screens
+a back key or a swipe leads to, HOME goes back to `start`.
+"""
+import json
+import time
+import xml.sax.saxutils as saxutils
+from typing import NamedTuple, Optional, Tuple
+from PIL import Image, ImageDraw
+from adb_session import split_commands
+
+DEFAULT_SCRIPT = {
+    "width": 1080,
+    "height": 2400,
+    "density": 420,
+    "start": "home",
+    "screens": {
+        "home": {
+            "color": "#f0f0f0",
+            "elements": [
+                {"id": "search", "text": "Search", "bounds": [60, 200, 1020, 340], "color": "#ffffff", "tap": "home"},
+                {"id": "rotate", "text": "Rotate", "bounds": [340, 1100, 740, 1300], "color": "#3050c8", "tap": "landscape"},
+            ],
+        },
+        "landscape": {
+            "color": "#202020",
+            "rotation": 1,
+            "back": "home",
+            "elements": [
+                {"id": "done", "text": "Done", "bounds": [1900, 860, 2300, 1020], "color": "#30a050", "tap": "done"},
+                {"id": "cancel", "text": "Cancel", "bounds": [100, 860, 500, 1020], "color": "#a03030", "tap": "home"},
+            ],
+        },
+        "done": {"color": "#ffffff", "back": "home", "elements": [{"id": "message", "text": "Done", "bounds": [340, 1100, 740, 1300], "color": "#30a050"}]},
+    },
+}
+
+
+class Gesture(NamedTuple):
+    # tap, long_press, swipe, text, key or launch.
+    kind: str
+    # Device pixels in the orientation of the screen the gesture was received on.
+    points: Tuple[Tuple[int, int], ...]
+    # Text typed or key code, "" otherwise.
+    value: str
+    screen: str
+    rotation: int
+    # Id of the element hit by the first point, or None.
+    target: Optional[str]
+    time: float
+
+
+def load_script(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class VirtualDevice:
+    """
+    state: {"screen": ..., "text": ...} to resume from, see `state()`.
+    """
+
+    def __init__(self, script=None, state=None):
+        self.script = script if script is not None else DEFAULT_SCRIPT
+        self.width = self.script.get("width", 1080)
+        self.height = self.script.get("height", 2400)
+        self.density = self.script.get("density", 420)
+        self.screens = self.script["screens"]
+        self.screen = (state or {}).get("screen", self.script.get("start", next(iter(self.screens))))
+        self.text = (state or {}).get("text", "")
+        self.gestures = []
+        self.renders = {}
+
+    def state(self):
+        return {"screen": self.screen, "text": self.text}
+
+    @property
+    def rotation(self):
+        return self.screens[self.screen].get("rotation", 0)
+
+    @property
+    def size(self):
+        """
+        Size of the current screen in its orientation, the space `input` coordinates are in.
+        """
+        return (self.height, self.width) if self.rotation % 2 else (self.width, self.height)
+
+    def element_at(self, x, y):
+        """
+        Topmost element of the current screen containing the point, or None.
+        """
+        for element in reversed(self.screens[self.screen].get("elements", [])):
+            x1, y1, x2, y2 = element["bounds"]
+            if x1 <= x < x2 and y1 <= y < y2:
+                return element
+        return None
+
+    def go(self, screen):
+        if screen is not None:
+            if screen not in self.screens:
+                raise ValueError(f"Unknown screen {screen!r}")
+            self.screen = screen
+
+    def __record__(self, kind, points=(), value=""):
+        target = self.element_at(*points[0]) if points else None
+        self.gestures.append(Gesture(kind, tuple(points), value, self.screen, self.rotation, target["id"] if target else None, time.time()))
+        return target
+
+    def input(self, args):
+        if args[:1] == ["tap"] and len(args) >= 3:
+            target = self.__record__("tap", [(int(float(args[1])), int(float(args[2])))])
+            self.go(target.get("tap") if target else None)
+        elif args[:1] == ["swipe"] and len(args) >= 5:
+            start, end = (int(float(args[1])), int(float(args[2]))), (int(float(args[3])), int(float(args[4])))
+            if start == end:
+                target = self.__record__("long_press", [start])
+                self.go(target.get("long_press") if target else None)
+            else:
+                self.__record__("swipe", [start, end])
+                self.go(self.screens[self.screen].get("swipe"))
+        elif args[:1] == ["text"] and len(args) >= 2:
+            self.text += " ".join(args[1:])
+            self.__record__("text", value=" ".join(args[1:]))
+        elif args[:1] == ["keyevent"] and len(args) >= 2:
+            self.__record__("key", value=args[1])
+            if args[1] == "KEYCODE_BACK":
+                self.go(self.screens[self.screen].get("back"))
+            elif args[1] == "KEYCODE_HOME":
+                self.go(self.script.get("start", self.screen))
+            elif args[1] == "KEYCODE_ENTER":
+                self.go(self.screens[self.screen].get("enter"))
+        else:
+            return 1, f"Unknown input command: {' '.join(args)}\n"
+        return 0, ""
+
+    def run(self, command):
+        """
+        Run a device shell command line, returns (exit_code, output) like AdbShellSession.run.
+        """
+        code, output = 0, ""
+        for args in split_commands(command):
+            code, text = self.__execute__(args)
+            output += text
+        return code, output
+
+    def __execute__(self, args):
+        if args[0] == "input":
+            return self.input(args[1:])
+        if args[:2] == ["wm", "size"]:
+            return 0, f"Physical size: {self.width}x{self.height}\n"
+        if args[:2] == ["wm", "density"]:
+            return 0, f"Physical density: {self.density}\n"
+        if args[:2] == ["pm", "path"] and len(args) > 2:
+            installed = args[2] in self.script.get("packages", [])
+            return (0, f"package:/data/app/{args[2]}/base.apk\n") if installed else (1, "")
+        if args[0] == "monkey" and "-p" in args:
+            package = args[args.index("-p") + 1]
+            self.__record__("launch", value=package)
+            return (0, "") if package in self.script.get("packages", []) else (251, "No activities found to run, monkey aborted.\n")
+        return 0, ""
+
+    def close(self):
+        pass
+
+    def screenshot(self):
+        """
+        The current screen as an RGB image, rendered once per screen.
+        """
+        image = self.renders.get(self.screen)
+        if image is None:
+            screen = self.screens[self.screen]
+            image = Image.new("RGB", self.size, screen.get("color", "#ffffff"))
+            draw = ImageDraw.Draw(image)
+            for element in screen.get("elements", []):
+                x1, y1, x2, y2 = element["bounds"]
+                draw.rectangle((x1, y1, x2 - 1, y2 - 1), fill=element.get("color", "#c0c0c0"), outline="#000000")
+                if element.get("text"):
+                    draw.text((x1 + 16, (y1 + y2) // 2 - 6), element["text"], fill="#000000")
+            self.renders[self.screen] = image
+        return image
+
+    def hierarchy_xml(self):
+        """
+        `uiautomator dump` document of the current screen.
+        """
+        width, height = self.size
+        nodes = []
+        for index, element in enumerate(self.screens[self.screen].get("elements", [])):
+            x1, y1, x2, y2 = element["bounds"]
+            clickable = "true" if "tap" in element or "long_press" in element else "false"
+            nodes.append(
+                f'<node index="{index}" text={saxutils.quoteattr(element.get("text", ""))} '
+                f'resource-id={saxutils.quoteattr(element.get("id", ""))} class="android.widget.Button" '
+                f'content-desc="" clickable="{clickable}" enabled="true" bounds="[{x1},{y1}][{x2},{y2}]" />'
+            )
+        return (
+            "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>"
+            f'<hierarchy rotation="{self.rotation}"><node index="0" text="" resource-id="" class="android.widget.FrameLayout" '
+            f'content-desc="" clickable="false" enabled="true" bounds="[0,0][{width},{height}]">{"".join(nodes)}</node></hierarchy>'
+        )
@@ -0,0 +1,69 @@
+import random
+import pytest
+from action_parser import ActionParseError, ActionParser, parse_actions
+from parser_corpus import RAW_TEXTS, action_templates, fill_template, fuzz, parser_corpus, property_violations
+
+
+def events(response):
+    return [action.to_event() for action in parse_actions(response)]
+
+
+@pytest.mark.parametrize("response, expected", [
+    ("Action: click(start_box='(235,512)')", [{"type": "click", "x": 235, "y": 512}]),
+    ("Action: click(start_box='<|box_start|>(235,512)<|box_end|>')", [{"type": "click", "x": 235, "y": 512}]),
+    ("Action: scroll(start_box='(1,2)', end_box='(3,4)')", [{"type": "scroll", "start_x": 1, "start_y": 2, "end_x": 3, "end_y": 4}]),
+    ("Action: type(content='It\\'s a test')", [{"type": "type", "content": "It's a test"}]),
+    ("Action: type(content='It's a test')", [{"type": "type", "content": "It's a test"}]),
+    ("Action: type(content='rock 'n' roll')", [{"type": "type", "content": "rock 'n' roll"}]),
+    ("Action: type(content='hello\\n')", [{"type": "type", "content": "hello\\n"}]),
+    ("Action: type(content='don't stop\\n')", [{"type": "type", "content": "don't stop\\n"}]),
+    ("Action: type(content='line one\nline two')", [{"type": "type", "content": "line one\nline two"}]),
+    ("Action: type(content=\"say \\\"hi\\\"\")", [{"type": "type", "content": 'say "hi"'}]),
+    ("Action: click(start_box='(1,2)'), type(content='O'Brien')", [{"type": "click", "x": 1, "y": 2}, {"type": "type", "content": "O'Brien"}]),
+    ("Action: [\"type(content='It's \\u00e9t\\u00e9')\", \"press_home()\"]", [{"type": "type", "content": "It's été"}, {"type": "press_home"}]),
+    ("Thought: done\nAction: finished(content='')", [{"type": "finished"}]),
+])
+def test_parse(response, expected):
+    assert events(response) == expected
+
+
+def test_render_round_trip():
+    for response in ("Action: type(content='It's a test\\n')", "Action: type(content='a\\\\b')"):
+        actions = parse_actions(response)
+        reparsed = ActionParser(strict=True).parse("Action: " + " ".join(action.render() for action in actions))
+        assert [(action.name, action.args) for action in reparsed] == [(action.name, action.args) for action in actions]
+
+
+@pytest.mark.parametrize("response", ["Thought: nothing to do", "Action: click(start_box=", "Action: "])
+def test_rejected(response):
+    with pytest.raises(ActionParseError):
+        parse_actions(response)
+
+
+def test_strict_rejects_trailing_text():
+    with pytest.raises(ActionParseError):
+        ActionParser(strict=True).parse("Action: press_home() and then")
+
+
+def test_prompt_templates_parse():
+    templates = action_templates()
+    assert {"click", "type", "scroll", "finished", "Tap_Type_and_Enter"} <= {template.split("(")[0] for template in templates}
+    rng = random.Random(0)
+    for template in templates:
+        call, points, texts = fill_template(template, rng)
+        assert property_violations([(f"Action: {call}", [(call, points, texts)])]) == []
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_corpus_properties(seed):
+    corpus = parser_corpus(250, random.Random(seed))
+    assert any(text in response for response, _ in corpus for text in RAW_TEXTS)
+    assert property_violations(corpus) == []
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_fuzzed_responses_never_crash(seed):
+    rng = random.Random(seed)
+    rejected, crashes = fuzz(parser_corpus(100, rng), 500, rng)
+    assert crashes == []
+    assert rejected > 0
@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+import pytest
+import actions
+from actions import ActionSpace
+from adb_session import AdbSessionError, AdbSessionTimeout, AdbShellSession
+
+FAKE_ADB = f"{sys.executable} {os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'fake_adb.py')}"
+
+
+class FailingSession:
+    def __init__(self, error):
+        self.error = error
+        self.commands = []
+
+    def run(self, command):
+        self.commands.append(command)
+        raise self.error
+
+    def close(self):
+        pass
+
+
+def action_space(session):
+    return ActionSpace(adb_path=FAKE_ADB, image_width=1000, image_height=1000, shell_session=session, wait_for_settle=False)
+
+
+@pytest.mark.parametrize("content", ['say "hi"', "It's a test", "line one\nline two", "a; rm -rf /sdcard", "$HOME `id`", "don't stop\\n"])
+def test_type_text_is_one_shell_word(content):
+    command = action_space(FailingSession(None)).gesture_commands([{"type": "type", "content": content}])[0]
+    result = subprocess.run(["sh", "-c", "input() { printf '%s|' \"$@\"; }; " + command], capture_output=True, text=True, timeout=5)
+    assert result.stdout == f"text|{content.replace(' ', '%s')}|"
+
+
+def test_timed_out_command_is_not_replayed(monkeypatch):
+    session = FailingSession(AdbSessionTimeout("Timed out"))
+    monkeypatch.setattr(actions.subprocess, "run", lambda *args, **kwargs: pytest.fail("replayed over a new adb client"))
+    assert action_space(session).run_shell("input tap 1 2") is None
+    assert session.commands == ["input tap 1 2"]
+
+
+def test_lost_session_falls_back_to_a_single_command(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_ADB_ROOT", str(tmp_path))
+    assert action_space(FailingSession(AdbSessionError("closed"))).run_shell("input tap 1 2") == 0
+    assert (tmp_path / "gestures").read_text().strip() == "1"
+
+
+def test_session_survives_quotes_and_newlines(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_ADB_ROOT", str(tmp_path))
+    space = action_space(AdbShellSession(adb_path=FAKE_ADB, timeout=5))
+    try:
+        space.type('say "hi"\nnow')
+        space.type("It's")
+        space.click(10, 10)
+    finally:
+        space.close()
+    assert (tmp_path / "gestures").read_text().strip() == "3"
+
+
+class RecordingSession:
+    def __init__(self):
+        self.commands = []
+
+    def run(self, command):
+        self.commands.append(command)
+        return 0, ""
+
+    def close(self):
+        pass
+
+
+def test_double_click_taps_back_to_back(monkeypatch):
+    session = RecordingSession()
+    space = action_space(session)
+    waits = []
+    monkeypatch.setattr(space, "wait_until_settled", lambda timeout=None: waits.append(timeout) or 0)
+    space.map_generate_action_to_event({"type": "double_click", "x": 500, "y": 250})
+    assert session.commands == ["input tap 500 250; input tap 500 250"]
+    assert waits == [None]
+
+
+@pytest.mark.parametrize("use_session", [True, False])
+def test_double_click_over_fake_adb(tmp_path, monkeypatch, use_session):
+    monkeypatch.setenv("FAKE_ADB_ROOT", str(tmp_path))
+    session = AdbShellSession(adb_path=FAKE_ADB, timeout=5) if use_session else FailingSession(AdbSessionError("closed"))
+    space = action_space(session)
+    try:
+        space.run_shell(space.gesture_commands([{"type": "double_click", "x": 500, "y": 250}])[0])
+    finally:
+        space.close()
+    assert (tmp_path / "gestures").read_text().strip() == "2"
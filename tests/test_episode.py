@@ -0,0 +1,43 @@
+import pytest
+from action_parser import parse_actions
+from actions import ActionSpace
+from adb_session import AdbShellSession
+from episode import count_gestures
+from test_actions import FAKE_ADB
+
+RESPONSES = [
+    "Action: click(start_box='(500,500)')",
+    "Action: double_click(start_box='(500,500)')",
+    "Action: type(content='lofi beats')\npress_enter()",
+    "Action: scroll(start_box='(500,750)', end_box='(500,250)')\nlong_press(start_box='(100,100)')",
+    "Action: press_home()\npress_back()",
+    "Action: Tap_Type_and_Enter(start_box='(500,80)', text='lofi beats')",
+    "Action: Open_App(package='com.google.android.youtube')",
+    "Action: Swipe_Page(direction='down')\nfinished(content='')\nclick(start_box='(1,1)')",
+    "Action: wait()",
+]
+
+
+def events(response):
+    return [action.to_event() for action in parse_actions(response)]
+
+
+def test_counts():
+    assert count_gestures(events(RESPONSES[1])) == 2
+    assert count_gestures(events(RESPONSES[5])) == 3
+    assert count_gestures(events(RESPONSES[6])) == 1
+    assert count_gestures(events(RESPONSES[7])) == 1
+    assert count_gestures(events(RESPONSES[8])) == 0
+    assert count_gestures([{"type": "shortcut", "name": "Swipe_Page", "args": {"direction": "sideways"}}, {"type": "click", "x": 1, "y": 1}]) == 0
+
+
+@pytest.mark.parametrize("response", RESPONSES)
+def test_counts_match_fake_adb(tmp_path, monkeypatch, response):
+    monkeypatch.setenv("FAKE_ADB_ROOT", str(tmp_path))
+    space = ActionSpace(adb_path=FAKE_ADB, image_width=1000, image_height=1000, shell_session=AdbShellSession(adb_path=FAKE_ADB, timeout=5), wait_for_settle=False, settle_timeout=0)
+    try:
+        space.execute_actions(events(response))
+    finally:
+        space.close()
+    received = int((tmp_path / "gestures").read_text()) if (tmp_path / "gestures").exists() else 0
+    assert count_gestures(events(response)) == received
@@ -0,0 +1,76 @@
+import os
+import pytest
+import episode_log
+from episode_log import EpisodeLog
+
+
+def frame(index, size=1000):
+    return index.to_bytes(4, "big") * (size // 4)
+
+
+def log_episode(log, task, frames, status="finished"):
+    episode = log.start_episode(task, device="emulator-5554")
+    for index in frames:
+        log.add_step(episode, frame(index), f"Action: click(start_box='(500,{index})')", [{"type": "click"}])
+    if status is not None:
+        log.finish_episode(episode, status)
+    return episode
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = EpisodeLog(str(tmp_path), chunk_size=4000)
+    yield log
+    log.close()
+
+
+def test_frames_are_deduplicated(log):
+    log_episode(log, "Open Youtube", [0, 1, 0, 1])
+    stats = log.stats()
+    assert stats["frames"] == 2
+    assert stats["frame_bytes"] == 2000
+    assert stats["logged_bytes"] == 4000
+
+
+def test_retain_drops_oldest_finished_episodes(log):
+    first = log_episode(log, "Task 0", [0, 1, 2])
+    running = log_episode(log, "Task 1", [3, 4, 5], status=None)
+    last = log_episode(log, "Task 2", [6, 7, 8])
+    result = log.retain(max_bytes=6000)
+    assert result["dropped_episodes"] == 1
+    assert [episode["id"] for episode in log.episodes()] == [running, last]
+    assert log.stats()["frame_bytes"] <= 6000
+    assert log.steps(first) == []
+    for step in log.steps(last):
+        assert bytes(log.frame(step.frame)) == frame(6 + step.step)
+
+
+def test_retain_keeps_episodes_in_progress(log):
+    log_episode(log, "Task 0", [0, 1, 2], status=None)
+    log_episode(log, "Task 1", [3, 4, 5], status=None)
+    assert log.retain(max_bytes=1000)["dropped_episodes"] == 0
+    assert len(log.episodes()) == 2
+
+
+def test_retain_compacts_chunks(log):
+    for index in range(4):
+        log_episode(log, f"Task {index}", [3 * index, 3 * index + 1, 3 * index + 2])
+    chunks = len(log.chunks())
+    assert chunks >= 3
+    result = log.retain(max_bytes=3000)
+    assert result["freed_bytes"] > 0
+    assert len(log.chunks()) < chunks
+    stats = log.stats()
+    assert stats["episodes"] == 1
+    assert stats["disk_bytes"] - os.path.getsize(os.path.join(log.path, "index.sqlite")) <= 3000 / 0.5 + log.chunk_size
+    for step in log.steps(log.episodes()[0]["id"]):
+        assert bytes(log.frame(step.frame)) == frame(9 + step.step)
+
+
+def test_retain_by_age(log, monkeypatch):
+    log_episode(log, "Task 0", [0])
+    now = episode_log.time.time()
+    monkeypatch.setattr(episode_log.time, "time", lambda: now + 3600)
+    kept = log_episode(log, "Task 1", [1])
+    assert log.retain(max_age=60)["dropped_episodes"] == 1
+    assert [episode["id"] for episode in log.episodes()] == [kept]
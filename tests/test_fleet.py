@@ -0,0 +1,45 @@
+import asyncio
+import os
+import sys
+from PIL import Image
+import fleet
+from fleet import run_fleet, summarize
+from inference_client import InferenceClient
+from stub_server import StubServer
+
+FAKE_ADB = f"{sys.executable} {os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'fake_adb.py')}"
+SERIALS = ["emulator-5554", "emulator-5556"]
+
+
+class TaskStub(StubServer):
+    """
+    Taps once, then finishes the task.
+    """
+
+    def next_response(self, request):
+        if any(message["role"] == "assistant" for message in request["messages"]):
+            return "Thought: The task is done.\nAction: finished(content='')"
+        return "Thought: Open the app.\nAction: click(start_box='(500,500)')"
+
+
+def test_fleet_over_two_devices(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_ADB_ROOT", str(tmp_path))
+    monkeypatch.setenv("FAKE_ADB_FRAME", str(tmp_path / "frame.png"))
+    Image.new("RGB", (280, 560), "#ffffff").save(tmp_path / "frame.png")
+    for index, serial in enumerate(SERIALS):
+        (tmp_path / serial).mkdir()
+        Image.new("RGB", (280, 560), ("#ff0000", "#0000ff")[index]).save(tmp_path / serial / "frame.png")
+    tasks = [f"Task {index}" for index in range(4)]
+    with TaskStub() as server:
+        monkeypatch.setattr(fleet, "create_inference_client", lambda llm_type, http_client=None, **kwargs: InferenceClient([("stub", server.url)], api_key="stub", http_client=http_client))
+        results = asyncio.run(run_fleet(SERIALS, tasks, max_itr=4, adb_path=FAKE_ADB, task_timeout=60))
+    assert sorted(result["task"] for result in results) == tasks
+    assert all(result["status"] == "finished" for result in results), results
+    assert all(result["steps"] == 2 for result in results)
+    summary = summarize(results)
+    assert set(summary) == set(SERIALS)
+    assert sum(device["tasks"] for device in summary.values()) == len(tasks)
+    for serial, device in summary.items():
+        assert device["finished"] == device["tasks"] >= 1
+        assert (tmp_path / serial / "gestures").read_text().strip() == str(device["tasks"])
+    assert not (tmp_path / "gestures").exists()
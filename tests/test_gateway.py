@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+import gateway
+from gateway import InferenceGateway
+
+
+class FakeClient:
+    """
+    InferenceClient stand-in with one endpoint, answering after `latency` seconds.
+    """
+
+    def __init__(self, latency=0.05):
+        self.endpoints = [SimpleNamespace(name="stub")]
+        self.failover = False
+        self.latency = latency
+        self.requests = []
+
+    async def acreate(self, admission=None, **kwargs):
+        async with admission(self.endpoints[0]):
+            self.requests.append(kwargs)
+            await asyncio.sleep(self.latency)
+            return f"response {len(self.requests)}"
+
+
+async def run(gateway, *submissions):
+    try:
+        return await asyncio.wait_for(asyncio.gather(*(gateway.session(session).acreate(**kwargs) for session, kwargs in submissions), return_exceptions=True), 5)
+    finally:
+        await gateway.aclose()
+
+
+def test_string_content():
+    client = FakeClient()
+    responses = asyncio.run(run(InferenceGateway(client), ("a", {"messages": [{"role": "user", "content": "hi"}]})))
+    assert responses == ["response 1"]
+
+
+def test_estimate_error_fails_the_request(monkeypatch):
+    def broken(kwargs):
+        raise ValueError("no estimate")
+
+    monkeypatch.setattr(gateway, "request_tokens", broken)
+    instance = InferenceGateway(FakeClient())
+    responses = asyncio.run(run(instance, ("a", {"messages": []})))
+    assert isinstance(responses[0], ValueError)
+    assert instance.in_flight == 0
+
+
+def test_identical_requests_are_coalesced():
+    client = FakeClient()
+    instance = InferenceGateway(client)
+    kwargs = {"messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+    responses = asyncio.run(run(instance, ("a", kwargs), ("b", dict(kwargs)), ("c", {**kwargs, "temperature": 0.5})))
+    assert responses[0] == responses[1]
+    assert len(client.requests) == 2
+    assert instance.stats()["coalesced"] == 1
+
+
+def test_concurrency_limit():
+    client = FakeClient()
+    instance = InferenceGateway(client, max_concurrent=2)
+    asyncio.run(run(instance, *((f"s{index}", {"messages": [{"role": "user", "content": f"task {index}"}]}) for index in range(6))))
+    assert len(client.requests) == 6
+    assert instance.stats()["endpoints"]["stub"]["max_in_flight"] == 2
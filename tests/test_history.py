@@ -0,0 +1,85 @@
+import copy
+from history import ConversationHistory
+from test_prompt import image_url
+
+
+def screen(text, url):
+    return {"role": "user", "content": [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": url}}]}
+
+
+def action(step):
+    return {"role": "assistant", "content": [{"type": "text", "text": f"Thought: step {step}\nAction: click(start_box='(500,{step})')"}]}
+
+
+def roles(history):
+    return [message["role"] for message in history.messages()]
+
+
+def test_failed_request_keeps_alternation():
+    url = image_url(280, 280)
+    history = ConversationHistory(max_images=2, max_turns=2)
+    history.append(screen("Screen 0", url))
+    history.append(action(0))
+    history.append(screen("Screen 1", url))
+    # The request failed, the next step sends a fresh screenshot.
+    history.append(screen("Screen 2", url))
+    assert roles(history) == ["user", "assistant", "user"]
+    assert history.messages()[-1]["content"][0]["text"] == "Screen 2"
+    assert history.image_count() == 2
+    assert history.window_tokens == sum(tokens for _, tokens in history.window)
+
+
+def test_failed_first_request():
+    history = ConversationHistory()
+    history.append(screen("Screen 0", image_url(280, 280)))
+    history.append(screen("Screen 1", image_url(280, 280)))
+    assert len(history) == 1
+    assert history.image_count() == 1
+
+
+def test_trimming():
+    url = image_url(560, 560)
+    history = ConversationHistory(max_images=2, max_turns=2)
+    for step in range(10):
+        history.append(screen(f"Screen {step}", url))
+        history.append(action(step))
+        assert history.image_count() <= 2
+        assert len(history) <= 2 * 2 + 1
+        assert roles(history)[0] == "user"
+    history.append(screen("Last", url))
+    messages = history.messages()
+    assert roles(history) == ["user", "assistant", "user", "assistant", "user"]
+    assert sum(item["type"] == "image_url" for message in messages for item in message["content"]) == 2
+    assert messages[0]["content"][0]["text"].startswith("Previous actions:\n1. click(start_box='(500,0)')")
+    assert len(history.summary) == 8
+
+
+def test_token_budget():
+    url = image_url(560, 560)
+    history = ConversationHistory(max_images=5, max_turns=5, max_tokens=600)
+    for step in range(5):
+        history.append(screen(f"Screen {step}", url))
+        history.append(action(step))
+        assert history.window_tokens <= 600 or len(history) == 1
+        assert roles(history)[0] == "user"
+    assert history.window_tokens == sum(tokens for _, tokens in history.window)
+
+
+def test_preview_shares_screenshots_and_keeps_the_history():
+    url = image_url(280, 280)
+    history = ConversationHistory(max_images=2, max_turns=2)
+    for step in range(3):
+        history.append(screen(f"Screen {step}", url))
+        history.append(action(step))
+    before = history.messages()
+    tokens = history.window_tokens
+    preview = history.preview(screen("Next", url))
+    appended = copy.deepcopy(history)
+    appended.append(screen("Next", url))
+    assert preview == appended.messages()
+    assert history.messages() == before
+    assert history.window_tokens == tokens
+    assert history.image_count() == 2
+    # The screenshot still in the preview window is the stored one, not a copy.
+    shared = [message for message in before if any(item["type"] == "image_url" for item in message["content"])][-1]
+    assert any(message is shared for message in preview)
@@ -0,0 +1,77 @@
+import asyncio
+import time
+import pytest
+from inference_client import CircuitBreaker, InferenceClient, InferenceError, RetryPolicy
+from stub_server import StubServer
+
+MESSAGES = [{"role": "user", "content": "Open Youtube"}]
+
+
+def test_breaker_state_machine():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_released_trial_lets_the_next_one_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_cancelled_trial_does_not_wedge_the_breaker():
+    async def run(client):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.acreate(model="tgi", messages=MESSAGES), 0.1)
+        response = await client.acreate(model="tgi", messages=MESSAGES)
+        await client.aclose()
+        return response
+
+    with StubServer(latency=0.3) as server:
+        client = InferenceClient([("stub", server.url)], api_key="stub", failure_threshold=1, reset_timeout=0.0)
+        breaker = client.endpoints[0].breaker
+        breaker.record_failure()
+        assert breaker.state == "half_open"
+        response = asyncio.run(run(client))
+        assert response.choices[0].message.content
+        assert breaker.state == "closed"
+
+
+def test_transient_errors_are_retried():
+    with StubServer(fail_first=2) as server:
+        client = InferenceClient([("stub", server.url)], api_key="stub", retry_policy=RetryPolicy(base_delay=0.01))
+        assert client.create(model="tgi", messages=MESSAGES).choices[0].message.content
+        assert client.metrics()["stub"]["errors"] == {"server": 2}
+
+
+def test_internal_errors_are_not_retried(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    client = InferenceClient([("stub", "http://127.0.0.1:9/v1/")], api_key=None, retry_policy=RetryPolicy(base_delay=1.0))
+    started = time.monotonic()
+    with pytest.raises(InferenceError) as error:
+        asyncio.run(client.acreate(model="tgi", messages=MESSAGES))
+    assert error.value.kind == "internal"
+    assert time.monotonic() - started < 0.5
+    assert client.endpoints[0].breaker.state == "closed"
+
+
+def test_failover_after_breaker_opens():
+    with StubServer(fail_rate=1.0) as primary, StubServer() as fallback:
+        client = InferenceClient([("dpo", primary.url), ("sft", fallback.url)], api_key="stub", retry_policy=RetryPolicy(base_delay=0.01), failure_threshold=2)
+        for _ in range(3):
+            assert client.create(model="tgi", messages=MESSAGES).choices[0].message.content
+        assert client.metrics()["dpo"]["breaker"] == "open"
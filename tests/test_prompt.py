@@ -0,0 +1,129 @@
+import asyncio
+import base64
+import io
+from PIL import Image
+from constants import MANAGER_PROMPT_TEMPLATE
+from inference_client import InferenceClient
+from prompt import PLAN_DESCRIPTION, SUBGOAL_DESCRIPTION, PromptAssembler, estimate_tokens, image_tokens, parse_manager_response
+from stub_server import StubServer
+from tars import AsyncTARS
+
+PLANNING_RESPONSE = "### Thought ###\nYoutube is not open yet.\n\n### Plan ###\n1. Open Youtube\n2. Search for cats\n\n### Current Subgoal ###\nOpen Youtube"
+
+
+def image_url(width, height, format="PNG"):
+    data = io.BytesIO()
+    Image.new("RGB", (width, height), "#ffffff").save(data, format)
+    return f"data:image/{format.lower()};base64,{base64.b64encode(data.getvalue()).decode()}"
+
+
+def test_string_content():
+    assert estimate_tokens({"role": "user", "content": "Open Youtube"}) == estimate_tokens({"role": "user", "content": [{"type": "text", "text": "Open Youtube"}]})
+    assert estimate_tokens({"role": "user", "content": {"type": "text", "text": "Open Youtube"}}) > 0
+    assert estimate_tokens({"role": "user", "content": ["Open Youtube"]}) > 0
+
+
+def test_image_tokens():
+    for format in ("PNG", "JPEG"):
+        assert image_tokens(image_url(280, 560, format)) == 10 * 20 + 2
+
+
+def test_system_message_is_stable():
+    assembler = PromptAssembler("System", "Open Youtube")
+    messages = [{"role": "assistant", "content": "Hi"}, {"role": "user", "content": "Open Youtube"}]
+    first, _ = assembler.assemble(messages)
+    second, _ = assembler.assemble(messages + [{"role": "assistant", "content": "Ok"}, {"role": "user", "content": "Next"}])
+    assert first[0] is second[0]
+    assert first[0]["content"][0]["text"] == "System\n## User Instruction\nOpen Youtube"
+    assert first[1]["role"] == "user"
+
+
+def test_budget_drops_old_images_first():
+    url = image_url(560, 560)
+    messages = []
+    for step in range(4):
+        messages.append({"role": "user", "content": [{"type": "text", "text": f"Screen {step}"}, {"type": "image_url", "image_url": {"url": url}}]})
+        messages.append({"role": "assistant", "content": f"Action {step}"})
+    messages.append({"role": "user", "content": [{"type": "text", "text": "Last"}, {"type": "image_url", "image_url": {"url": url}}]})
+    assembler = PromptAssembler("System", "Task", max_tokens=500)
+    assembled, tokens = assembler.assemble(messages)
+    assert tokens <= 500
+    assert assembled[-1] == messages[-1]
+    assert sum(item["type"] == "image_url" for message in assembled[1:-1] for item in message["content"] if type(message["content"]) == list) == 0
+    assert len(assembled) == len(messages) + 1
+    assert assembler.trimmed == 1
+
+
+def full_manager_prompt(instruction, planning_block, error_handling_block=""):
+    return MANAGER_PROMPT_TEMPLATE.substitute(instruction=instruction, planning_block=planning_block, error_handling_block=error_handling_block, plan_checkpoint_meta_metadata="", shortcuts_reference_block="- open_app($package)", plan_description=PLAN_DESCRIPTION, current_subgoal_description=SUBGOAL_DESCRIPTION)
+
+
+def test_manager_prompt_is_rendered_incrementally():
+    assembler = PromptAssembler("System", "Pay $5 to Bob", shortcuts_reference_block="- open_app($package)", max_errors=2)
+    first = assembler.manager_prompt()
+    assert first.startswith("### User Instruction ###\nPay $5 to Bob\n\n---\nMake a high-level plan")
+    assert assembler.manager_prompt() is first
+    assembler.set_plan("1. Open the bank app", "Open the bank app", "Nothing done yet.")
+    planned = assembler.manager_prompt()
+    assert planned == full_manager_prompt("Pay $5 to Bob", "### Current Plan ###\n1. Open the bank app\n\n### Previous Subgoal ###\nOpen the bank app\n\n### Progress Status ###\nNothing done yet.")
+    assembler.set_plan("1. Open the bank app", "Open the bank app", "Nothing done yet.")
+    assert assembler.manager_prompt() is planned
+    for error in ("first", "second", "third"):
+        assembler.add_error(error)
+    assert "### Potentially Stuck! ###\nThe last attempts failed:\n- second\n- third\n" in assembler.manager_prompt()
+    assembler.clear_errors()
+    assert assembler.manager_prompt() == planned
+
+
+def test_plan_is_sent_after_the_last_message():
+    assembler = PromptAssembler("System", "Open Youtube")
+    messages = [{"role": "user", "content": "Screen 0"}, {"role": "assistant", "content": "Action 0"}, {"role": "user", "content": "Screen 1"}]
+    before, tokens = assembler.assemble(messages)
+    assembler.set_plan("1. Open Youtube", "Open Youtube")
+    after, planned_tokens = assembler.assemble(messages)
+    assert after[0] is before[0]
+    assert after[:-1] == before[:-1]
+    assert after[-1]["content"] == [{"type": "text", "text": "Screen 1"}, {"type": "text", "text": "## Plan\n1. Open Youtube\n## Current Subgoal\nOpen Youtube"}]
+    assert messages[-1]["content"] == "Screen 1"
+    assert planned_tokens > tokens
+
+
+def test_parse_manager_response():
+    assert parse_manager_response(PLANNING_RESPONSE) == ("Youtube is not open yet.", "1. Open Youtube\n2. Search for cats", "Open Youtube")
+    assert parse_manager_response("Thought: click\nAction: click(start_box='(1,2)')") is None
+    assert parse_manager_response(None) is None
+
+
+class PlanningStub(StubServer):
+    def __init__(self):
+        super().__init__()
+        self.bodies = []
+
+    def next_response(self, request):
+        self.bodies.append(request)
+        if request["messages"][0]["role"] == "user":
+            return PLANNING_RESPONSE
+        return "Thought: Open the app.\nAction: click(start_box='(500,500)')"
+
+
+def test_plan_request_updates_the_next_requests():
+    url = image_url(280, 280)
+    screen = {"role": "user", "content": [{"type": "text", "text": "Here is the screen"}, {"type": "image_url", "image_url": {"url": url}}]}
+
+    async def run(server):
+        client = InferenceClient([("stub", server.url)], api_key="stub")
+        agent = AsyncTARS("Search cats on Youtube", "default", inference_client=client)
+        try:
+            return await agent.plan([screen]), await agent.inference([screen])
+        finally:
+            await client.aclose()
+
+    with PlanningStub() as server:
+        planned, response = asyncio.run(run(server))
+    assert planned and response.startswith("Thought: Open the app.")
+    planning, action = server.bodies
+    assert [message["role"] for message in planning["messages"]] == ["user"]
+    assert planning["messages"][0]["content"][0]["text"].startswith("### User Instruction ###\nSearch cats on Youtube\n")
+    assert planning["messages"][0]["content"][1] == {"type": "image_url", "image_url": {"url": url}}
+    assert action["messages"][0]["role"] == "system"
+    assert action["messages"][-1]["content"][-1]["text"] == "## Plan\n1. Open Youtube\n2. Search for cats\n## Current Subgoal\nOpen Youtube\n## Progress Status\nYoutube is not open yet."
@@ -0,0 +1,51 @@
+from PIL import Image
+from settle import ReplayFrameSource, frame_difference, wait_for_screen_settle
+
+
+def gray(level, size=(90, 200)):
+    return Image.new("L", size, level)
+
+
+def sliding(steps, size=(90, 200)):
+    """
+    A bar sliding down the screen over `steps` frames.
+    """
+    frames = []
+    for step in range(steps):
+        frame = Image.new("L", size, 255)
+        top = step * size[1] // steps
+        frame.paste(0, (0, top, size[0], top + size[1] // 8))
+        frames.append(frame)
+    return frames
+
+
+def test_settles_once_frames_stop_changing():
+    source = ReplayFrameSource(sliding(4))
+    result = wait_for_screen_settle(source, timeout=5, poll_interval=0.001)
+    assert result.settled
+    # Three moving differences, then two stable ones on the repeated last frame.
+    assert result.frames == 6
+    assert result.waited < 1
+
+
+def test_times_out_when_the_screen_keeps_changing():
+    source = ReplayFrameSource(sliding(4) * 1000)
+    result = wait_for_screen_settle(source, timeout=0.2, poll_interval=0.01)
+    assert not result.settled
+    assert 0.2 <= result.waited < 1
+    assert result.frames > 2
+
+
+def test_threshold_is_exclusive():
+    frames = [gray(0), gray(51)] * 1000
+    assert frame_difference(frames[0], frames[1]) == 0.2
+    assert not wait_for_screen_settle(ReplayFrameSource(frames), threshold=0.2, timeout=0.1, poll_interval=0.001).settled
+    result = wait_for_screen_settle(ReplayFrameSource(frames), threshold=0.2001, timeout=5, poll_interval=0.001)
+    assert result.settled and result.frames == 3
+
+
+def test_missing_frames_do_not_count_as_stable():
+    source = ReplayFrameSource([gray(0), None, gray(0), gray(0), gray(0)])
+    result = wait_for_screen_settle(source, timeout=5, poll_interval=0.001)
+    assert result.settled
+    assert result.frames == 5
@@ -0,0 +1,106 @@
+import asyncio
+from PIL import Image
+import main
+from history import ConversationHistory
+from image_pipeline import ImageEncodeConfig
+from inference_client import InferenceClient
+from response_cache import perceptual_hash
+from settle import ReplayFrameSource
+from speculation import Speculator
+from stub_server import StubServer
+from tars import AsyncTARS
+from tracing import Tracer
+
+RESPONSE = "Thought: Tap the next button.\nAction: click(start_box='(500,500)')"
+
+
+def blocks(seed, size=(270, 600)):
+    """
+    Screen of colored blocks, distinct to the perceptual hash for every seed.
+    """
+    image = Image.new("RGB", size, "#ffffff")
+    for row in range(6):
+        for column in range(3):
+            color = (seed * 97 + row * 41 + column * 13) % 256
+            image.paste((color, 255 - color, (color * 7) % 256), (column * size[0] // 3, row * size[1] // 6, (column + 1) * size[0] // 3, (row + 1) * size[1] // 6))
+    return image
+
+
+class RecordingStub(StubServer):
+    def __init__(self, **kwargs):
+        super().__init__([RESPONSE], **kwargs)
+        self.bodies = []
+
+    def next_response(self, request):
+        self.bodies.append(request)
+        return super().next_response(request)
+
+
+async def speculate_on(frames, server, final, max_speculative=1, history=None):
+    """
+    Run the speculation watcher over replayed frames until they are used up, then take the request
+    matching the final frame. Returns (speculator, committed request or None, pending requests before).
+    """
+    source = ReplayFrameSource(frames)
+
+    async def capture(adb_path=None, max_retry=1):
+        return source()
+
+    main.capture_screenshot_async = capture
+    client = InferenceClient([("stub", server.url)], api_key="stub")
+    agent = AsyncTARS("Open the settings", "default", inference_client=client)
+    speculator = Speculator(max_concurrent=max_speculative)
+    history = history if history is not None else ConversationHistory()
+    watcher = asyncio.ensure_future(main.speculate(agent, speculator, history, None, ImageEncodeConfig(), perceptual_hash(blocks(0)), Tracer(), interval=0.01))
+    while source.index < len(frames) and not watcher.done():
+        await asyncio.sleep(0.01)
+    assert not watcher.done(), watcher.exception()
+    await main.cancel_task(watcher)
+    pending = list(speculator.pending)
+    request = speculator.take(perceptual_hash(final))
+    response = await request.task if request is not None else None
+    await asyncio.gather(*(other.task for other in pending if other is not request), return_exceptions=True)
+    await client.aclose()
+    return speculator, request, pending, response
+
+
+def test_hit(monkeypatch):
+    monkeypatch.setattr(main, "capture_screenshot_async", main.capture_screenshot_async)
+    history = ConversationHistory()
+    history.append(main.screen_message("Screen 0", main.get_image_url(b"\x89PNG", "image/png")))
+    history.append({"role": "assistant", "content": [{"type": "text", "text": RESPONSE}]})
+    with RecordingStub() as server:
+        # The next screen slides in, then holds still.
+        frames = [blocks(0), blocks(5), blocks(1), blocks(1), blocks(1)]
+        speculator, request, pending, response = asyncio.run(speculate_on(frames, server, blocks(1), history=history))
+    assert len(pending) == 1
+    assert request is pending[0]
+    assert response == RESPONSE
+    assert speculator.stats()["hit_rate"] == 1.0
+    # Sent with the history and the new screen, which stays out of the history until committed.
+    assert len(history) == 2
+    assert [message["role"] for message in server.bodies[0]["messages"]] == ["system", "user", "assistant", "user"]
+    assert request.payload["content"][-1]["type"] == "image_url"
+
+
+def test_miss_is_cancelled(monkeypatch):
+    monkeypatch.setattr(main, "capture_screenshot_async", main.capture_screenshot_async)
+    with RecordingStub(latency=0.5) as server:
+        frames = [blocks(1), blocks(1), blocks(1)]
+        speculator, request, pending, response = asyncio.run(speculate_on(frames, server, blocks(2)))
+    assert len(pending) == 1
+    assert request is None and response is None
+    assert pending[0].task.cancelled()
+    stats = speculator.stats()
+    assert stats["discarded"] == 1 and stats["committed"] == 0 and stats["hit_rate"] == 0.0
+
+
+def test_newer_frame_supersedes(monkeypatch):
+    monkeypatch.setattr(main, "capture_screenshot_async", main.capture_screenshot_async)
+    with RecordingStub(latency=0.5) as server:
+        frames = [blocks(1), blocks(1), blocks(2), blocks(2), blocks(2)]
+        speculator, request, pending, response = asyncio.run(speculate_on(frames, server, blocks(2)))
+    assert len(pending) == 1
+    assert request is pending[0] and response == RESPONSE
+    assert speculator.stats()["superseded"] == 1
+    assert speculator.stats()["started"] == 2
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import time
+from http.server import BaseHTTPRequestHandler
+from inference_client import InferenceClient, RetryPolicy
+from stub_server import StubServer
+from tars import AsyncTARS
+
+RESPONSE = (
+    "Thought: The YouTube icon is in the second row.\n"
+    "Action: click(start_box='(235,512)')\n"
+    "Reflection: The click should open YouTube, the next step is to tap the search icon in the top bar."
+)
+MESSAGES = [{"role": "user", "content": "Open Youtube"}]
+
+
+class RawStreamStub(StubServer):
+    """
+    Streams the given raw SSE data lines, then hangs up without [DONE] when `complete` is false.
+    """
+
+    def __init__(self, lines, complete=True, **kwargs):
+        self.lines = lines
+        self.complete = complete
+        super().__init__(**kwargs)
+
+    def __handler__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for line in stub.lines:
+                    self.wfile.write(f"data: {line}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                if stub.complete:
+                    self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def chunks(server, text):
+    request = {"model": "tgi"}
+    return [json.dumps(server.chunk(request, {"content": piece})) for piece in server.pieces(text)]
+
+
+async def stream(server, cancel_after_action):
+    client = InferenceClient([("stub", server.url)], api_key="stub", retry_policy=RetryPolicy(request_timeout=10))
+    agent = AsyncTARS("Open Youtube", "default", inference_client=client)
+    dispatched = []
+    started = time.monotonic()
+    try:
+        result = await agent.stream_inference([dict(message) for message in MESSAGES], on_action=lambda actions: dispatched.append((time.monotonic() - started, actions)), cancel_after_action=cancel_after_action)
+    finally:
+        await client.aclose()
+    return result, dispatched
+
+
+def test_action_is_dispatched_before_the_stream_ends():
+    with StubServer([RESPONSE], token_latency=0.01, chunk_size=4) as server:
+        result, dispatched = asyncio.run(stream(server, cancel_after_action=False))
+    assert result.text == RESPONSE
+    assert not result.cancelled
+    assert len(dispatched) == 1
+    at, actions = dispatched[0]
+    assert [(action.name, action.args) for action in actions] == [("click", {"start_box": (235, 512)})]
+    assert result.time_to_first_token < result.time_to_action < result.total_time
+    # The reflection is still being generated when the action is dispatched.
+    remaining = len(RESPONSE) - RESPONSE.index("Reflection")
+    assert result.total_time - at > 0.01 * remaining / 4 / 2
+
+
+def test_stream_is_cancelled_after_the_action():
+    with StubServer([RESPONSE], token_latency=0.01, chunk_size=4) as server:
+        result, dispatched = asyncio.run(stream(server, cancel_after_action=True))
+        deadline = time.monotonic() + 2
+        while not server.cancelled_streams and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert server.cancelled_streams == 1
+    assert result.cancelled
+    assert len(dispatched) == 1
+    assert "Reflection" not in result.text
+    assert result.text.startswith("Thought:") and "click(start_box='(235,512)')" in result.text
+    assert result.total_time < 0.01 * len(RESPONSE) / 4
+
+
+def test_stream_cut_off_before_the_action():
+    server = StubServer()
+    cut = RESPONSE.index("click") + 8
+    with RawStreamStub(chunks(server, RESPONSE[:cut]), complete=False) as raw:
+        result, dispatched = asyncio.run(stream(raw, cancel_after_action=True))
+    assert result.text == RESPONSE[:cut]
+    assert dispatched == [] and result.actions == []
+    assert result.time_to_action is None
+    assert not result.cancelled
+
+
+def test_malformed_chunk_keeps_the_text_so_far():
+    server = StubServer()
+    lines = chunks(server, "Thought: The YouTube icon") + ['{"choices": [{"delta": {"content": "is in the', "[not json"]
+    with RawStreamStub(lines) as raw:
+        result, dispatched = asyncio.run(stream(raw, cancel_after_action=True))
+    assert result.text == "Thought: The YouTube icon"
+    assert dispatched == []
+    assert not result.cancelled
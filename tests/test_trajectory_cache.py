@@ -0,0 +1,62 @@
+import itertools
+import trajectory_cache
+from trajectory_cache import TrajectoryStep, TrajectoryStore
+
+
+def steps(count):
+    return [TrajectoryStep(index, f"Action: click(start_box='(500,{index})')", [{"type": "click", "x": 500, "y": index}]) for index in range(count)]
+
+
+def test_least_recently_used_is_evicted(monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(trajectory_cache.time, "time", lambda: next(clock))
+    store = TrajectoryStore(max_trajectories=2)
+    store.record("Open Youtube", steps(2))
+    store.record("Open Settings", steps(1))
+    assert store.lookup("open youtube!") is not None
+    store.record("Open Maps", steps(3))
+    assert store.lookup("Open Settings") is None
+    assert store.lookup("Open Youtube").steps == steps(2)
+    assert len(store.lookup("Open Maps").steps) == 3
+    assert store.stats()["trajectories"] == 2
+
+
+def test_record_replaces_the_same_instruction():
+    store = TrajectoryStore(max_trajectories=2)
+    store.record("Open Youtube", steps(2))
+    store.record("open  youtube", steps(4))
+    assert store.stats()["trajectories"] == 1
+    assert len(store.lookup("Open Youtube").steps) == 4
+
+
+def test_failing_trajectory_is_dropped():
+    store = TrajectoryStore(min_replays=3)
+    store.record("Open Youtube", steps(2))
+    trajectory = store.lookup("Open Youtube")
+    store.record_replay(trajectory, 2, True)
+    store.record_replay(trajectory, 1, False)
+    assert store.lookup("Open Youtube") is not None
+    store.record_replay(trajectory, 0, False)
+    assert store.lookup("Open Youtube") is None
+    assert store.stats()["trajectories"] == 0
+
+
+def test_new_recording_resets_replay_counts():
+    store = TrajectoryStore(min_replays=3)
+    store.record("Open Youtube", steps(2))
+    trajectory = store.lookup("Open Youtube")
+    store.record_replay(trajectory, 0, False)
+    store.record_replay(trajectory, 0, False)
+    store.record("Open Youtube", steps(3))
+    assert store.stats()["replays"] == 0
+    store.record_replay(store.lookup("Open Youtube"), 0, False)
+    assert store.lookup("Open Youtube") is not None
+
+
+def test_matches():
+    trajectory = TrajectoryStore()
+    trajectory.record("Open Youtube", [TrajectoryStep(0b1111, "", [])])
+    recorded = trajectory.lookup("Open Youtube")
+    assert recorded.matches(0, 0b1111 ^ 0b11111, max_distance=5)
+    assert not recorded.matches(0, 0b1111 ^ 0b111111, max_distance=5)
+    assert not recorded.matches(1, 0b1111, max_distance=5)
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import sys
+import time
+from PIL import Image
+from actions import ActionSpace
+from inference_client import InferenceClient
+from main import run_task_async
+from stub_server import StubServer
+from tracing import Tracer
+from ui_hierarchy import UiHierarchy
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "settings.xml")
+FAKE_ADB = f"{sys.executable} {os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'fake_adb.py')}"
+
+
+def settings():
+    with open(FIXTURE, "rb") as f:
+        return UiHierarchy.from_xml(f.read())
+
+
+def test_from_xml():
+    hierarchy = settings()
+    assert len(hierarchy) == 15
+    root, search_bar, search_icon = hierarchy.elements[:3]
+    assert root.class_name == "android.widget.FrameLayout" and not root.clickable and root.clickable_index is None
+    assert search_bar.resource_id == "com.android.settings:id/search_action_bar"
+    assert search_bar.bounds == (40, 100, 1040, 220) and search_bar.center == (540, 160)
+    assert search_bar.clickable and search_bar.clickable_index == search_bar.index
+    assert search_icon.content_desc == "Search" and search_icon.clickable_index == search_bar.index
+    assert hierarchy.elements[5].text == "Network & internet"
+    reset = next(element for element in hierarchy.elements if element.text == "Reset options")
+    assert reset.clickable and not reset.enabled
+
+
+def test_find_exact_label():
+    hierarchy = settings()
+    assert hierarchy.find("Battery").resource_id == "com.android.settings:id/battery"
+    assert hierarchy.find("battery ").bounds == (560, 2200, 1040, 2320)
+    assert hierarchy.find("search_action_bar").bounds == (40, 100, 1040, 220)
+    assert hierarchy.find("hotspot").bounds == (0, 400, 1080, 560)
+
+
+def test_find_ambiguous_or_missing_label():
+    hierarchy = settings()
+    # Title of one row and summary of another.
+    assert hierarchy.find("Notifications") is None
+    assert hierarchy.find("Bluetooth") is None
+    assert hierarchy.find("Reset options") is None
+
+
+def test_find_resolves_the_clickable_ancestor():
+    hierarchy = settings()
+    # Both labels are on children of the search bar, which is what gets tapped.
+    assert hierarchy.find("Search").resource_id == "com.android.settings:id/search_action_bar"
+    assert hierarchy.find("Search settings").resource_id == "com.android.settings:id/search_action_bar"
+    assert hierarchy.find("Network & internet").bounds == (0, 400, 1080, 560)
+
+
+def test_snap_to_elements():
+    space = ActionSpace(image_width=1080, image_height=2400, use_shell_session=False, wait_for_settle=False, frame_source=object())
+    hierarchy = settings()
+    actions = [
+        # 20px right of the battery button.
+        {"type": "click", "x": space.grid_point(1060, 2260)[0], "y": space.grid_point(1060, 2260)[1]},
+        # Inside the search bar, left as it is.
+        {"type": "long_press", "x": 500, "y": 70},
+        # Next to the disabled reset button only.
+        {"type": "double_click", "x": space.grid_point(30, 2260)[0], "y": space.grid_point(30, 2260)[1]},
+        {"type": "scroll", "start_x": 980, "start_y": 940, "end_x": 980, "end_y": 500},
+        {"type": "press_back"},
+    ]
+    snapped = space.snap_to_elements(actions, hierarchy, max_distance=48)
+    assert snapped[0] == {"type": "click", "x": space.grid_point(800, 2260)[0], "y": space.grid_point(800, 2260)[1]}
+    assert snapped[1:] == actions[1:]
+    assert space.snap_to_elements(actions[:1], hierarchy, max_distance=10) == actions[:1]
+
+
+class ListSink(list):
+    def write(self, record):
+        self.append(record)
+
+    def close(self):
+        pass
+
+
+def run_fast_path(tmp_path, monkeypatch, plan, server, sink=None):
+    monkeypatch.setenv("FAKE_ADB_ROOT", str(tmp_path))
+    monkeypatch.setenv("FAKE_ADB_FRAME", str(tmp_path / "frame.png"))
+    monkeypatch.setenv("FAKE_ADB_HIERARCHY", FIXTURE)
+    Image.new("RGB", (1080, 2400), "#ffffff").save(tmp_path / "frame.png")
+    client = InferenceClient([("stub", server.url)], api_key="stub")
+    started = time.monotonic()
+    result = asyncio.run(run_task_async(plan, max_itr=2, adb_path=FAKE_ADB, inference_client=client, ui_fast_path=True, tracer=Tracer(sink)))
+    return result, time.monotonic() - started
+
+
+def test_fast_path_cancels_the_model_request(tmp_path, monkeypatch):
+    sink = ListSink()
+    with StubServer(["Thought: Done.\nAction: finished(content='')"], latency=5) as server:
+        result, elapsed = run_fast_path(tmp_path, monkeypatch, "Tap Battery", server, sink)
+    assert result["status"] == "finished" and result["steps"] == 1
+    # The request was started with the hierarchy dump, and cancelled once the target was found.
+    spans = {record["name"]: record for record in sink if record["type"] == "span"}
+    assert spans["request"]["error"] == "CancelledError"
+    assert spans["request"]["start"] <= spans["hierarchy"]["start"] + spans["hierarchy"]["duration"]
+    assert elapsed < 5
+    assert (tmp_path / "gestures").read_text().strip() == "1"
+
+
+def test_fast_path_miss_uses_the_model(tmp_path, monkeypatch):
+    with StubServer(["Thought: Done.\nAction: finished(content='')"], latency=0.2) as server:
+        result, _ = run_fast_path(tmp_path, monkeypatch, "Tap Bluetooth", server)
+        assert server.requests == 1
+    assert result["status"] == "finished"